@@ -1,21 +1,21 @@
-import dataclasses
-import io
-import json
 import logging
 import mimetypes
 import os
+import tempfile
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Union, cast
+from typing import Any, AsyncGenerator, Dict, List, Union, cast
 
+from azure.core import MatchConditions
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.storage.blob.aio import BlobServiceClient
+from azure.search.documents.models import CaptionResult
+from azure.storage.blob.aio import BlobClient, BlobServiceClient
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
@@ -28,30 +28,47 @@ from quart import (
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
+from werkzeug.http import http_date, quote_etag, unquote_etag
 
-from approaches.approach import Approach
+from approaches.approach import Approach, CachedAnswer, Document, ThoughtStep
+from approaches.chatapproach import ChatApproach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from config import (
+    CONFIG_ANSWER_CACHE,
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
     CONFIG_BLOB_CONTAINER_CLIENT,
+    CONFIG_CACHE_BACKENDS,
     CONFIG_CHAT_APPROACH,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_DELTA_COALESCER,
+    CONFIG_EMBEDDING_CACHE,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HTTP_SESSION,
+    CONFIG_INDEX_VERSION_WATCHER,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_SEARCH_CACHE,
     CONFIG_SEARCH_CLIENT,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
+    CONFIG_THOUGHTS_STORE,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.cachebackends import CACHE_BACKENDS, CacheBackendFactory
+from core.deltacoalescer import DeltaCoalescer
+from core.httpsession import create_http_session
+from core.indexversion import IndexVersionWatcher
+from core.serialization import dumps, dumps_ndjson_line
+from core.singleflight import SingleFlight
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 
@@ -91,28 +108,101 @@ async def content_file(path: str):
     *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
     if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
     if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
-    This is also slow and memory hungry.
+    The blob is streamed in chunks, so memory use doesn't grow with the file size. Single byte ranges
+    and conditional requests (ETag and Last-Modified) are supported, as PDF viewers rely on them.
     """
     # Remove page number from path, filename-1.txt -> filename.txt
     if path.find("#page=") > 0:
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
-    logging.info("Opening file %s at page %s", path)
+    logging.info("Opening file %s", path)
     blob_container_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    blob_client = blob_container_client.get_blob_client(path)
+    return await make_blob_response(blob_client, path)
+
+
+async def make_blob_response(blob_client: BlobClient, path: str, retries: int = 1):
+    """
+    Streams the blob, or the requested range of it, with headers computed from its properties.
+    If the blob is replaced after its properties were read, they are read again up to `retries` times,
+    after which the response is 412, as the client may otherwise mix parts of both versions.
+    """
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        properties = await blob_client.get_blob_properties()
     except ResourceNotFoundError:
         logging.exception("Path not found: %s", path)
         abort(404)
-    if not blob.properties or not blob.properties.has_key("content_settings"):
-        abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    mime_type = properties.content_settings.content_type
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    etag = unquote_etag(properties.etag)[0] if properties.etag else None
+    last_modified = properties.last_modified.replace(microsecond=0) if properties.last_modified else None
+
+    # The If-None-Match header takes precedence over If-Modified-Since
+    if request.if_none_match:
+        not_modified = etag is not None and request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = (
+            last_modified is not None
+            and request.if_modified_since is not None
+            and last_modified <= request.if_modified_since
+        )
+
+    headers = {"Accept-Ranges": "bytes"}
+    if etag:
+        headers["ETag"] = quote_etag(etag)
+    if last_modified:
+        headers["Last-Modified"] = http_date(last_modified)
+    if not_modified:
+        return await make_response("", 304, headers)
+
+    size = properties.size
+    start, end = 0, size
+    status = 200
+    # Only single ranges are served partially, and only if the file didn't change since the client's copy (If-Range)
+    if_range = request.if_range
+    if_range_matches = (not if_range.etag and not if_range.date) or (
+        (if_range.etag is not None and if_range.etag == etag)
+        or (if_range.date is not None and last_modified is not None and if_range.date == last_modified)
+    )
+    if request.range and len(request.range.ranges) == 1 and if_range_matches:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return await make_response("", 416, {**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    # An empty blob can't be downloaded with a range, and has nothing to download anyway
+    if end == start:
+        response = await make_response(b"", status, headers)
+        response.mimetype = mime_type
+        return response
+
+    # Download from the same blob version that the headers were computed from
+    try:
+        downloader = await blob_client.download_blob(
+            offset=start,
+            length=end - start,
+            etag=properties.etag,
+            match_condition=MatchConditions.IfNotModified,
+        )
+    except ResourceModifiedError:
+        if retries > 0:
+            logging.info("File %s changed while opening it, retrying", path)
+            return await make_blob_response(blob_client, path, retries - 1)
+        logging.warning("File %s keeps changing while opening it", path)
+        abort(412)
+
+    async def stream_blob() -> AsyncGenerator[bytes, None]:
+        async for chunk in downloader.chunks():
+            yield chunk
+
+    response = await make_response(stream_blob(), status, headers)
+    response.mimetype = mime_type
+    response.content_length = end - start
+    response.timeout = None  # type: ignore
+    return response
 
 
 @bp.route("/ask", methods=["POST"])
@@ -130,28 +220,35 @@ async def ask(auth_claims: Dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
+        result = await approach.run(
+            request_json["messages"],
+            stream=request_json.get("stream", False),
+            context=context,
+            session_state=request_json.get("session_state"),
         )
-        return jsonify(r)
+        if isinstance(result, dict):
+            return jsonify(result)
+        else:
+            return await make_ndjson_response(result)
     except Exception as error:
         return error_response(error, "/ask")
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        return super().default(o)
-
-
 async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            yield dumps_ndjson_line(event)
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps(error_dict(error))
+        yield dumps(error_dict(error))
+
+
+async def make_ndjson_response(result: AsyncGenerator[dict, None]):
+    delta_coalescer: DeltaCoalescer = current_app.config[CONFIG_DELTA_COALESCER]
+    response = await make_response(format_as_ndjson(delta_coalescer.coalesce(result)))
+    response.timeout = None  # type: ignore
+    response.mimetype = "application/json-lines"
+    return response
 
 
 @bp.route("/chat", methods=["POST"])
@@ -179,14 +276,22 @@ async def chat(auth_claims: Dict[str, Any]):
         if isinstance(result, dict):
             return jsonify(result)
         else:
-            response = await make_response(format_as_ndjson(result))
-            response.timeout = None  # type: ignore
-            response.mimetype = "application/json-lines"
-            return response
+            return await make_ndjson_response(result)
     except Exception as error:
         return error_response(error, "/chat")
 
 
+@bp.route("/thoughts/<thoughts_id>", methods=["GET"])
+@authenticated
+async def thoughts(auth_claims: Dict[str, Any], thoughts_id: str):
+    thoughts_store: TTLCache[Dict[str, Any]] = current_app.config[CONFIG_THOUGHTS_STORE]
+    entry = await thoughts_store.aget(thoughts_id)
+    # Only the user who asked the question can see its thought process
+    if entry is None or entry["oid"] != auth_claims.get("oid"):
+        return jsonify({"error": "thoughts not found or expired"}), 404
+    return jsonify({"thoughts": entry["thoughts"]})
+
+
 # Send MSAL.js settings to the client UI
 @bp.route("/auth_setup", methods=["GET"])
 def auth_setup():
@@ -237,6 +342,14 @@ async def setup_clients():
     AZURE_SERVER_APP_SECRET = os.getenv("AZURE_SERVER_APP_SECRET")
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_AUTH_TENANT_ID = os.getenv("AZURE_AUTH_TENANT_ID", AZURE_TENANT_ID)
+    AUTH_JWKS_CACHE_TTL = float(os.getenv("AUTH_JWKS_CACHE_TTL", "86400"))
+    AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "1024"))
+    AUTH_TOKEN_CACHE_TTL = float(os.getenv("AUTH_TOKEN_CACHE_TTL", "300"))
+    AUTH_OBO_MAX_WORKERS = int(os.getenv("AUTH_OBO_MAX_WORKERS", "4"))
+    AUTH_GROUPS_CACHE_TTL = float(os.getenv("AUTH_GROUPS_CACHE_TTL", "300"))
+    AUTH_GROUPS_STALE_TTL = float(os.getenv("AUTH_GROUPS_STALE_TTL", "600"))
+    AUTH_PATH_CACHE_SIZE = int(os.getenv("AUTH_PATH_CACHE_SIZE", "4096"))
+    AUTH_PATH_CACHE_TTL = float(os.getenv("AUTH_PATH_CACHE_TTL", "60"))
 
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
@@ -246,6 +359,61 @@ async def setup_clients():
     AZURE_SEARCH_SEMANTIC_RANKER = os.getenv("AZURE_SEARCH_SEMANTIC_RANKER", "free").lower()
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
+    # Whether the chat approaches generate the search query with the model: always, never or heuristic
+    QUERY_REWRITE_MODE = os.getenv("QUERY_REWRITE_MODE", ChatApproach.QUERY_REWRITE_ALWAYS).lower()
+    if QUERY_REWRITE_MODE not in ChatApproach.QUERY_REWRITE_MODES:
+        raise ValueError(f"QUERY_REWRITE_MODE must be one of {', '.join(ChatApproach.QUERY_REWRITE_MODES)}")
+    # Retrieve documents for the user's question while the search query is generated, and keep them if it's similar
+    SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "").lower() == "true"
+    # Whether the responses include the thought process: full, none or deferred, to fetch it from /thoughts/<id>
+    THOUGHTS_MODE = os.getenv("THOUGHTS_MODE", Approach.THOUGHTS_FULL).lower()
+    if THOUGHTS_MODE not in Approach.THOUGHTS_MODES:
+        raise ValueError(f"THOUGHTS_MODE must be one of {', '.join(Approach.THOUGHTS_MODES)}")
+    # Deferred thoughts are kept in the cache backend for a short while, set the size to 0 to leave them out instead
+    THOUGHTS_STORE_SIZE = int(os.getenv("THOUGHTS_STORE_SIZE", "1024"))
+    THOUGHTS_STORE_TTL = float(os.getenv("THOUGHTS_STORE_TTL", "300"))
+
+    # Where the caches below keep their entries: memory (per worker process), sqlite (a file shared by the workers of
+    # an instance) or redis (a server shared by all instances). The token counts are always kept in memory
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+    if CACHE_BACKEND not in CACHE_BACKENDS:
+        raise ValueError(f"CACHE_BACKEND must be one of {', '.join(CACHE_BACKENDS)}")
+    CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "app-cache.sqlite3"))
+    CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+    CACHE_TIMEOUT = float(os.getenv("CACHE_TIMEOUT", "0.5"))
+    # The secret the sqlite and redis entries are signed with, the same for all the workers and instances,
+    # so that entries written by anyone else with access to the file or the server are ignored
+    CACHE_SIGNING_KEY = os.getenv("CACHE_SIGNING_KEY")
+    # The thoughts are fetched by a later request, which any worker may serve, so they can't be kept in memory
+    if THOUGHTS_MODE == Approach.THOUGHTS_DEFERRED and CACHE_BACKEND == "memory":
+        raise ValueError("THOUGHTS_MODE=deferred needs a CACHE_BACKEND shared by the workers: sqlite or redis")
+    # Query embeddings are cached and shared by all approaches, set the size to 0 to disable the cache
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+    EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+    # Search results are cached per query and security filter, and cleared when prepdocs updates the index version
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+    SEARCH_CACHE_VERSION_POLL_INTERVAL = float(os.getenv("SEARCH_CACHE_VERSION_POLL_INTERVAL", "60"))
+    # Token counts of chat messages, so the history resent on every turn is only tokenized once
+    TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "8192"))
+    TOKEN_COUNT_CACHE_TTL = float(os.getenv("TOKEN_COUNT_CACHE_TTL", "3600"))
+    # Answers to single-turn questions, reused for questions whose embedding is similar enough in the same security scope.
+    # Disabled by default, set the size to enable it
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "0"))
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY", "0.97"))
+    VISION_VECTOR_TIMEOUT = float(os.getenv("VISION_VECTOR_TIMEOUT", "10"))
+    VISION_IMAGE_FETCH_CONCURRENCY = int(os.getenv("VISION_IMAGE_FETCH_CONCURRENCY", "5"))
+    CONTENT_CHUNK_SIZE = int(os.getenv("CONTENT_CHUNK_SIZE", str(4 * 1024 * 1024)))
+    # Connection pool shared by the calls to Azure AI Vision, Microsoft Graph and the Entra ID keys endpoint
+    HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+    HTTP_POOL_SIZE_PER_HOST = int(os.getenv("HTTP_POOL_SIZE_PER_HOST", "20"))
+    HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+    HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+    # Consecutive content deltas of a streamed chat response are sent together, set either to 0 to send each delta
+    STREAM_COALESCE_MAX_CHARS = int(os.getenv("STREAM_COALESCE_MAX_CHARS", "100"))
+    STREAM_COALESCE_MAX_DELAY_MS = float(os.getenv("STREAM_COALESCE_MAX_DELAY_MS", "30"))
 
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -278,11 +446,33 @@ async def setup_clients():
         credential=search_credential,
     )
 
+    # Downloads are read in chunks of this size, which bounds the memory used to stream a file from /content
     blob_client = BlobServiceClient(
-        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=azure_credential,
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
     )
     blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
+    http_session = create_http_session(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+        timeout=HTTP_TIMEOUT,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        dns_cache_ttl=HTTP_DNS_CACHE_TTL,
+    )
+
+    cache_backends = CacheBackendFactory(
+        CACHE_BACKEND,
+        sqlite_path=CACHE_SQLITE_PATH,
+        redis_url=CACHE_REDIS_URL,
+        timeout=CACHE_TIMEOUT,
+        signing_key=CACHE_SIGNING_KEY,
+        value_types=[Document, ThoughtStep, CachedAnswer, CaptionResult],
+    )
+    current_app.config[CONFIG_CACHE_BACKENDS] = cache_backends
+
     # Set up authentication helper
     auth_helper = AuthenticationHelper(
         search_index=(await search_index_client.get_index(AZURE_SEARCH_INDEX)) if AZURE_USE_AUTHENTICATION else None,
@@ -292,6 +482,16 @@ async def setup_clients():
         client_app_id=AZURE_CLIENT_APP_ID,
         tenant_id=AZURE_AUTH_TENANT_ID,
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
+        http_session=http_session,
+        jwks_cache_ttl=AUTH_JWKS_CACHE_TTL,
+        token_cache_size=AUTH_TOKEN_CACHE_SIZE,
+        token_cache_ttl=AUTH_TOKEN_CACHE_TTL,
+        obo_max_workers=AUTH_OBO_MAX_WORKERS,
+        groups_cache_ttl=AUTH_GROUPS_CACHE_TTL,
+        groups_stale_ttl=AUTH_GROUPS_STALE_TTL,
+        path_auth_cache_size=AUTH_PATH_CACHE_SIZE,
+        path_auth_cache_ttl=AUTH_PATH_CACHE_TTL,
+        cache_backends=cache_backends,
     )
 
     # Used by the OpenAI SDK
@@ -317,6 +517,60 @@ async def setup_clients():
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
+    current_app.config[CONFIG_HTTP_SESSION] = http_session
+
+    embedding_cache: TTLCache[List[float]] = TTLCache(
+        maxsize=EMBEDDING_CACHE_SIZE,
+        ttl=EMBEDDING_CACHE_TTL,
+        backend=cache_backends.create("embeddings", EMBEDDING_CACHE_SIZE),
+    )
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    search_cache: TTLCache[List[Document]] = TTLCache(
+        maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, backend=cache_backends.create("search", SEARCH_CACHE_SIZE)
+    )
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+    answer_cache: SemanticAnswerCache[CachedAnswer] = SemanticAnswerCache(
+        maxsize=ANSWER_CACHE_SIZE,
+        ttl=ANSWER_CACHE_TTL,
+        min_similarity=ANSWER_CACHE_MIN_SIMILARITY,
+        # Each answer also has a member in the index of its scope
+        backend=cache_backends.create("answers", 2 * ANSWER_CACHE_SIZE) if cache_backends.shared else None,
+    )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    # The index version the caches were filled with. Shared caches outlive the workers, so a worker that starts
+    # only clears them if the index changed since, rather than every time the workers are recycled
+    cached_index_versions: TTLCache[str] = TTLCache(
+        maxsize=1, ttl=max(SEARCH_CACHE_TTL, ANSWER_CACHE_TTL), backend=cache_backends.create("index_version", 1)
+    )
+
+    async def clear_caches():
+        version = str(index_version_watcher.version)
+        if await cached_index_versions.aget("index") == version:
+            return
+        await search_cache.aclear()
+        await answer_cache.aclear()
+        await cached_index_versions.aset("index", version)
+
+    index_version_watcher = IndexVersionWatcher(
+        blob_container_client, on_change=clear_caches, interval=SEARCH_CACHE_VERSION_POLL_INTERVAL
+    )
+    if search_cache.enabled or answer_cache.enabled:
+        index_version_watcher.start()
+    current_app.config[CONFIG_INDEX_VERSION_WATCHER] = index_version_watcher
+    # Concurrent identical query rewrites, embeddings and searches share a single upstream call
+    single_flight: SingleFlight = SingleFlight()
+    token_count_cache: TTLCache[int] = TTLCache(maxsize=TOKEN_COUNT_CACHE_SIZE, ttl=TOKEN_COUNT_CACHE_TTL)
+    # Shared, the thoughts can be fetched from any worker, not only the one that answered. In memory, the store is
+    # disabled, so that the thoughts_mode override leaves the thoughts out rather than sending IDs other workers lack
+    thoughts_store: TTLCache[Dict[str, Any]] = TTLCache(
+        maxsize=THOUGHTS_STORE_SIZE if cache_backends.shared else 0,
+        ttl=THOUGHTS_STORE_TTL,
+        backend=cache_backends.create("thoughts", THOUGHTS_STORE_SIZE),
+    )
+    current_app.config[CONFIG_THOUGHTS_STORE] = thoughts_store
+    current_app.config[CONFIG_DELTA_COALESCER] = DeltaCoalescer(
+        max_chars=STREAM_COALESCE_MAX_CHARS, max_delay=STREAM_COALESCE_MAX_DELAY_MS / 1000
+    )
 
     current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
     current_app.config[CONFIG_SEMANTIC_RANKER_DEPLOYED] = AZURE_SEARCH_SEMANTIC_RANKER != "disabled"
@@ -336,6 +590,12 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        single_flight=single_flight,
+        thoughts_mode=THOUGHTS_MODE,
+        thoughts_store=thoughts_store,
+        answer_cache=answer_cache,
     )
 
     if USE_GPT4V:
@@ -357,6 +617,15 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            vector_timeout=VISION_VECTOR_TIMEOUT,
+            image_fetch_concurrency=VISION_IMAGE_FETCH_CONCURRENCY,
+            http_session=http_session,
+            search_cache=search_cache,
+            single_flight=single_flight,
+            thoughts_mode=THOUGHTS_MODE,
+            thoughts_store=thoughts_store,
+            answer_cache=answer_cache,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -374,6 +643,17 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            vector_timeout=VISION_VECTOR_TIMEOUT,
+            image_fetch_concurrency=VISION_IMAGE_FETCH_CONCURRENCY,
+            http_session=http_session,
+            search_cache=search_cache,
+            single_flight=single_flight,
+            token_count_cache=token_count_cache,
+            query_rewrite_mode=QUERY_REWRITE_MODE,
+            thoughts_mode=THOUGHTS_MODE,
+            thoughts_store=thoughts_store,
+            answer_cache=answer_cache,
         )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -388,6 +668,15 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        single_flight=single_flight,
+        token_count_cache=token_count_cache,
+        query_rewrite_mode=QUERY_REWRITE_MODE,
+        speculative_retrieval=SPECULATIVE_RETRIEVAL,
+        thoughts_mode=THOUGHTS_MODE,
+        thoughts_store=thoughts_store,
+        answer_cache=answer_cache,
     )
 
 
@@ -395,6 +684,10 @@ async def setup_clients():
 async def close_clients():
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
+    await current_app.config[CONFIG_HTTP_SESSION].close()
+    await current_app.config[CONFIG_INDEX_VERSION_WATCHER].close()
+    current_app.config[CONFIG_AUTH_CLIENT].close()
+    await current_app.config[CONFIG_CACHE_BACKENDS].close()
 
 
 def create_app():
@@ -1,6 +1,26 @@
+import array
+import asyncio
+import hashlib
+import json
+import logging
 import os
+import re
+import time
+import unicodedata
+import uuid
 from dataclasses import dataclass
-from typing import Any, AsyncGenerator, List, Optional, Union, cast
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Hashable,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import aiohttp
 from azure.search.documents.aio import SearchClient
@@ -11,10 +31,28 @@ from azure.search.documents.models import (
     VectorQuery,
 )
 from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from opentelemetry import metrics
 
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.httpsession import use_http_session
+from core.modelhelper import get_encoding, num_tokens_from_texts
+from core.singleflight import SingleFlight
 from text import nonewlines
 
+T = TypeVar("T")
+
+# The end of a sentence, in English or Japanese, where a truncated source can be cut
+SENTENCE_END = re.compile(r"[.!?](?=\s)|[。！？]")
+
+meter = metrics.get_meter(__name__)
+answer_cache_lookups = meter.create_counter(
+    "app.answer_cache.lookups",
+    description="Single-turn questions by whether their answer was found in the answer cache",
+)
+
 
 @dataclass
 class Document:
@@ -74,7 +112,26 @@ class ThoughtStep:
     props: Optional[dict[str, Any]] = None
 
 
+@dataclass
+class CachedAnswer:
+    question: str
+    content: str
+    context: dict[str, Any]
+
+
 class Approach:
+    # What the responses include of the thought process: all of it, none of it, or an ID to fetch it from
+    # the thoughts store for a short while, see get_response_context
+    THOUGHTS_FULL = "full"
+    THOUGHTS_NONE = "none"
+    THOUGHTS_DEFERRED = "deferred"
+    THOUGHTS_MODES = [THOUGHTS_FULL, THOUGHTS_NONE, THOUGHTS_DEFERRED]
+    thoughts_mode = THOUGHTS_FULL
+    thoughts_store: Optional[TTLCache[dict[str, Any]]] = None
+    # Overrides that don't change the answer, so requests that only differ by them share the cached answers
+    ANSWER_CACHE_IGNORED_OVERRIDES = {"thoughts_mode", "use_answer_cache"}
+    answer_cache: Optional[SemanticAnswerCache[CachedAnswer]] = None
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -85,6 +142,13 @@ class Approach:
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         openai_host: str,
+        embedding_cache: Optional[TTLCache[List[float]]] = None,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        search_cache: Optional[TTLCache[List[Document]]] = None,
+        single_flight: Optional[SingleFlight] = None,
+        thoughts_mode: str = THOUGHTS_FULL,
+        thoughts_store: Optional[TTLCache[dict[str, Any]]] = None,
+        answer_cache: Optional[SemanticAnswerCache[CachedAnswer]] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -94,6 +158,13 @@ class Approach:
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.openai_host = openai_host
+        self.embedding_cache = embedding_cache
+        self.http_session = http_session
+        self.search_cache = search_cache
+        self.single_flight = single_flight
+        self.thoughts_mode = thoughts_mode
+        self.thoughts_store = thoughts_store
+        self.answer_cache = answer_cache
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         exclude_category = overrides.get("exclude_category")
@@ -113,7 +184,10 @@ class Approach:
         vectors: List[VectorQuery],
         use_semantic_ranker: bool,
         use_semantic_captions: bool,
+        include_vectors: bool = False,
     ) -> List[Document]:
+        # The stored vectors are large and only shown trimmed in the thoughts, so only fetch them when asked to
+        select = None if include_vectors else self.get_select_fields()
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
         if use_semantic_ranker and query_text:
             results = await self.search_client.search(
@@ -126,10 +200,11 @@ class Approach:
                 top=top,
                 query_caption="extractive|highlight-false" if use_semantic_captions else None,
                 vector_queries=vectors,
+                select=select,
             )
         else:
             results = await self.search_client.search(
-                search_text=query_text or "", filter=filter, top=top, vector_queries=vectors
+                search_text=query_text or "", filter=filter, top=top, vector_queries=vectors, select=select
             )
 
         documents = []
@@ -151,6 +226,79 @@ class Approach:
                 )
         return documents
 
+    def get_search_cache_key(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        include_vectors: bool,
+    ) -> Hashable:
+        # The filter includes the security filter, so users with different access never share results
+        vector_keys = []
+        for vector in vectors:
+            values = getattr(vector, "vector", None) or []
+            digest = hashlib.sha256(array.array("d", values).tobytes()).hexdigest()
+            vector_keys.append((vector.fields, vector.k, vector.exhaustive, digest))
+        return (
+            query_text,
+            filter,
+            tuple(vector_keys),
+            top,
+            use_semantic_ranker,
+            use_semantic_captions,
+            include_vectors,
+            self.query_language,
+            self.query_speller,
+        )
+
+    async def search_with_cache(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        include_vectors: bool = False,
+        use_cache: bool = True,
+    ) -> tuple[List[Document], dict[str, Any]]:
+        """
+        Runs the search, or returns the results of an identical recent search from the search cache.
+        Returns the results along with whether they came from the cache, for the thoughts panel.
+        """
+        cache_key = self.get_search_cache_key(
+            top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions, include_vectors
+        )
+        use_cache = use_cache and self.search_cache is not None and self.search_cache.enabled
+        if use_cache and self.search_cache is not None:
+            cached_results = await self.search_cache.aget(cache_key)
+            if cached_results is not None:
+                # Copy the list so callers can't change the cached entry
+                return list(cached_results), {"search_cache_hit": True}
+
+        results = await self.run_single_flight(
+            ("search", cache_key),
+            lambda: self.search(
+                top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions, include_vectors
+            ),
+        )
+        if use_cache and self.search_cache is not None:
+            await self.search_cache.aset(cache_key, list(results))
+        # Concurrent identical searches share the same results, so each caller gets its own list
+        return list(results), {"search_cache_hit": False}
+
+    async def run_single_flight(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Runs fn, unless an identical call is already in flight, in which case its result is shared.
+        A caller that disconnects doesn't cancel the call for the others.
+        """
+        if self.single_flight is None:
+            return await fn()
+        return await self.single_flight.do(key, fn)
+
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
     ) -> list[str]:
@@ -167,6 +315,72 @@ class Approach:
                 for doc in results
             ]
 
+    def pack_sources(
+        self, sources_content: List[str], token_budget: int, model: str
+    ) -> tuple[List[str], dict[str, Any]]:
+        """
+        Keeps the sources, in order of relevance, that fit in the token budget.
+        The first source that doesn't fit is truncated at the last sentence that fits, and the next ones are dropped.
+        Returns the packed sources along with what was dropped or truncated, for the thoughts panel.
+        """
+        # Each source is followed by a newline when the sources are joined
+        token_counts = [count + 1 for count in num_tokens_from_texts(sources_content, model)]
+        packed: List[str] = []
+        used_tokens = 0
+        truncated: Optional[str] = None
+        dropped: List[str] = []
+        for index, (source, token_count) in enumerate(zip(sources_content, token_counts)):
+            if used_tokens + token_count <= token_budget:
+                packed.append(source)
+                used_tokens += token_count
+                continue
+            truncated_source = self.truncate_source(source, token_budget - used_tokens - 1, model)
+            if truncated_source:
+                packed.append(truncated_source)
+                used_tokens += num_tokens_from_texts([truncated_source], model)[0] + 1
+                truncated = self.get_source_name(source)
+            else:
+                dropped.append(self.get_source_name(source))
+            dropped += [self.get_source_name(source) for source in sources_content[index + 1 :]]
+            break
+        return packed, {
+            "sources_token_budget": token_budget,
+            "sources_tokens": used_tokens,
+            "sources_truncated": truncated,
+            "sources_dropped": dropped,
+        }
+
+    def truncate_source(self, source: str, max_tokens: int, model: str) -> Optional[str]:
+        """Truncates a source to its last complete sentence within max_tokens, or returns None if none fits."""
+        if max_tokens <= 0:
+            return None
+        encoding = get_encoding(model)
+        # Decoding a prefix of the tokens may split a multi-byte character at the end
+        text = encoding.decode(encoding.encode(source)[:max_tokens]).rstrip("\ufffd")
+        # Never cut inside the citation that prefixes the source
+        content_start = len(self.get_source_name(source)) + 2
+        sentence_ends = [match.end() for match in SENTENCE_END.finditer(text, content_start)]
+        if not sentence_ends:
+            return None
+        return text[: sentence_ends[-1]]
+
+    @staticmethod
+    def get_source_name(source: str) -> str:
+        return source.split(": ", 1)[0]
+
+    def get_select_fields(self) -> List[str]:
+        """Returns the index fields needed to build the sources and the results thoughts, leaving out the vectors."""
+        fields = ["id", "content", "category", "sourcepage", "sourcefile"]
+        # The access control fields only exist in indexes that were created with them
+        if self.auth_helper.has_auth_fields:
+            fields += ["oids", "groups"]
+        return fields
+
+    def preauthorize_citations(self, results: List[Document], use_image_citation: bool, auth_claims: dict[str, Any]):
+        """Checks access to the cited files in the background, so opening a citation doesn't need a search query."""
+        paths = [self.get_citation(doc.sourcepage, use_image_citation) for doc in results if doc.sourcepage]
+        self.auth_helper.schedule_path_preauthorization(paths, auth_claims, self.search_client)
+
     def get_citation(self, sourcepage: str, use_image_citation: bool) -> str:
         if use_image_citation:
             return sourcepage
@@ -179,30 +393,390 @@ class Approach:
 
             return sourcepage
 
-    async def compute_text_embedding(self, q: str):
-        embedding = await self.openai_client.embeddings.create(
-            # Azure Open AI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-        )
-        query_vector = embedding.data[0].embedding
+    @staticmethod
+    def normalize_query(q: str) -> str:
+        """Normalizes a query so that trivially different spellings share an embedding cache entry."""
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFC", q)).strip()
+
+    async def get_cached_embedding(self, key: tuple[str, str, str], use_cache: bool) -> Optional[List[float]]:
+        if use_cache and self.embedding_cache is not None:
+            return await self.embedding_cache.aget(key)
+        return None
+
+    async def set_cached_embedding(self, key: tuple[str, str, str], vector: List[float], use_cache: bool):
+        if use_cache and self.embedding_cache is not None:
+            await self.embedding_cache.aset(key, vector)
+
+    async def compute_text_embedding(self, q: str, use_cache: bool = True):
+        # Azure Open AI takes the deployment name as the model name
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+        cache_key = (model, self.normalize_query(q), "embedding")
+        query_vector = await self.get_cached_embedding(cache_key, use_cache)
+        if query_vector is None:
+            embedding = await self.run_single_flight(
+                cache_key, lambda: self.openai_client.embeddings.create(model=model, input=q)
+            )
+            query_vector = embedding.data[0].embedding
+            await self.set_cached_embedding(cache_key, query_vector, use_cache)
         return RawVectorQuery(vector=query_vector, k=50, fields="embedding")
 
-    async def compute_image_embedding(self, q: str, vision_endpoint: str, vision_key: str):
-        endpoint = f"{vision_endpoint}computervision/retrieval:vectorizeText"
-        params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
-        headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": vision_key}
-        data = {"text": q}
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
-            ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+    async def compute_image_embedding(self, q: str, vision_endpoint: str, vision_key: str, use_cache: bool = True):
+        cache_key = (vision_endpoint, self.normalize_query(q), "imageEmbedding")
+        image_query_vector = await self.get_cached_embedding(cache_key, use_cache)
+        if image_query_vector is None:
+            endpoint = f"{vision_endpoint}computervision/retrieval:vectorizeText"
+            params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
+            headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": vision_key}
+            data = {"text": q}
+
+            async def vectorize_text() -> List[float]:
+                async with use_http_session(self.http_session) as session:
+                    async with session.post(
+                        url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+                    ) as response:
+                        json = await response.json()
+                        return json["vector"]
+
+            image_query_vector = await self.run_single_flight(cache_key, vectorize_text)
+            await self.set_cached_embedding(cache_key, image_query_vector, use_cache)
         return RawVectorQuery(vector=image_query_vector, k=50, fields="imageEmbedding")
 
+    async def compute_vectors(
+        self,
+        q: str,
+        vector_fields: List[str],
+        vision_endpoint: str,
+        vision_key: str,
+        use_cache: bool = True,
+        timeout: Optional[float] = None,
+    ) -> tuple[List[VectorQuery], dict[str, Any]]:
+        """
+        Computes the query vectors for all of the requested fields concurrently.
+        A field whose embedding fails or exceeds the timeout is skipped,
+        so the search can still run with the vectors that succeeded.
+        Returns the vectors along with timing information for the thoughts panel.
+        """
+
+        async def compute_vector(field: str) -> tuple[VectorQuery, float]:
+            start = time.perf_counter()
+            coroutine = (
+                self.compute_text_embedding(q, use_cache)
+                if field == "embedding"
+                else self.compute_image_embedding(q, vision_endpoint, vision_key, use_cache)
+            )
+            vector = await asyncio.wait_for(coroutine, timeout)
+            return vector, time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[compute_vector(field) for field in vector_fields], return_exceptions=True)
+        elapsed = time.perf_counter() - start
+
+        vectors: List[VectorQuery] = []
+        latencies: dict[str, float] = {}
+        failed_fields: List[str] = []
+        errors: List[BaseException] = []
+        for field, result in zip(vector_fields, results):
+            if isinstance(result, BaseException):
+                logging.warning("Unable to compute %s vector for the query: %r", field, result)
+                failed_fields.append(field)
+                errors.append(result)
+            else:
+                vector, latency = result
+                vectors.append(vector)
+                latencies[field] = round(latency * 1000, 1)
+        if errors and not vectors:
+            raise errors[0]
+
+        return vectors, {
+            "vector_latency_ms": latencies,
+            "vector_sequential_ms": round(sum(latencies.values()), 1),
+            "vector_concurrent_ms": round(elapsed * 1000, 1),
+            "vector_fields_failed": failed_fields,
+        }
+
+    async def run_until_final_call(self, history, overrides, auth_claims, should_stream) -> tuple:
+        """
+        Retrieves the sources and builds the prompt for the last message of the history.
+        Returns the context shown in the thoughts panel and the call that generates the answer.
+        """
+        raise NotImplementedError
+
+    async def run_without_streaming(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
+    ) -> dict[str, Any]:
+        extra_info, chat_coroutine = await self.run_until_final_call(
+            history, overrides, auth_claims, should_stream=False
+        )
+        chat_completion_response: ChatCompletion = await chat_coroutine
+        chat_resp = chat_completion_response.model_dump()  # Convert to dict to make it JSON serializable
+        chat_resp["choices"][0]["context"] = await self.get_response_context(extra_info, overrides, auth_claims)
+        chat_resp["choices"][0]["session_state"] = session_state
+        return chat_resp
+
+    async def run_with_streaming(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict, None]:
+        extra_info, chat_coroutine = await self.run_until_final_call(
+            history, overrides, auth_claims, should_stream=True
+        )
+        yield self.get_context_event(await self.get_response_context(extra_info, overrides, auth_claims), session_state)
+        async for event_chunk in await chat_coroutine:
+            # "2023-07-01-preview" API version has a bug where first response has empty choices
+            if event_chunk.choices:
+                yield self.get_chunk_event(event_chunk, event_chunk.choices[0].delta.content)
+
+    async def get_response_context(
+        self, extra_info: dict[str, Any], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> dict[str, Any]:
+        """
+        Returns the context sent with the answer, following the thoughts_mode override or the deployment's mode.
+        The thoughts repeat the prompt and the search results, so leaving them out makes the responses much smaller.
+        Deferred thoughts are kept in the thoughts store, where only the same user can fetch them with thoughts_id.
+        """
+        mode = overrides.get("thoughts_mode") or self.thoughts_mode
+        if mode not in self.THOUGHTS_MODES:
+            logging.warning("Unknown thoughts mode %s, using %s", mode, self.thoughts_mode)
+            mode = self.thoughts_mode
+        if mode == self.THOUGHTS_FULL or "thoughts" not in extra_info:
+            return extra_info
+        context = {key: value for key, value in extra_info.items() if key != "thoughts"}
+        if mode == self.THOUGHTS_DEFERRED and self.thoughts_store is not None and self.thoughts_store.enabled:
+            thoughts_id = uuid.uuid4().hex
+            await self.thoughts_store.aset(
+                thoughts_id, {"oid": auth_claims.get("oid"), "thoughts": extra_info["thoughts"]}
+            )
+            context["thoughts_id"] = thoughts_id
+        return context
+
+    @staticmethod
+    def get_context_event(extra_info: dict[str, Any], session_state: Any) -> dict[str, Any]:
+        """Builds the first event of a streamed answer, which carries the context before the answer."""
+        return {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": extra_info,
+                    "session_state": session_state,
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    @staticmethod
+    def get_followup_event(followup_questions: list[str]) -> dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": {"followup_questions": followup_questions},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    @staticmethod
+    def get_chunk_event(chunk: ChatCompletionChunk, content: Optional[str]) -> dict[str, Any]:
+        """
+        Builds the event sent for a chunk of the answer, with only the fields the client uses,
+        instead of dumping the whole chunk with its logprobs, tool calls and content filter results.
+        """
+        choice = chunk.choices[0]
+        return {
+            "id": chunk.id,
+            "choices": [
+                {
+                    "delta": {"content": content, "role": choice.delta.role},
+                    "finish_reason": choice.finish_reason,
+                    "index": choice.index,
+                }
+            ],
+            "created": chunk.created,
+            "model": chunk.model,
+            "object": "chat.completion.chunk",
+        }
+
+    def get_answer_cache_scope(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> str:
+        """
+        Returns the partition of the answer cache for a request: the approach, the search filter, which holds
+        the security filters of the user, and the overrides that change the answer.
+        """
+        settings = {key: value for key, value in overrides.items() if key not in self.ANSWER_CACHE_IGNORED_OVERRIDES}
+        return "|".join(
+            [
+                type(self).__name__,
+                self.build_filter(overrides, auth_claims) or "",
+                json.dumps(settings, sort_keys=True, default=str),
+            ]
+        )
+
+    async def get_answer_cache_key(
+        self, messages: list[dict], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> Optional[tuple[str, List[float]]]:
+        """
+        Returns the scope and the question embedding to look up the answer cache with.
+        Only single-turn questions are cached, since the answer to a follow-up depends on the conversation before it.
+        """
+        if self.answer_cache is None or not self.answer_cache.enabled or overrides.get("use_answer_cache") is False:
+            return None
+        if len(messages) != 1 or not isinstance(messages[0].get("content"), str):
+            return None
+        try:
+            question_vector = await self.compute_text_embedding(messages[0]["content"])
+        except Exception as error:
+            logging.warning("Unable to compute the question embedding for the answer cache: %r", error)
+            return None
+        return self.get_answer_cache_scope(overrides, auth_claims), question_vector.vector
+
+    async def store_answer(
+        self,
+        answer_key: tuple[str, List[float]],
+        question: str,
+        content: Optional[str],
+        context: dict[str, Any],
+        finish_reason: Optional[str],
+    ):
+        # Answers cut short by the token limit or the content filter aren't worth replaying
+        if self.answer_cache is not None and content and finish_reason == "stop":
+            await self.answer_cache.aset(*answer_key, CachedAnswer(question=question, content=content, context=context))
+
+    async def get_cached_answer_context(
+        self,
+        cached: CachedAnswer,
+        similarity: float,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        include_followup_questions: bool = True,
+    ) -> dict[str, Any]:
+        # Streamed answers send the follow-up questions in their own event after the answer
+        context = {
+            key: value
+            for key, value in cached.context.items()
+            if include_followup_questions or key != "followup_questions"
+        }
+        if "thoughts" in context:
+            context["thoughts"] = context["thoughts"] + [
+                ThoughtStep(
+                    "Answer cache hit", cached.question, {"answer_cache_hit": True, "similarity": round(similarity, 4)}
+                )
+            ]
+        return await self.get_response_context(context, overrides, auth_claims)
+
+    async def replay_cached_answer(
+        self,
+        cached: CachedAnswer,
+        similarity: float,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """Streams a cached answer the way run_with_streaming streams a new one."""
+        yield self.get_context_event(
+            await self.get_cached_answer_context(
+                cached, similarity, overrides, auth_claims, include_followup_questions=False
+            ),
+            session_state,
+        )
+        yield {
+            "choices": [{"delta": {"content": cached.content, "role": None}, "finish_reason": None, "index": 0}],
+            "object": "chat.completion.chunk",
+        }
+        if followup_questions := cached.context.get("followup_questions"):
+            yield self.get_followup_event(followup_questions)
+        yield {
+            "choices": [{"delta": {"content": None, "role": None}, "finish_reason": "stop", "index": 0}],
+            "object": "chat.completion.chunk",
+        }
+
+    async def cache_streamed_answer(
+        self,
+        events: AsyncGenerator[dict[str, Any], None],
+        answer_key: tuple[str, List[float]],
+        question: str,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """Passes the events of a streamed answer through, and caches the answer once it's complete."""
+        context: Optional[dict[str, Any]] = None
+        followup_questions = None
+        parts: list[str] = []
+        finish_reason = None
+        async for event in events:
+            choice = event["choices"][0]
+            if context is None and "context" in choice:
+                # The first event carries the full context, which is sent in the thoughts mode of the request
+                context = choice["context"]
+                choice["context"] = await self.get_response_context(context, overrides, auth_claims)
+            elif "context" in choice:
+                followup_questions = choice["context"].get("followup_questions")
+            else:
+                parts.append(choice["delta"].get("content") or "")
+                finish_reason = choice.get("finish_reason") or finish_reason
+            yield event
+        if context is not None:
+            if followup_questions:
+                context = {**context, "followup_questions": followup_questions}
+            await self.store_answer(answer_key, question, "".join(parts), context, finish_reason)
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
-        raise NotImplementedError
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+
+        answer_key = await self.get_answer_cache_key(messages, overrides, auth_claims)
+        if answer_key is not None and self.answer_cache is not None:
+            question = messages[0]["content"]
+            cached = await self.answer_cache.aget(*answer_key)
+            answer_cache_lookups.add(1, {"approach": type(self).__name__, "result": "hit" if cached else "miss"})
+            if cached is not None:
+                cached_answer, similarity = cached
+                if stream:
+                    return self.replay_cached_answer(cached_answer, similarity, overrides, auth_claims, session_state)
+                return {
+                    "choices": [
+                        {
+                            "message": {"content": cached_answer.content, "role": "assistant"},
+                            "context": await self.get_cached_answer_context(
+                                cached_answer, similarity, overrides, auth_claims
+                            ),
+                            "session_state": session_state,
+                            "finish_reason": "stop",
+                            "index": 0,
+                        }
+                    ],
+                    "object": "chat.completion",
+                }
+            # Keep the full thoughts in the cache, so the answer can be replayed in any thoughts mode
+            full_overrides = {**overrides, "thoughts_mode": self.THOUGHTS_FULL}
+            if stream:
+                return self.cache_streamed_answer(
+                    self.run_with_streaming(messages, full_overrides, auth_claims, session_state),
+                    answer_key,
+                    question,
+                    overrides,
+                    auth_claims,
+                )
+            chat_resp = await self.run_without_streaming(messages, full_overrides, auth_claims, session_state)
+            choice = chat_resp["choices"][0]
+            await self.store_answer(
+                answer_key, question, choice["message"]["content"], choice["context"], choice["finish_reason"]
+            )
+            choice["context"] = await self.get_response_context(choice["context"], overrides, auth_claims)
+            return chat_resp
+
+        if stream is False:
+            return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+        else:
+            return self.run_with_streaming(messages, overrides, auth_claims, session_state)
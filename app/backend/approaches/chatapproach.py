@@ -1,18 +1,50 @@
 import json
 import logging
+import math
 import re
+import time
+import unicodedata
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Optional, Union
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional, Union
 
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
 )
+from opentelemetry import metrics
 
 from approaches.approach import Approach
+from core.cache import TTLCache
+from core.followupparser import FollowupQuestionParser
 from core.messagebuilder import MessageBuilder
 
+meter = metrics.get_meter(__name__)
+query_rewrite_decisions = meter.create_counter(
+    "app.query_rewrite.decisions",
+    description="Chat turns by whether the search query was rewritten by the model or skipped, and why",
+)
+query_rewrite_duration = meter.create_histogram(
+    "app.query_rewrite.duration",
+    unit="ms",
+    description="Time spent generating the search query with the model",
+)
+query_rewrite_saved_duration = meter.create_histogram(
+    "app.query_rewrite.saved_duration",
+    unit="ms",
+    description="Estimated time saved by skipping the search query generation, based on the recent generation times",
+)
+speculative_retrieval_results = meter.create_counter(
+    "app.speculative_retrieval.results",
+    description="Speculative retrievals by whether their results were used, because the generated search query "
+    "matched the user's question or was similar enough to it, or discarded",
+)
+speculative_retrieval_saved_duration = meter.create_histogram(
+    "app.speculative_retrieval.saved_duration",
+    unit="ms",
+    description="Time saved by using the results of a speculative retrieval that overlapped the query generation",
+)
+
 
 class ChatApproach(Approach, ABC):
     # Chat roles
@@ -21,13 +53,35 @@ class ChatApproach(Approach, ABC):
     ASSISTANT = "assistant"
 
     query_prompt_few_shots = [
-        {'role' : USER, 'content' : 'あべしってなにした人  ' },
-        {'role' : ASSISTANT, 'content' : 'あべし 人物 歴史' },
-        {'role' : USER, 'content' : 'あべしの功績を教えてください' },
-        {'role' : ASSISTANT, 'content' : 'あべし 人物 功績 業績' }
+        {"role": USER, "content": "あべしってなにした人  "},
+        {"role": ASSISTANT, "content": "あべし 人物 歴史"},
+        {"role": USER, "content": "あべしの功績を教えてください"},
+        {"role": ASSISTANT, "content": "あべし 人物 功績 業績"},
     ]
     NO_RESPONSE = "0"
 
+    # Query rewrite modes: always generate the search query with the model, never do it and search for the
+    # user's question as is, or skip it when the question can be searched as is
+    QUERY_REWRITE_ALWAYS = "always"
+    QUERY_REWRITE_NEVER = "never"
+    QUERY_REWRITE_HEURISTIC = "heuristic"
+    QUERY_REWRITE_MODES = [QUERY_REWRITE_ALWAYS, QUERY_REWRITE_NEVER, QUERY_REWRITE_HEURISTIC]
+    query_rewrite_mode = QUERY_REWRITE_ALWAYS
+    # Questions up to this many words and characters, without punctuation, are searched as is in heuristic mode
+    query_rewrite_max_keyword_words = 4
+    query_rewrite_max_keyword_chars = 40
+    # Moving average of the recent query generation times, used to estimate the time saved by skipping it
+    query_rewrite_average_ms: Optional[float] = None
+    # Whether to retrieve documents for the user's question while the search query is generated, see is_same_search_query
+    speculative_retrieval = False
+    # The minimum cosine similarity between the embeddings of the question and the generated query
+    # for the speculative results to be used
+    speculative_min_similarity = 0.95
+    # Shared between requests, so that the history resent on every turn is only tokenized once
+    token_count_cache: Optional[TTLCache[int]] = None
+    # The share of the prompt budget the sources always get, even when a long history would fill it
+    sources_min_token_share = 0.5
+
     follow_up_questions_prompt_content = """
     Answers must be accompanied by three additional follow-up questions to the user's question. The rules for follow-up questions are defined in the Restrictions.
 
@@ -78,6 +132,105 @@ class ChatApproach(Approach, ABC):
         else:
             return override_prompt.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
+    async def create_search_query_completion(self, **kwargs: Any) -> ChatCompletion:
+        """Generates the search query, sharing the completion between concurrent identical requests."""
+        key = ("search_query", json.dumps(kwargs, sort_keys=True, default=str))
+        return await self.run_single_flight(key, lambda: self.openai_client.chat.completions.create(**kwargs))
+
+    def should_rewrite_query(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> tuple[bool, str]:
+        """
+        Decides whether to generate the search query with the model, following the query_rewrite_mode override
+        or the deployment's mode. Returns the decision along with the reason for it.
+        """
+        mode = overrides.get("query_rewrite_mode") or self.query_rewrite_mode
+        if mode not in self.QUERY_REWRITE_MODES:
+            logging.warning("Unknown query rewrite mode %s, using %s", mode, self.query_rewrite_mode)
+            mode = self.query_rewrite_mode
+        if mode == self.QUERY_REWRITE_ALWAYS:
+            return True, mode
+        if mode == self.QUERY_REWRITE_NEVER:
+            return False, mode
+        # Without earlier messages, there is no context the model needs to add to the question
+        if len(history) <= 1:
+            return False, "first_turn"
+        if self.is_keyword_query(history[-1]["content"]):
+            return False, "keyword_query"
+        return True, "follow_up"
+
+    def is_keyword_query(self, query: str) -> bool:
+        query = query.strip()
+        return (
+            len(query) <= self.query_rewrite_max_keyword_chars
+            and len(query.split()) <= self.query_rewrite_max_keyword_words
+            and not re.search(r"[?.!？。！]", query)
+        )
+
+    async def rewrite_query(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        generate_search_query: Callable[[], Awaitable[str]],
+    ) -> tuple[str, dict[str, Any]]:
+        """
+        Generates the search query with generate_search_query, unless the rewrite policy skips it
+        and the user's question is searched as is. Returns the query along with the decision, for the thoughts panel.
+        """
+        rewrite, reason = self.should_rewrite_query(history, overrides)
+        if not rewrite:
+            query_rewrite_decisions.add(1, {"result": "skipped", "reason": reason})
+            if self.query_rewrite_average_ms is not None:
+                query_rewrite_saved_duration.record(self.query_rewrite_average_ms)
+            return history[-1]["content"], {"query_rewrite": "skipped", "query_rewrite_reason": reason}
+
+        start = time.perf_counter()
+        query_text = await generate_search_query()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        query_rewrite_decisions.add(1, {"result": "rewritten", "reason": reason})
+        query_rewrite_duration.record(elapsed_ms)
+        self.query_rewrite_average_ms = (
+            elapsed_ms
+            if self.query_rewrite_average_ms is None
+            else 0.9 * self.query_rewrite_average_ms + 0.1 * elapsed_ms
+        )
+        return query_text, {
+            "query_rewrite": "rewritten",
+            "query_rewrite_reason": reason,
+            "query_rewrite_ms": round(elapsed_ms, 1),
+        }
+
+    def should_speculate(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> bool:
+        """
+        Decides whether to retrieve documents for the user's question while the search query is generated,
+        following the speculative_retrieval override or the deployment's setting.
+        There's nothing to speculate on when the rewrite is skipped, since the question is searched as is.
+        """
+        speculate = overrides.get("speculative_retrieval")
+        if speculate is None:
+            speculate = self.speculative_retrieval
+        return bool(speculate) and self.should_rewrite_query(history, overrides)[0]
+
+    @staticmethod
+    def normalize_search_query(q: str) -> str:
+        """Normalizes a search query for comparison, ignoring case, punctuation and whitespace."""
+        q = unicodedata.normalize("NFKC", q).casefold()
+        q = "".join(" " if unicodedata.category(c).startswith("P") else c for c in q)
+        return " ".join(q.split())
+
+    def is_same_search_query(self, original_query: str, generated_query: str) -> bool:
+        return self.normalize_search_query(original_query) == self.normalize_search_query(generated_query)
+
+    @staticmethod
+    def cosine_similarity(a: list[float], b: list[float]) -> float:
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        if norm == 0:
+            return 0.0
+        return sum(x * y for x, y in zip(a, b)) / norm
+
+    def record_speculation(self, result: str, saved_ms: Optional[float] = None):
+        speculative_retrieval_results.add(1, {"result": result})
+        if saved_ms is not None:
+            speculative_retrieval_saved_duration.record(saved_ms)
+
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
         response_message = chat_completion.choices[0].message
 
@@ -108,27 +261,52 @@ class ChatApproach(Approach, ABC):
         max_tokens: int,
         few_shots=[],
     ) -> list[ChatCompletionMessageParam]:
-        message_builder = MessageBuilder(system_prompt, model_id)
+        message_builder = MessageBuilder(system_prompt, model_id, self.token_count_cache)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
-
-        append_index = len(few_shots) + 1
+        for shot in few_shots:
+            message_builder.append_message(shot.get("role"), shot.get("content"))
 
-        message_builder.insert_message(self.USER, user_content, index=append_index)
-        total_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[-1]))  # type: ignore
+        user_message = message_builder.create_message(self.USER, user_content)
+        total_token_count = message_builder.count_tokens_for_message(dict(user_message))
 
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
+        # Pick the messages that fit from newest to oldest, then add them in the conversation order
+        included_history = []
+        for message in reversed(history[:-1]):
             potential_message_count = message_builder.count_tokens_for_message(message)
             if (total_token_count + potential_message_count) > max_tokens:
                 logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
                 break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
+            included_history.append(message)
             total_token_count += potential_message_count
+        for message in reversed(included_history):
+            message_builder.append_message(message["role"], message["content"])
+        message_builder.messages.append(user_message)
         return message_builder.messages
 
+    def get_sources_token_budget(
+        self,
+        system_prompt: str,
+        model_id: str,
+        history: list[dict[str, str]],
+        user_content: str,
+        max_tokens: int,
+    ) -> int:
+        """
+        Returns the number of tokens left for the sources once the system prompt, the user question
+        and the history are counted, within max_tokens. The history only gets the budget that is left
+        after the sources_min_token_share of the sources, and is truncated to fit afterwards.
+        """
+        message_builder = MessageBuilder(system_prompt, model_id, self.token_count_cache)
+        remaining = max_tokens - message_builder.count_tokens_for_message(dict(message_builder.messages[0]))
+        remaining -= message_builder.count_tokens_for_message({"role": self.USER, "content": user_content})
+        history_tokens = 0
+        for message in reversed(history[:-1]):
+            history_tokens += message_builder.count_tokens_for_message(message)
+            if history_tokens >= remaining:
+                break
+        return max(0, int(max(remaining - history_tokens, remaining * self.sources_min_token_share)))
+
     async def run_without_streaming(
         self,
         history: list[dict[str, str]],
@@ -136,17 +314,11 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> dict[str, Any]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=False
-        )
-        chat_completion_response: ChatCompletion = await chat_coroutine
-        chat_resp = chat_completion_response.model_dump()  # Convert to dict to make it JSON serializable
-        chat_resp["choices"][0]["context"] = extra_info
+        chat_resp = await super().run_without_streaming(history, overrides, auth_claims, session_state)
         if overrides.get("suggest_followup_questions"):
             content, followup_questions = self.extract_followup_questions(chat_resp["choices"][0]["message"]["content"])
             chat_resp["choices"][0]["message"]["content"] = content
             chat_resp["choices"][0]["context"]["followup_questions"] = followup_questions
-        chat_resp["choices"][0]["session_state"] = session_state
         return chat_resp
 
     async def run_with_streaming(
@@ -159,60 +331,31 @@ class ChatApproach(Approach, ABC):
         extra_info, chat_coroutine = await self.run_until_final_call(
             history, overrides, auth_claims, should_stream=True
         )
-        yield {
-            "choices": [
-                {
-                    "delta": {"role": self.ASSISTANT},
-                    "context": extra_info,
-                    "session_state": session_state,
-                    "finish_reason": None,
-                    "index": 0,
-                }
-            ],
-            "object": "chat.completion.chunk",
-        }
+        yield self.get_context_event(await self.get_response_context(extra_info, overrides, auth_claims), session_state)
 
-        followup_questions_started = False
-        followup_content = ""
+        followup_parser = FollowupQuestionParser() if overrides.get("suggest_followup_questions") else None
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = event["choices"][0]["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        event["choices"][0]["delta"]["content"] = earlier_content
-                        yield event
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
-                    yield event
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(followup_content)
+            if not event_chunk.choices:
+                continue
+            # Read the delta from the chunk model, rather than converting the whole chunk to a dict
+            choice = event_chunk.choices[0]
+            delta_content = choice.delta.content  # content may either not exist in delta, or explicitly be None
+            if followup_parser is None:
+                yield self.get_chunk_event(event_chunk, delta_content)
+                continue
+
+            content, followup_questions = followup_parser.feed(delta_content or "")
+            if choice.finish_reason is not None:
+                content += followup_parser.flush()
+            if content or choice.finish_reason is not None or not (delta_content or followup_parser.started):
+                # Once the follow-up questions started, the raw delta is their markup, so only the answer is sent
+                yield self.get_chunk_event(event_chunk, content or (None if followup_parser.started else delta_content))
+            # Send each follow-up question as soon as it's complete, along with the earlier ones
+            if followup_questions:
+                yield self.get_followup_event(list(followup_parser.questions))
+        if followup_parser is not None and (content := followup_parser.flush()):
             yield {
-                "choices": [
-                    {
-                        "delta": {"role": self.ASSISTANT},
-                        "context": {"followup_questions": followup_questions},
-                        "finish_reason": None,
-                        "index": 0,
-                    }
-                ],
+                "choices": [{"delta": {"content": content}, "finish_reason": None, "index": 0}],
                 "object": "chat.completion.chunk",
             }
-
-    async def run(
-        self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
-    ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
-        overrides = context.get("overrides", {})
-        auth_claims = context.get("auth_claims", {})
-
-        if stream is False:
-            return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
-        else:
-            return self.run_with_streaming(messages, overrides, auth_claims, session_state)
@@ -1,7 +1,20 @@
-from typing import Any, Coroutine, List, Literal, Optional, Union, overload
+import asyncio
+import logging
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    List,
+    Literal,
+    Optional,
+    Union,
+    overload,
+)
 
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorQuery
+from azure.search.documents.models import RawVectorQuery, VectorQuery
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
     ChatCompletion,
@@ -9,10 +22,16 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import CachedAnswer, Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
 from core.modelhelper import get_token_limit
+from core.singleflight import SingleFlight
+
+# The vectors, results and search props of a retrieval
+Retrieval = tuple[list[VectorQuery], List[Document], dict[str, Any]]
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -36,6 +55,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[TTLCache[List[float]]] = None,
+        search_cache: Optional[TTLCache[List[Document]]] = None,
+        single_flight: Optional[SingleFlight] = None,
+        token_count_cache: Optional[TTLCache[int]] = None,
+        query_rewrite_mode: str = ChatApproach.QUERY_REWRITE_ALWAYS,
+        speculative_retrieval: bool = False,
+        thoughts_mode: str = ChatApproach.THOUGHTS_FULL,
+        thoughts_store: Optional[TTLCache[dict[str, Any]]] = None,
+        answer_cache: Optional[SemanticAnswerCache[CachedAnswer]] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -48,6 +76,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.single_flight = single_flight
+        self.token_count_cache = token_count_cache
+        self.query_rewrite_mode = query_rewrite_mode
+        self.speculative_retrieval = speculative_retrieval
+        self.thoughts_mode = thoughts_mode
+        self.thoughts_store = thoughts_store
+        self.answer_cache = answer_cache
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
 
     @property
@@ -93,6 +130,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
+        use_embedding_cache = overrides.get("use_embedding_cache", True)
         filter = self.build_filter(overrides, auth_claims)
         use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
 
@@ -120,43 +158,79 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         ]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
+        async def generate_search_query() -> str:
+            messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.chatgpt_model,
+                history=history,
+                user_content=user_query_request,
+                max_tokens=self.chatgpt_token_limit - len(user_query_request),
+                few_shots=self.query_prompt_few_shots,
+            )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,  # type: ignore
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            tools=tools,
-            tool_choice="auto",
-        )
+            chat_completion: ChatCompletion = await self.create_search_query_completion(
+                messages=messages,  # type: ignore
+                # Azure Open AI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                temperature=0.0,  # Minimize creativity for search query generation
+                max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
+                n=1,
+                tools=tools,
+                tool_choice="auto",
+            )
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+            return self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        async def retrieve(query: str, vectors: Optional[list[VectorQuery]] = None) -> Retrieval:
+            # If retrieval mode includes vectors, compute an embedding for the query
+            if vectors is None:
+                vectors = []
+                if has_vector:
+                    vectors.append(await self.compute_text_embedding(query, use_embedding_cache))
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(query_text))
+            # Only keep the text query if the retrieval mode uses text, otherwise drop it
+            results, search_props = await self.search_with_cache(
+                top,
+                query if has_text else None,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                include_vectors=overrides.get("include_vectors", False),
+                use_cache=overrides.get("use_search_cache", True),
+            )
+            return vectors, results, search_props
 
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        if not has_text:
-            query_text = None
+        # Optionally start retrieving documents for the user's question while the search query is generated
+        speculation: Optional[asyncio.Task[tuple[Retrieval, float]]] = None
+        if self.should_speculate(history, overrides):
+            speculation = asyncio.create_task(self.run_timed(retrieve(original_user_query)))
+            # Discarded speculations may still fail, their errors don't matter
+            speculation.add_done_callback(lambda task: task.cancelled() or task.exception())
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        query_text: Optional[str]
+        try:
+            query_text, rewrite_props = await self.rewrite_query(history, overrides, generate_search_query)
+        except BaseException:
+            if speculation is not None:
+                speculation.cancel()
+            raise
 
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
-        content = "\n".join(sources_content)
+        speculation_props: dict[str, Any] = {}
+        if speculation is None:
+            _, results, search_props = await retrieve(query_text)
+        else:
+            (_, results, search_props), speculation_props = await self.resolve_speculation(
+                speculation,
+                original_user_query,
+                query_text,
+                retrieve,
+                (lambda q: self.compute_text_embedding(q, use_embedding_cache)) if has_vector else None,
+            )
+        if not has_text:
+            query_text = None
+        self.preauthorize_citations(results, use_image_citation=False, auth_claims=auth_claims)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
@@ -168,6 +242,21 @@ class ChatReadRetrieveReadApproach(ChatApproach):
 
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
+
+        # Only keep the sources that fit in what's left of the prompt, so they don't push out the history after the fact
+        sources_token_budget = self.get_sources_token_budget(
+            system_prompt=system_message,
+            model_id=self.chatgpt_model,
+            history=history,
+            user_content=original_user_query + "\n\nSources:\n",
+            max_tokens=messages_token_limit,
+        )
+        sources_content, packing_props = self.pack_sources(
+            self.get_sources_content(results, use_semantic_captions, use_image_citation=False),
+            sources_token_budget,
+            self.chatgpt_model,
+        )
+        content = "\n".join(sources_content)
         messages = self.get_messages_from_history(
             system_prompt=system_message,
             model_id=self.chatgpt_model,
@@ -189,9 +278,18 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ThoughtStep(
                     "Generated search query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "has_vector": has_vector},
+                    {
+                        "use_semantic_captions": use_semantic_captions,
+                        "has_vector": has_vector,
+                        **rewrite_props,
+                        **speculation_props,
+                    },
+                ),
+                ThoughtStep(
+                    "Results",
+                    [result.serialize_for_results() for result in results],
+                    {**search_props, **packing_props},
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in messages]),
             ],
         }
@@ -206,3 +304,63 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             stream=should_stream,
         )
         return (extra_info, chat_coroutine)
+
+    @staticmethod
+    async def run_timed(retrieval: Awaitable[Retrieval]) -> tuple[Retrieval, float]:
+        start = time.perf_counter()
+        result = await retrieval
+        return result, (time.perf_counter() - start) * 1000
+
+    async def resolve_speculation(
+        self,
+        speculation: "asyncio.Task[tuple[Retrieval, float]]",
+        original_query: str,
+        generated_query: str,
+        retrieve: Callable[[str, Optional[list[VectorQuery]]], Awaitable[Retrieval]],
+        compute_embedding: Optional[Callable[[str], Awaitable[RawVectorQuery]]],
+    ) -> tuple[Retrieval, dict[str, Any]]:
+        """
+        Uses the results of the speculative retrieval for the user's question if the generated query is the same
+        once normalized, or if their embeddings are similar enough. Otherwise discards them and retrieves the documents
+        for the generated query. Returns the retrieval along with the outcome, for the thoughts panel, which shows
+        the question the results were retrieved for when they come from the speculative retrieval.
+        """
+        start = time.perf_counter()
+        props: dict[str, Any] = {}
+        generated_vector: Optional[RawVectorQuery] = None
+        if self.is_same_search_query(original_query, generated_query):
+            outcome = "hit_exact"
+        elif compute_embedding is not None:
+            # The embedding of the question is shared with the speculative retrieval, which computes it too
+            original_vector, query_vector = await asyncio.gather(
+                compute_embedding(original_query), compute_embedding(generated_query)
+            )
+            generated_vector = query_vector
+            similarity = self.cosine_similarity(original_vector.vector or [], query_vector.vector or [])
+            props["speculative_similarity"] = round(similarity, 4)
+            outcome = "hit_similar" if similarity >= self.speculative_min_similarity else "miss"
+        else:
+            outcome = "miss"
+
+        if outcome != "miss":
+            try:
+                retrieval, speculative_ms = await speculation
+            except Exception as error:
+                logging.warning("Speculative retrieval failed, retrieving the documents again: %r", error)
+                outcome = "error"
+            else:
+                # The part of the speculative retrieval that ran while the search query was generated
+                saved_ms = max(0.0, speculative_ms - (time.perf_counter() - start) * 1000)
+                self.record_speculation(outcome, saved_ms)
+                return retrieval, {
+                    **props,
+                    "speculative_retrieval": outcome,
+                    "speculative_query": original_query,
+                    "speculative_saved_ms": round(saved_ms, 1),
+                }
+        else:
+            speculation.cancel()
+
+        self.record_speculation(outcome)
+        retrieval = await retrieve(generated_query, [generated_vector] if generated_vector is not None else None)
+        return retrieval, {**props, "speculative_retrieval": outcome}
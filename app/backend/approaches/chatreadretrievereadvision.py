@@ -1,6 +1,9 @@
-from typing import Any, Coroutine, Optional, Union
+import time
+from typing import Any, Coroutine, List, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
@@ -10,11 +13,14 @@ from openai.types.chat import (
     ChatCompletionContentPartParam,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import CachedAnswer, Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.cache import TTLCache
+from core.imageshelper import fetch_images
 from core.modelhelper import get_token_limit
+from core.singleflight import SingleFlight
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -41,6 +47,17 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        embedding_cache: Optional[TTLCache[List[float]]] = None,
+        vector_timeout: Optional[float] = None,
+        image_fetch_concurrency: int = 5,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        search_cache: Optional[TTLCache[List[Document]]] = None,
+        single_flight: Optional[SingleFlight] = None,
+        token_count_cache: Optional[TTLCache[int]] = None,
+        query_rewrite_mode: str = ChatApproach.QUERY_REWRITE_ALWAYS,
+        thoughts_mode: str = ChatApproach.THOUGHTS_FULL,
+        thoughts_store: Optional[TTLCache[dict[str, Any]]] = None,
+        answer_cache: Optional[SemanticAnswerCache[CachedAnswer]] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -56,6 +73,17 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
+        self.embedding_cache = embedding_cache
+        self.vector_timeout = vector_timeout
+        self.image_fetch_concurrency = image_fetch_concurrency
+        self.http_session = http_session
+        self.search_cache = search_cache
+        self.single_flight = single_flight
+        self.token_count_cache = token_count_cache
+        self.query_rewrite_mode = query_rewrite_mode
+        self.thoughts_mode = thoughts_mode
+        self.thoughts_store = thoughts_store
+        self.answer_cache = answer_cache
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
 
     @property
@@ -84,6 +112,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         vector_fields = overrides.get("vector_fields", ["embedding"])
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
+        use_embedding_cache = overrides.get("use_embedding_cache", True)
         filter = self.build_filter(overrides, auth_claims)
         use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
 
@@ -93,45 +122,61 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         original_user_query = history[-1]["content"]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        user_query_request = "Generate search query for: " + original_user_query
+        async def generate_search_query() -> str:
+            user_query_request = "Generate search query for: " + original_user_query
 
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.gpt4v_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(" ".join(user_query_request)),
-            few_shots=self.query_prompt_few_shots,
-        )
+            messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.gpt4v_model,
+                history=history,
+                user_content=user_query_request,
+                max_tokens=self.chatgpt_token_limit - len(" ".join(user_query_request)),
+                few_shots=self.query_prompt_few_shots,
+            )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-            messages=messages,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=100,
-            n=1,
-        )
+            chat_completion: ChatCompletion = await self.create_search_query_completion(
+                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+                messages=messages,
+                temperature=0.0,  # Minimize creativity for search query generation
+                max_tokens=100,
+                n=1,
+            )
+
+            return self.get_search_query(chat_completion, original_user_query)
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+        query_text: Optional[str]
+        query_text, rewrite_props = await self.rewrite_query(history, overrides, generate_search_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
+        vectors: list[VectorQuery] = []
+        vector_props: dict[str, Any] = {}
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text, self.vision_endpoint, self.vision_key)
-                )
-                vectors.append(vector)
+            vectors, vector_props = await self.compute_vectors(
+                query_text,
+                vector_fields,
+                self.vision_endpoint,
+                self.vision_key,
+                use_cache=use_embedding_cache,
+                timeout=self.vector_timeout,
+            )
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        results, search_props = await self.search_with_cache(
+            top,
+            query_text,
+            filter,
+            vectors,
+            use_semantic_ranker,
+            use_semantic_captions,
+            include_vectors=overrides.get("include_vectors", False),
+            use_cache=overrides.get("use_search_cache", True),
+        )
+        self.preauthorize_citations(results, use_image_citation=True, auth_claims=auth_claims)
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
 
@@ -151,11 +196,15 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         if include_gtpV_text:
             user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
+        image_props: dict[str, Any] = {}
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            start = time.perf_counter()
+            images = await fetch_images(self.blob_container_client, results, self.image_fetch_concurrency)
+            image_list = [{"image_url": url, "type": "image_url"} for url in images]
+            image_props = {
+                "image_count": len(image_list),
+                "image_fetch_ms": round((time.perf_counter() - start) * 1000, 1),
+            }
             user_content.extend(image_list)
 
         messages = self.get_messages_from_history(
@@ -181,9 +230,18 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 ThoughtStep(
                     "Generated search query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields},
+                    {
+                        "use_semantic_captions": use_semantic_captions,
+                        "vector_fields": vector_fields,
+                        **vector_props,
+                        **rewrite_props,
+                    },
+                ),
+                ThoughtStep(
+                    "Results",
+                    [result.serialize_for_results() for result in results],
+                    {**search_props, **image_props},
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in messages]),
             ],
         }
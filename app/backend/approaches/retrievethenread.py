@@ -1,13 +1,17 @@
 import os
-from typing import Any, AsyncGenerator, Optional, Union
+from typing import Any, Coroutine, List, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, AsyncStream
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, CachedAnswer, Document, ThoughtStep
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
 from core.messagebuilder import MessageBuilder
+from core.singleflight import SingleFlight
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -55,6 +59,12 @@ class RetrieveThenReadApproach(Approach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[TTLCache[List[float]]] = None,
+        search_cache: Optional[TTLCache[List[Document]]] = None,
+        single_flight: Optional[SingleFlight] = None,
+        thoughts_mode: str = Approach.THOUGHTS_FULL,
+        thoughts_store: Optional[TTLCache[dict[str, Any]]] = None,
+        answer_cache: Optional[SemanticAnswerCache[CachedAnswer]] = None,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -68,35 +78,66 @@ class RetrieveThenReadApproach(Approach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.single_flight = single_flight
+        self.thoughts_mode = thoughts_mode
+        self.thoughts_store = thoughts_store
+        self.answer_cache = answer_cache
+
+    @overload
+    async def run_until_final_call(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: Literal[False],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
+
+    @overload
+    async def run_until_final_call(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: Literal[True],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
 
-    async def run(
+    async def run_until_final_call(
         self,
-        messages: list[dict],
-        stream: bool = False,  # Stream is not used in this approach
-        session_state: Any = None,
-        context: dict[str, Any] = {},
-    ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
-        q = messages[-1]["content"]
-        overrides = context.get("overrides", {})
-        auth_claims = context.get("auth_claims", {})
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: bool = False,
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+        q = history[-1]["content"]
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_ranker = overrides.get("semantic_ranker") and has_text
+        use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
 
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
+        use_embedding_cache = overrides.get("use_embedding_cache", True)
         filter = self.build_filter(overrides, auth_claims)
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if has_vector:
-            vectors.append(await self.compute_text_embedding(q))
+            vectors.append(await self.compute_text_embedding(q, use_embedding_cache))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
-
-        user_content = [q]
+        results, search_props = await self.search_with_cache(
+            top,
+            query_text,
+            filter,
+            vectors,
+            use_semantic_ranker,
+            use_semantic_captions,
+            include_vectors=overrides.get("include_vectors", False),
+            use_cache=overrides.get("use_search_cache", True),
+        )
+        self.preauthorize_citations(results, use_image_citation=False, auth_claims=auth_claims)
 
         template = overrides.get("prompt_template", self.system_chat_template)
         model = self.chatgpt_model
@@ -112,17 +153,6 @@ class RetrieveThenReadApproach(Approach):
         message_builder.insert_message("assistant", self.answer)
         message_builder.insert_message("user", self.question)
 
-        chat_completion = (
-            await self.openai_client.chat.completions.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-                messages=message_builder.messages,
-                temperature=overrides.get("temperature", 0.3),
-                max_tokens=1024,
-                n=1,
-            )
-        ).model_dump()
-
         data_points = {"text": sources_content}
         extra_info = {
             "data_points": data_points,
@@ -134,11 +164,18 @@ class RetrieveThenReadApproach(Approach):
                         "use_semantic_captions": use_semantic_captions,
                     },
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
+                ThoughtStep("Results", [result.serialize_for_results() for result in results], search_props),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
             ],
         }
 
-        chat_completion["choices"][0]["context"] = extra_info
-        chat_completion["choices"][0]["session_state"] = session_state
-        return chat_completion
+        chat_coroutine = self.openai_client.chat.completions.create(
+            # Azure Open AI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            messages=message_builder.messages,
+            temperature=overrides.get("temperature", 0.3),
+            max_tokens=1024,
+            n=1,
+            stream=should_stream,
+        )
+        return (extra_info, chat_coroutine)
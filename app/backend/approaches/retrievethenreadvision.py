@@ -1,18 +1,26 @@
 import os
-from typing import Any, AsyncGenerator, Optional, Union
+import time
+from typing import Any, Coroutine, List, Literal, Optional, Union, overload
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
     ChatCompletionContentPartImageParam,
     ChatCompletionContentPartParam,
 )
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, CachedAnswer, Document, ThoughtStep
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.cache import TTLCache
+from core.imageshelper import fetch_images
 from core.messagebuilder import MessageBuilder
+from core.singleflight import SingleFlight
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -53,6 +61,15 @@ class RetrieveThenReadVisionApproach(Approach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        embedding_cache: Optional[TTLCache[List[float]]] = None,
+        vector_timeout: Optional[float] = None,
+        image_fetch_concurrency: int = 5,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        search_cache: Optional[TTLCache[List[Document]]] = None,
+        single_flight: Optional[SingleFlight] = None,
+        thoughts_mode: str = Approach.THOUGHTS_FULL,
+        thoughts_store: Optional[TTLCache[dict[str, Any]]] = None,
+        answer_cache: Optional[SemanticAnswerCache[CachedAnswer]] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -68,17 +85,42 @@ class RetrieveThenReadVisionApproach(Approach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
+        self.embedding_cache = embedding_cache
+        self.vector_timeout = vector_timeout
+        self.image_fetch_concurrency = image_fetch_concurrency
+        self.http_session = http_session
+        self.search_cache = search_cache
+        self.single_flight = single_flight
+        self.thoughts_mode = thoughts_mode
+        self.thoughts_store = thoughts_store
+        self.answer_cache = answer_cache
+
+    @overload
+    async def run_until_final_call(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: Literal[False],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
+
+    @overload
+    async def run_until_final_call(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: Literal[True],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
 
-    async def run(
+    async def run_until_final_call(
         self,
-        messages: list[dict],
-        stream: bool = False,  # Stream is not used in this approach
-        session_state: Any = None,
-        context: dict[str, Any] = {},
-    ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
-        q = messages[-1]["content"]
-        overrides = context.get("overrides", {})
-        auth_claims = context.get("auth_claims", {})
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: bool = False,
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+        q = history[-1]["content"]
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         vector_fields = overrides.get("vector_fields", ["embedding"])
@@ -88,25 +130,38 @@ class RetrieveThenReadVisionApproach(Approach):
 
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
+        use_embedding_cache = overrides.get("use_embedding_cache", True)
         filter = self.build_filter(overrides, auth_claims)
-        use_semantic_ranker = overrides.get("semantic_ranker") and has_text
+        use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
 
         # If retrieval mode includes vectors, compute an embedding for the query
 
-        vectors = []
+        vectors: list[VectorQuery] = []
+        vector_props: dict[str, Any] = {}
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q, self.vision_endpoint, self.vision_key)
-                )
-                vectors.append(vector)
+            vectors, vector_props = await self.compute_vectors(
+                q,
+                vector_fields,
+                self.vision_endpoint,
+                self.vision_key,
+                use_cache=use_embedding_cache,
+                timeout=self.vector_timeout,
+            )
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        results, search_props = await self.search_with_cache(
+            top,
+            query_text,
+            filter,
+            vectors,
+            use_semantic_ranker,
+            use_semantic_captions,
+            include_vectors=overrides.get("include_vectors", False),
+            use_cache=overrides.get("use_search_cache", True),
+        )
+        self.preauthorize_citations(results, use_image_citation=True, auth_claims=auth_claims)
 
         image_list: list[ChatCompletionContentPartImageParam] = []
         user_content: list[ChatCompletionContentPartParam] = [{"text": q, "type": "text"}]
@@ -122,26 +177,20 @@ class RetrieveThenReadVisionApproach(Approach):
         if include_gtpV_text:
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
+        image_props: dict[str, Any] = {}
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            start = time.perf_counter()
+            images = await fetch_images(self.blob_container_client, results, self.image_fetch_concurrency)
+            image_list = [{"image_url": url, "type": "image_url"} for url in images]
+            image_props = {
+                "image_count": len(image_list),
+                "image_fetch_ms": round((time.perf_counter() - start) * 1000, 1),
+            }
             user_content.extend(image_list)
 
         # Append user message
         message_builder.insert_message("user", user_content)
 
-        chat_completion = (
-            await self.openai_client.chat.completions.create(
-                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-                messages=message_builder.messages,
-                temperature=overrides.get("temperature", 0.3),
-                max_tokens=1024,
-                n=1,
-            )
-        ).model_dump()
-
         data_points = {
             "text": sources_content,
             "images": [d["image_url"] for d in image_list],
@@ -153,12 +202,23 @@ class RetrieveThenReadVisionApproach(Approach):
                 ThoughtStep(
                     "Search Query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields},
+                    {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields, **vector_props},
+                ),
+                ThoughtStep(
+                    "Results",
+                    [result.serialize_for_results() for result in results],
+                    {**search_props, **image_props},
                 ),
-                ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
             ],
         }
-        chat_completion["choices"][0]["context"] = extra_info
-        chat_completion["choices"][0]["session_state"] = session_state
-        return chat_completion
+
+        chat_coroutine = self.openai_client.chat.completions.create(
+            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+            messages=message_builder.messages,
+            temperature=overrides.get("temperature", 0.3),
+            max_tokens=1024,
+            n=1,
+            stream=should_stream,
+        )
+        return (extra_info, chat_coroutine)
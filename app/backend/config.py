@@ -11,3 +11,11 @@ CONFIG_SEMANTIC_RANKER_DEPLOYED = "semantic_ranker_deployed"
 CONFIG_VECTOR_SEARCH_ENABLED = "vector_search_enabled"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_HTTP_SESSION = "http_session"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_INDEX_VERSION_WATCHER = "index_version_watcher"
+CONFIG_DELTA_COALESCER = "delta_coalescer"
+CONFIG_THOUGHTS_STORE = "thoughts_store"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_CACHE_BACKENDS = "cache_backends"
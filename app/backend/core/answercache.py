@@ -0,0 +1,269 @@
+import base64
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Generic, Hashable, Optional, Sequence, TypeVar
+
+import numpy as np
+
+from core.cachebackends import CacheBackend
+
+V = TypeVar("V")
+
+
+class _Partition(Generic[V]):
+    """The entries of one scope, with their normalized embeddings stacked in a matrix for vectorized lookups."""
+
+    def __init__(self, dimensions: int, capacity: int = 16):
+        self.vectors = np.empty((capacity, dimensions), dtype=np.float32)
+        self.expires = np.empty(capacity, dtype=np.float64)
+        self.ids: list[int] = []
+        self.values: list[V] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, entry_id: int, vector: np.ndarray, expires_at: float, value: V):
+        size = len(self.ids)
+        if size == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+            self.expires = np.concatenate([self.expires, np.empty_like(self.expires)])
+        self.vectors[size] = vector
+        self.expires[size] = expires_at
+        self.ids.append(entry_id)
+        self.values.append(value)
+
+    def remove(self, entry_id: int):
+        # Move the last entry into the removed one's row, so the rows stay contiguous
+        index = self.ids.index(entry_id)
+        last = len(self.ids) - 1
+        if index != last:
+            self.vectors[index] = self.vectors[last]
+            self.expires[index] = self.expires[last]
+            self.ids[index] = self.ids[last]
+            self.values[index] = self.values[last]
+        self.ids.pop()
+        self.values.pop()
+
+    def expired(self, now: float) -> list[int]:
+        size = len(self.ids)
+        return [self.ids[index] for index in np.flatnonzero(self.expires[:size] <= now)]
+
+    def nearest(self, vector: np.ndarray) -> tuple[int, float]:
+        similarities = self.vectors[: len(self.ids)] @ vector
+        index = int(np.argmax(similarities))
+        return index, float(similarities[index])
+
+
+class SemanticAnswerCache(Generic[V]):
+    """
+    A bounded cache of answers, looked up by the embedding of the question rather than its text,
+    so that rephrasings of a question already answered share its answer.
+    Entries are partitioned by a scope, like the security filter of the search, and a lookup only returns an entry
+    of the same scope whose embedding has a cosine similarity of at least min_similarity with the question's.
+    With a shared backend, each scope has an index collection holding the embeddings, one member per entry,
+    and each answer is an entry of its own, so a lookup only reads the embeddings and the answer it returns,
+    and storing an answer doesn't rewrite the other entries of the scope. The stats only count the lookups then.
+    Attributes:
+        maxsize (int): The maximum number of entries kept across all scopes, or per scope with a shared backend,
+            a maxsize of 0 disables the cache.
+        ttl (float): The number of seconds an entry stays valid.
+        min_similarity (float): The cosine similarity from which a question counts as the same as a cached one.
+        hits (int): The number of lookups that found a similar enough entry.
+        misses (int): The number of lookups that found none.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        min_similarity: float = 0.97,
+        backend: Optional[CacheBackend] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._partitions: dict[Hashable, _Partition[V]] = {}
+        # The scope of every entry, oldest first, to evict across scopes
+        self._entries: OrderedDict[int, Hashable] = OrderedDict()
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    @staticmethod
+    def normalize(vector: Sequence[float]) -> Optional[np.ndarray]:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm > 0 else None
+
+    def get(self, scope: Hashable, vector: Sequence[float]) -> Optional[tuple[V, float]]:
+        """
+        Returns the value of the entry of the scope most similar to the vector, with its similarity,
+        or None if there's no entry similar enough. Only for the cache without a shared backend, see aget.
+        """
+        self.check_local()
+        normalized = self.normalize(vector)
+        return self.count_lookup(
+            self._get_local(scope, normalized) if self.enabled and normalized is not None else None
+        )
+
+    def set(self, scope: Hashable, vector: Sequence[float], value: V):
+        """Stores a value for the scope and vector, evicting the oldest entries once maxsize is reached."""
+        self.check_local()
+        normalized = self.normalize(vector)
+        if self.enabled and normalized is not None:
+            self._set_local(scope, normalized, value)
+
+    def clear(self):
+        self.check_local()
+        self._partitions.clear()
+        self._entries.clear()
+
+    # Like in TTLCache, the async methods don't block the event loop on a shared backend.
+    # Without one, the entries are only touched on the event loop.
+
+    async def aget(self, scope: Hashable, vector: Sequence[float]) -> Optional[tuple[V, float]]:
+        if self.backend is None:
+            return self.get(scope, vector)
+        normalized = self.normalize(vector)
+        return self.count_lookup(
+            await self._aget_shared(self.backend, scope, normalized)
+            if self.enabled and normalized is not None
+            else None
+        )
+
+    async def aset(self, scope: Hashable, vector: Sequence[float], value: V):
+        if self.backend is None:
+            self.set(scope, vector, value)
+            return
+        normalized = self.normalize(vector)
+        if self.enabled and normalized is not None:
+            await self._aset_shared(self.backend, scope, normalized, value)
+
+    async def aclear(self):
+        if self.backend is None:
+            self.clear()
+        else:
+            await self.backend.aclear()
+
+    def check_local(self):
+        if self.backend is not None:
+            raise TypeError("A SemanticAnswerCache with a shared backend can only be used with the async methods")
+
+    def count_lookup(self, result: Optional[tuple[V, float]]) -> Optional[tuple[V, float]]:
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "scopes": len(self._partitions),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    def _get_local(self, scope: Hashable, normalized: np.ndarray) -> Optional[tuple[V, float]]:
+        partition = self._partitions.get(scope)
+        if partition is not None:
+            self._remove_expired(scope, partition)
+        # The embeddings of another model or dimension can't be compared with the question's
+        if partition is None or len(partition) == 0 or partition.vectors.shape[1] != len(normalized):
+            return None
+        index, similarity = partition.nearest(normalized)
+        if similarity < self.min_similarity:
+            return None
+        return partition.values[index], similarity
+
+    def _set_local(self, scope: Hashable, normalized: np.ndarray, value: V):
+        partition = self._partitions.get(scope)
+        if partition is not None and partition.vectors.shape[1] != len(normalized):
+            # The entries of the previous dimension can't be matched anymore
+            for entry_id in list(partition.ids):
+                del self._entries[entry_id]
+                self._remove(entry_id, scope)
+            partition = None
+        if partition is None:
+            partition = self._partitions[scope] = _Partition(len(normalized))
+        entry_id = self._next_id
+        self._next_id += 1
+        partition.add(entry_id, normalized, time.monotonic() + self.ttl, value)
+        self._entries[entry_id] = scope
+        while len(self._entries) > self.maxsize:
+            oldest_id, oldest_scope = self._entries.popitem(last=False)
+            self._remove(oldest_id, oldest_scope)
+
+    async def _aget_shared(
+        self, backend: CacheBackend, scope: Hashable, normalized: np.ndarray
+    ) -> Optional[tuple[V, float]]:
+        index = await backend.aget_members(("index", scope))
+        # Skip the embeddings of another model or dimension, which _aset_shared evicts
+        vectors_by_id = {entry_id: self.decode_vector(member["vector"]) for entry_id, member in index.items()}
+        entry_ids = [entry_id for entry_id, vector in vectors_by_id.items() if len(vector) == len(normalized)]
+        if not entry_ids:
+            return None
+        vectors = np.stack([vectors_by_id[entry_id] for entry_id in entry_ids])
+        similarities = vectors @ normalized
+        nearest = int(np.argmax(similarities))
+        similarity = float(similarities[nearest])
+        if similarity < self.min_similarity:
+            return None
+        # The answer may have been evicted since the index was read
+        value = await backend.aget(("answer", scope, entry_ids[nearest]))
+        return (value, similarity) if value is not None else None
+
+    async def _aset_shared(self, backend: CacheBackend, scope: Hashable, normalized: np.ndarray, value: V):
+        # Random IDs, since the workers don't share a counter
+        entry_id = uuid.uuid4().hex
+        await backend.aset(("answer", scope, entry_id), value, self.ttl)
+        await backend.aset_member(
+            ("index", scope),
+            entry_id,
+            {"vector": self.encode_vector(normalized), "expires_at": time.time() + self.ttl},
+            self.ttl,
+        )
+        index = await backend.aget_members(("index", scope))
+        evicted = [
+            other_id
+            for other_id, member in index.items()
+            if len(self.decode_vector(member["vector"])) != len(normalized)
+        ]
+        kept = [other_id for other_id in index if other_id not in evicted]
+        if len(kept) > self.maxsize:
+            evicted += sorted(kept, key=lambda other_id: index[other_id]["expires_at"])[: len(kept) - self.maxsize]
+        if evicted:
+            await backend.adelete_members(("index", scope), evicted)
+            for evicted_id in evicted:
+                await backend.adelete(("answer", scope, evicted_id))
+
+    @staticmethod
+    def encode_vector(vector: np.ndarray) -> str:
+        return base64.b64encode(vector.astype(np.float32).tobytes()).decode("ascii")
+
+    @staticmethod
+    def decode_vector(data: str) -> np.ndarray:
+        return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+    def _remove_expired(self, scope: Hashable, partition: _Partition[V]):
+        for entry_id in partition.expired(time.monotonic()):
+            del self._entries[entry_id]
+            self._remove(entry_id, scope)
+
+    def _remove(self, entry_id: int, scope: Hashable):
+        partition = self._partitions[scope]
+        partition.remove(entry_id)
+        if len(partition) == 0:
+            del self._partitions[scope]
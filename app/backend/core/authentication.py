@@ -1,7 +1,12 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import functools
+import hashlib
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
 import aiohttp
@@ -10,6 +15,7 @@ from azure.search.documents.indexes.models import SearchIndex
 from jose import jwt
 from msal import ConfidentialClientApplication
 from msal.token_cache import TokenCache
+from opentelemetry import metrics
 from tenacity import (
     AsyncRetrying,
     retry_if_exception_type,
@@ -17,6 +23,22 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from core.cache import TTLCache
+from core.cachebackends import CacheBackendFactory
+from core.httpsession import use_http_session
+from core.singleflight import SingleFlight
+
+meter = metrics.get_meter(__name__)
+groups_cache_lookups = meter.create_counter(
+    "app.auth.groups_cache.lookups",
+    description="Lookups of a user's groups in the groups cache, by result (hit, stale or miss)",
+)
+groups_fetch_duration = meter.create_histogram(
+    "app.auth.groups_fetch.duration",
+    unit="ms",
+    description="Time spent reading a user's groups from Microsoft Graph",
+)
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -30,6 +52,7 @@ class AuthError(Exception):
 
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
+    jwks_min_refresh_interval: float = 60
 
     def __init__(
         self,
@@ -40,8 +63,52 @@ class AuthenticationHelper:
         client_app_id: Optional[str],
         tenant_id: Optional[str],
         require_access_control: bool = False,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        jwks_cache_ttl: float = 86400,
+        token_cache_size: int = 1024,
+        token_cache_ttl: float = 300,
+        obo_max_workers: int = 4,
+        groups_cache_ttl: float = 300,
+        groups_stale_ttl: float = 600,
+        path_auth_cache_size: int = 4096,
+        path_auth_cache_ttl: float = 60,
+        cache_backends: Optional[CacheBackendFactory] = None,
     ):
         self.use_authentication = use_authentication
+        self.http_session = http_session
+        # The signing keys rarely change, so they are kept until the TTL expires or a token is signed with an unknown key
+        self.jwks: Optional[dict[str, Any]] = None
+        self.jwks_fetched_at = 0.0
+        self.jwks_cache_ttl = jwks_cache_ttl
+        self.jwks_fetches: SingleFlight[Optional[dict[str, Any]]] = SingleFlight()
+        # Tokens that already passed validation, keyed by their hash and never kept past their expiration.
+        # Validating a token is cheaper than reading a shared cache, so this one always stays in the worker process.
+        self.validated_tokens: TTLCache[bool] = TTLCache(maxsize=token_cache_size, ttl=token_cache_ttl)
+        # The caches below save calls to Entra ID, Microsoft Graph and AI Search, so they can be shared by the workers
+        cache_backends = cache_backends or CacheBackendFactory()
+        # Claims derived from a user's token through the on-behalf-of flow, keyed by the token's hash
+        self.claims_cache: TTLCache[dict[str, Any]] = TTLCache(
+            maxsize=token_cache_size,
+            ttl=token_cache_ttl,
+            backend=cache_backends.create("auth_claims", token_cache_size),
+        )
+        # Groups read from Microsoft Graph for users with a groups overage, keyed by oid.
+        # Entries are fresh for groups_cache_ttl seconds, then served stale while they are refreshed in the background
+        # for at most groups_stale_ttl more seconds.
+        self.groups_cache_ttl = groups_cache_ttl
+        self.groups_cache: TTLCache[tuple[float, list[str]]] = TTLCache(
+            maxsize=token_cache_size,
+            ttl=groups_cache_ttl + groups_stale_ttl,
+            backend=cache_backends.create("auth_groups", token_cache_size),
+        )
+        self.group_fetches: SingleFlight[list[str]] = SingleFlight()
+        # Whether a security filter grants access to a path, keyed by (security filter, path)
+        self.path_auth_cache: TTLCache[bool] = TTLCache(
+            maxsize=path_auth_cache_size,
+            ttl=path_auth_cache_ttl,
+            backend=cache_backends.create("auth_paths", path_auth_cache_size),
+        )
+        self.path_preauthorizations: SingleFlight[dict[str, bool]] = SingleFlight()
         self.server_app_id = server_app_id
         self.server_app_secret = server_app_secret
         self.client_app_id = client_app_id
@@ -64,10 +131,16 @@ class AuthenticationHelper:
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id, authority=self.authority, client_credential=server_app_secret, token_cache=TokenCache()
             )
+            # MSAL is synchronous, so its network calls run on a small thread pool instead of blocking the event loop
+            self.obo_executor = ThreadPoolExecutor(max_workers=obo_max_workers, thread_name_prefix="msal-obo")
         else:
             self.has_auth_fields = False
             self.require_access_control = False
 
+    def close(self):
+        if self.use_authentication:
+            self.obo_executor.shutdown(wait=False)
+
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
         return {
@@ -128,6 +201,18 @@ class AuthenticationHelper:
 
         raise AuthError(error="Authorization header is expected", status_code=401)
 
+    @staticmethod
+    def hash_token(token: str) -> str:
+        # Tokens are only kept in the caches as hashes
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def get_token_expiration(token: str) -> Optional[float]:
+        try:
+            return float(jwt.get_unverified_claims(token)["exp"])
+        except Exception:
+            return None
+
     def build_security_filters(self, overrides: dict[str, Any], auth_claims: dict[str, Any]):
         # Build different permutations of the oid or groups security filter using OData filters
         # https://learn.microsoft.com/azure/search/search-security-trimming-for-azure-search
@@ -162,13 +247,18 @@ class AuthenticationHelper:
             return None
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, http_session: Optional[aiohttp.ClientSession] = None
+    ) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        # The headers are sent per request as the session may be shared with other users
+        async with use_http_session(http_session) as session:
             resp_json = None
             resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+            async with session.get(
+                url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id", headers=headers
+            ) as resp:
                 resp_json = await resp.json()
                 resp_status = resp.status
                 if resp_status != 200:
@@ -180,7 +270,7 @@ class AuthenticationHelper:
                     groups.append(group["id"])
                 next_link = resp_json.get("@odata.nextLink")
                 if next_link:
-                    async with session.get(url=next_link) as resp:
+                    async with session.get(url=next_link, headers=headers) as resp:
                         resp_json = await resp.json()
                         resp_status = resp.status
                 else:
@@ -190,6 +280,33 @@ class AuthenticationHelper:
 
         return groups
 
+    async def get_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        """
+        Returns the user's groups from the groups cache, reading them from Microsoft Graph when needed.
+        Concurrent requests for the same user share a single Graph lookup.
+        """
+
+        async def fetch_groups() -> list[str]:
+            start = time.perf_counter()
+            groups = await AuthenticationHelper.list_groups(graph_resource_access_token, self.http_session)
+            groups_fetch_duration.record((time.perf_counter() - start) * 1000)
+            # The wall clock, since a shared cache is read by other processes
+            await self.groups_cache.aset(oid, (time.time(), groups))
+            return groups
+
+        entry = await self.groups_cache.aget(oid)
+        if entry is None:
+            groups_cache_lookups.add(1, {"result": "miss"})
+            return list(await self.group_fetches.do(oid, fetch_groups))
+
+        fetched_at, groups = entry
+        if time.time() - fetched_at >= self.groups_cache_ttl:
+            groups_cache_lookups.add(1, {"result": "stale"})
+            self.group_fetches.start(oid, fetch_groups)
+        else:
+            groups_cache_lookups.add(1, {"result": "hit"})
+        return list(groups)
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -201,10 +318,21 @@ class AuthenticationHelper:
             # Validate the token before use
             await self.validate_access_token(auth_token)
 
+            # The claims only depend on the token, so reuse them until the token expires
+            token_hash = AuthenticationHelper.hash_token(auth_token)
+            cached_claims = await self.claims_cache.aget(token_hash)
+            if cached_claims is not None:
+                return dict(cached_claims)
+
             # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
             # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+            graph_resource_access_token = await asyncio.get_running_loop().run_in_executor(
+                self.obo_executor,
+                functools.partial(
+                    self.confidential_client.acquire_token_on_behalf_of,
+                    user_assertion=auth_token,
+                    scopes=["https://graph.microsoft.com/.default"],
+                ),
             )
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
@@ -225,7 +353,13 @@ class AuthenticationHelper:
             )
             if missing_groups_claim or has_group_overage_claim:
                 # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                auth_claims["groups"] = await self.get_groups(auth_claims["oid"], graph_resource_access_token)
+
+            expiration = AuthenticationHelper.get_token_expiration(auth_token)
+            if expiration is not None:
+                await self.claims_cache.aset(
+                    token_hash, auth_claims, ttl=min(self.claims_cache.ttl, expiration - time.time())
+                )
             return auth_claims
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -245,8 +379,17 @@ class AuthenticationHelper:
         if not security_filter:
             return True
 
-        # Filter down to only chunks that are from the specific source file
-        filter = f"{security_filter} and (sourcepage eq '{path}')"
+        # Viewers request the same file repeatedly, and citations may have been authorized when the answer was generated
+        blob_path = self.get_blob_path(path)
+        cached_decision = await self.path_auth_cache.aget((security_filter, blob_path))
+        if cached_decision is not None:
+            return cached_decision
+
+        # Filter down to only chunks that are from the specific file, decided per file like the cached decisions:
+        # the chunks of a PDF have the file as sourcefile and the page as sourcepage, while the chunks of other files
+        # and the page images have the requested path as sourcepage
+        escaped_path = blob_path.replace("'", "''")
+        filter = f"{security_filter} and (sourcepage eq '{escaped_path}' or sourcefile eq '{escaped_path}')"
 
         # If the filter returns any results, the user is allowed to access the document
         # Otherwise, access is denied
@@ -256,13 +399,72 @@ class AuthenticationHelper:
             allowed = True
             break
 
+        await self.path_auth_cache.aset((security_filter, blob_path), allowed)
         return allowed
 
-    # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
-    async def validate_access_token(self, token: str):
+    @staticmethod
+    def get_blob_path(path: str) -> str:
         """
-        Validate an access token is issued by Entra
+        Returns the path of the file a citation refers to, which the path authorization decisions are cached under.
+        The citations of PDF pages end with #page=N, which browsers don't send when the citation is opened.
+        """
+        return path.rsplit("#page=", 1)[0] if path.find("#page=") > 0 else path
+
+    async def preauthorize_paths(
+        self, paths: list[str], auth_claims: dict[str, Any], search_client: SearchClient
+    ) -> dict[str, bool]:
+        """
+        Checks access to several paths with a single search query and stores the decisions in the path cache,
+        so that check_path_auth doesn't need to query the search index when the user opens one of them.
+        The decisions are made per file, so a PDF is allowed when any of its cited pages is.
         """
+        security_filter = self.build_security_filters(overrides={}, auth_claims=auth_claims)
+        if not security_filter:
+            return {self.get_blob_path(path): True for path in paths}
+
+        # search.in splits the values on "|", so paths containing it are left to check_path_auth
+        paths = [
+            path
+            for path in dict.fromkeys(paths)
+            if "|" not in path and await self.path_auth_cache.aget((security_filter, self.get_blob_path(path))) is None
+        ]
+        if not paths:
+            return {}
+
+        # Facet on sourcepage to list which of the paths have at least one chunk the user can access
+        values = "|".join(path.replace("'", "''") for path in paths)
+        filter = f"{security_filter} and search.in(sourcepage, '{values}', '|')"
+        results = await search_client.search(
+            search_text="*", top=0, filter=filter, facets=[f"sourcepage,count:{len(paths)}"]
+        )
+        facets = await results.get_facets() or {}
+        allowed_paths = {self.get_blob_path(facet["value"]) for facet in facets.get("sourcepage", [])}
+
+        decisions = {self.get_blob_path(path): self.get_blob_path(path) in allowed_paths for path in paths}
+        for path, allowed in decisions.items():
+            await self.path_auth_cache.aset((security_filter, path), allowed)
+        return decisions
+
+    def schedule_path_preauthorization(
+        self, paths: list[str], auth_claims: dict[str, Any], search_client: SearchClient
+    ):
+        """
+        Runs preauthorize_paths in the background, without delaying the response that contains the paths.
+        """
+        security_filter = self.build_security_filters(overrides={}, auth_claims=auth_claims)
+        if not paths or not security_filter:
+            return
+
+        async def preauthorize() -> dict[str, bool]:
+            try:
+                return await self.preauthorize_paths(paths, auth_claims, search_client)
+            except Exception:
+                logging.exception("Unable to preauthorize paths")
+                return {}
+
+        self.path_preauthorizations.start((security_filter, tuple(paths)), preauthorize)
+
+    async def fetch_jwks(self) -> Optional[dict[str, Any]]:
         jwks = None
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type(AuthError),
@@ -270,7 +472,7 @@ class AuthenticationHelper:
             stop=stop_after_attempt(5),
         ):
             with attempt:
-                async with aiohttp.ClientSession() as session:
+                async with use_http_session(self.http_session) as session:
                     async with session.get(url=self.key_url) as resp:
                         resp_status = resp.status
                         if resp_status in [500, 502, 503, 504]:
@@ -278,7 +480,56 @@ class AuthenticationHelper:
                                 error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
                             )
                         jwks = await resp.json()
+        return jwks
+
+    async def get_jwks(self, force_refresh: bool = False) -> Optional[dict[str, Any]]:
+        """
+        Returns the signing keys of the tenant, downloading them only when the cached keys expired
+        or when force_refresh is set because a token was signed with a key that isn't cached yet.
+        Forced refreshes are rate limited so that tokens with made up key ids can't flood the keys endpoint.
+        Concurrent refreshes share a single download, and the last keys downloaded keep being used when it fails.
+        """
+
+        async def refresh_jwks() -> Optional[dict[str, Any]]:
+            jwks = await self.fetch_jwks()
+            if jwks and "keys" in jwks:
+                self.jwks = jwks
+                self.jwks_fetched_at = time.monotonic()
+            return jwks
+
+        age = time.monotonic() - self.jwks_fetched_at
+        refresh_allowed = force_refresh and age >= self.jwks_min_refresh_interval
+        if self.jwks and age < self.jwks_cache_ttl and not refresh_allowed:
+            return self.jwks
+        try:
+            jwks = await self.jwks_fetches.do("jwks", refresh_jwks)
+        except Exception:
+            if not self.jwks:
+                raise
+            logging.exception("Unable to refresh the signing keys, using the cached ones")
+            return self.jwks
+        if not (jwks and "keys" in jwks) and self.jwks:
+            logging.warning("The signing keys downloaded are invalid, using the cached ones")
+            return self.jwks
+        return jwks
+
+    @staticmethod
+    def find_signing_key(jwks: dict[str, Any], kid: str) -> Optional[dict[str, Any]]:
+        for key in jwks["keys"]:
+            if key["kid"] == kid:
+                return {"kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"]}
+        return None
+
+    # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
+    async def validate_access_token(self, token: str):
+        """
+        Validate an access token is issued by Entra
+        """
+        token_hash = AuthenticationHelper.hash_token(token)
+        if self.validated_tokens.get(token_hash):
+            return
 
+        jwks = await self.get_jwks()
         if not jwks or "keys" not in jwks:
             raise AuthError({"code": "invalid_keys", "description": "Unable to get keys to validate auth token."}, 401)
 
@@ -290,14 +541,17 @@ class AuthenticationHelper:
             unverified_claims = jwt.get_unverified_claims(token)
             issuer = unverified_claims.get("iss")
             audience = unverified_claims.get("aud")
-            for key in jwks["keys"]:
-                if key["kid"] == unverified_header["kid"]:
-                    rsa_key = {"kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"]}
-                    break
+            kid = unverified_header["kid"]
+            rsa_key = AuthenticationHelper.find_signing_key(jwks, kid)
         except Exception as exc:
             raise AuthError(
                 {"code": "invalid_header", "description": "Unable to parse authorization token."}, 401
             ) from exc
+        if not rsa_key:
+            # The keys may have been rotated since they were cached
+            jwks = await self.get_jwks(force_refresh=True)
+            if jwks and "keys" in jwks:
+                rsa_key = AuthenticationHelper.find_signing_key(jwks, kid)
         if not rsa_key:
             raise AuthError({"code": "invalid_header", "description": "Unable to find appropriate key"}, 401)
 
@@ -328,3 +582,8 @@ class AuthenticationHelper:
             raise AuthError(
                 {"code": "invalid_header", "description": "Unable to parse authorization token."}, 401
             ) from exc
+
+        # Remember the token until it expires, so repeated requests from the same user skip the signature check
+        expiration = AuthenticationHelper.get_token_expiration(token)
+        if expiration is not None:
+            self.validated_tokens.set(token_hash, True, ttl=min(self.validated_tokens.ttl, expiration - time.time()))
@@ -0,0 +1,102 @@
+from typing import Any, Generic, Hashable, Optional, TypeVar, cast
+
+from core.cachebackends import CacheBackend, MemoryBackend, SyncCacheBackend
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """
+    A bounded cache with per-entry expiration. The entries are kept in the worker process with least-recently-used
+    eviction, unless a shared backend is given, see core.cachebackends, which only the async methods can use
+    when it's the Redis one.
+    Attributes:
+        maxsize (int): The maximum number of entries kept, a maxsize of 0 disables the cache.
+        ttl (float): The default number of seconds an entry stays valid.
+        backend (CacheBackend): Where the entries are kept.
+        hits (int): The number of lookups that found a valid entry.
+        misses (int): The number of lookups that found no entry or an expired one.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, backend: Optional[CacheBackend] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryBackend(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.sync_backend)
+
+    @property
+    def sync_backend(self) -> SyncCacheBackend:
+        if not isinstance(self.backend, SyncCacheBackend):
+            raise TypeError(f"{type(self.backend).__name__} can only be used with the async methods")
+        return self.backend
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key: Hashable) -> Optional[V]:
+        return self.count_lookup(self.sync_backend.get(key) if self.enabled else None)
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None):
+        """
+        Stores a value, evicting the least recently used entries once maxsize is reached.
+        Args:
+            key (Hashable): The cache key.
+            value: The value to store.
+            ttl (float): Seconds until the entry expires, defaults to the cache's ttl.
+        """
+        ttl = self.get_ttl(ttl)
+        if ttl is not None:
+            self.sync_backend.set(key, value, ttl)
+
+    def delete(self, key: Hashable):
+        self.sync_backend.delete(key)
+
+    def clear(self):
+        self.sync_backend.clear()
+
+    # The async methods don't block the event loop on a shared backend, whose calls either run in its executor
+    # or are sent to the server asynchronously. The caches that are always in memory can keep using the methods above.
+
+    async def aget(self, key: Hashable) -> Optional[V]:
+        return self.count_lookup(await self.backend.aget(key) if self.enabled else None)
+
+    async def aset(self, key: Hashable, value: V, ttl: Optional[float] = None):
+        ttl = self.get_ttl(ttl)
+        if ttl is not None:
+            await self.backend.aset(key, value, ttl)
+
+    async def adelete(self, key: Hashable):
+        await self.backend.adelete(key)
+
+    async def aclear(self):
+        await self.backend.aclear()
+
+    def count_lookup(self, value: Optional[Any]) -> Optional[V]:
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cast(V, value)
+
+    def get_ttl(self, ttl: Optional[float]) -> Optional[float]:
+        """Returns the ttl to store an entry with, or None if it shouldn't be stored."""
+        if not self.enabled:
+            return None
+        ttl = self.ttl if ttl is None else ttl
+        return ttl if ttl > 0 else None
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            # Redis doesn't count the entries of a namespace without scanning all of its keys
+            "size": len(self.backend) if isinstance(self.backend, SyncCacheBackend) else None,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
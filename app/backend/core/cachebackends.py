@@ -0,0 +1,593 @@
+import asyncio
+import dataclasses
+import hashlib
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Optional, Sequence, TypeVar
+
+import redis.asyncio
+import redis.exceptions
+
+CACHE_BACKENDS = ["memory", "sqlite", "redis"]
+
+T = TypeVar("T")
+
+
+class CacheSerializer:
+    """
+    Serializes the values of the shared backends as JSON, so that reading an entry can't run code,
+    and signs them with HMAC-SHA256 along with their namespace, key and expiration, so that entries written
+    without the signing key, moved to another key or kept past their expiration are ignored.
+    Dataclasses and Azure SDK models are only serialized and rebuilt if their type is one of value_types,
+    and JSON turns tuples into lists.
+    """
+
+    def __init__(self, signing_key: str, value_types: Sequence[type] = ()):
+        self.signing_key = signing_key.encode("utf-8")
+        self.value_types = {value_type.__name__: value_type for value_type in value_types}
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=self.encode_object)
+        self.decoder = json.JSONDecoder(object_hook=self.decode_object)
+
+    def encode_object(self, o: Any) -> Any:
+        name = type(o).__name__
+        if self.value_types.get(name) is type(o):
+            if dataclasses.is_dataclass(o):
+                return {
+                    "__type__": name,
+                    "fields": {field.name: getattr(o, field.name) for field in dataclasses.fields(o)},
+                }
+            if hasattr(o, "as_dict"):
+                return {"__type__": name, "dict": o.as_dict()}
+        raise TypeError(f"Values of type {name} can't be cached")
+
+    def decode_object(self, o: dict[str, Any]) -> Any:
+        if "__type__" not in o:
+            return o
+        value_type = self.value_types.get(o["__type__"])
+        if value_type is None:
+            raise ValueError(f"Values of type {o['__type__']} can't be read from the cache")
+        if "fields" in o:
+            return value_type(**o["fields"])
+        return value_type.from_dict(o["dict"])  # type: ignore[attr-defined]
+
+    def sign(self, namespace: str, key: str, payload: bytes) -> bytes:
+        message = b"\n".join([namespace.encode("utf-8"), key.encode("utf-8"), payload])
+        return hmac.new(self.signing_key, message, hashlib.sha256).hexdigest().encode("ascii")
+
+    def dumps(self, namespace: str, key: str, value: Any, expires_at: float) -> bytes:
+        payload = self.encoder.encode({"expires_at": expires_at, "value": value}).encode("utf-8")
+        return self.sign(namespace, key, payload) + b"." + payload
+
+    def loads(self, namespace: str, key: str, data: bytes) -> Optional[Any]:
+        """Returns the value, or None if it expired. Raises ValueError if the signature or the value is invalid."""
+        signature, _, payload = data.partition(b".")
+        if not hmac.compare_digest(signature, self.sign(namespace, key, payload)):
+            raise ValueError("Invalid signature")
+        entry = self.decoder.decode(payload.decode("utf-8"))
+        return entry["value"] if entry["expires_at"] > time.time() else None
+
+    def loads_members(self, namespace: str, prefix: str, members: list[tuple[str, bytes]]) -> dict[str, Any]:
+        """
+        Returns the members that haven't expired, each signed with its name after prefix as key,
+        skipping the ones that can't be read rather than the whole collection.
+        """
+        values = {}
+        for member, data in members:
+            try:
+                value = self.loads(namespace, prefix + member, data)
+            except Exception as error:
+                logging.warning("Unable to read a member from the %s cache: %r", namespace, error)
+                continue
+            if value is not None:
+                values[member] = value
+        return values
+
+
+class CacheBackend(ABC):
+    """
+    Stores the entries of a cache. The caches use the async methods, so that the shared backends don't block
+    the event loop. The in-process backend keeps the values as they are, while the shared backends serialize them
+    with a CacheSerializer, so they are copies when read back.
+    """
+
+    shared = False
+
+    @abstractmethod
+    async def aget(self, key: Hashable) -> Optional[Any]:
+        """Returns the value of the key, or None if it's missing, expired or can't be read."""
+
+    @abstractmethod
+    async def aset(self, key: Hashable, value: Any, ttl: float):
+        pass
+
+    @abstractmethod
+    async def adelete(self, key: Hashable):
+        pass
+
+    @abstractmethod
+    async def aclear(self):
+        pass
+
+    @abstractmethod
+    async def aget_members(self, key: Hashable) -> dict[str, Any]:
+        """Returns the members of the collection of the key that haven't expired, by name."""
+
+    @abstractmethod
+    async def aset_member(self, key: Hashable, member: str, value: Any, ttl: float):
+        """Stores a member of the collection of the key, without reading or rewriting the other members."""
+
+    @abstractmethod
+    async def adelete_members(self, key: Hashable, members: list[str]):
+        pass
+
+    @staticmethod
+    def hash_key(key: Hashable) -> str:
+        # The keys are tuples of strings and numbers, whose repr is the same in every process, unlike their hash.
+        # Hashing them also keeps tokens and security filters out of the shared store.
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+class SyncCacheBackend(CacheBackend):
+    """
+    A backend with blocking methods, which the async methods call in the executor if there's one,
+    so that the calls that wait on a file don't block the event loop. The caches that are always in memory
+    can use the blocking methods directly.
+    """
+
+    # Set by CacheBackendFactory for the SQLite backend
+    executor: Optional[Executor] = None
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """Calls function with args, in the executor if the backend has one."""
+        if self.executor is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def aget(self, key: Hashable) -> Optional[Any]:
+        return await self.run(self.get, key)
+
+    async def aset(self, key: Hashable, value: Any, ttl: float):
+        await self.run(self.set, key, value, ttl)
+
+    async def adelete(self, key: Hashable):
+        await self.run(self.delete, key)
+
+    async def aclear(self):
+        await self.run(self.clear)
+
+    async def aget_members(self, key: Hashable) -> dict[str, Any]:
+        return await self.run(self.get_members, key)
+
+    async def aset_member(self, key: Hashable, member: str, value: Any, ttl: float):
+        await self.run(self.set_member, key, member, value, ttl)
+
+    async def adelete_members(self, key: Hashable, members: list[str]):
+        await self.run(self.delete_members, key, members)
+
+    @abstractmethod
+    def get(self, key: Hashable) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    def set(self, key: Hashable, value: Any, ttl: float):
+        pass
+
+    @abstractmethod
+    def delete(self, key: Hashable):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def get_members(self, key: Hashable) -> dict[str, Any]:
+        pass
+
+    @abstractmethod
+    def set_member(self, key: Hashable, member: str, value: Any, ttl: float):
+        pass
+
+    @abstractmethod
+    def delete_members(self, key: Hashable, members: list[str]):
+        pass
+
+
+class MemoryBackend(SyncCacheBackend):
+    """Keeps the entries in the worker process, evicting the least recently used ones past maxsize."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_members(self, key: Hashable) -> dict[str, Any]:
+        now = time.monotonic()
+        members = self.get(key) or {}
+        return {member: value for member, (expires_at, value) in members.items() if expires_at > now}
+
+    def set_member(self, key: Hashable, member: str, value: Any, ttl: float):
+        entry = self._entries.get(key)
+        members = entry[1] if entry is not None and entry[0] > time.monotonic() else {}
+        members[member] = (time.monotonic() + ttl, value)
+        # The collection lives as long as its longest-living member
+        self.set(key, members, max(expires_at for expires_at, _ in members.values()) - time.monotonic())
+
+    def delete_members(self, key: Hashable, members: list[str]):
+        entry = self._entries.get(key)
+        if entry is not None:
+            for member in members:
+                entry[1].pop(member, None)
+
+
+class SQLiteBackend(SyncCacheBackend):
+    """
+    Keeps the entries in a SQLite database file, shared by the worker processes of an instance,
+    so that they're not split between the workers and survive the workers being recycled.
+    Rather than on every write, the size is checked once every tenth of maxsize writes, when the expired entries
+    and then the entries closest to expiring are evicted, so the cache can briefly hold up to 10% more than maxsize.
+    """
+
+    shared = True
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        lock: threading.Lock,
+        namespace: str,
+        maxsize: int,
+        serializer: CacheSerializer,
+    ):
+        self.connection = connection
+        self.lock = lock
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.serializer = serializer
+        self.sweep_interval = max(1, maxsize // 10)
+        self.writes_since_sweep = 0
+
+    @staticmethod
+    def connect(path: str, timeout: float = 1.0) -> sqlite3.Connection:
+        # Autocommit, and the write-ahead log, so that readers in other workers don't wait on writers
+        connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, value BLOB NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS cache_entries_expires_at ON cache_entries (namespace, expires_at)"
+        )
+        return connection
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        hashed_key = self.hash_key(key)
+        try:
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT value FROM cache_entries WHERE namespace = ? AND key = ? AND expires_at > ?",
+                    (self.namespace, hashed_key, time.time()),
+                ).fetchone()
+            return self.serializer.loads(self.namespace, hashed_key, row[0]) if row else None
+        except Exception as error:
+            logging.warning("Unable to read from the %s cache: %r", self.namespace, error)
+            return None
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        self.set_row(self.hash_key(key), value, ttl)
+
+    def set_row(self, row_key: str, value: Any, ttl: float):
+        now = time.time()
+        try:
+            data = self.serializer.dumps(self.namespace, row_key, value, now + ttl)
+            with self.lock:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, expires_at, value) VALUES (?, ?, ?, ?)",
+                    (self.namespace, row_key, now + ttl, data),
+                )
+                self.writes_since_sweep += 1
+                if self.writes_since_sweep >= self.sweep_interval:
+                    self.writes_since_sweep = 0
+                    self.sweep(now)
+        except Exception as error:
+            logging.warning("Unable to write to the %s cache: %r", self.namespace, error)
+
+    def sweep(self, now: float):
+        """Evicts the expired entries, then the entries closest to expiring past maxsize. Called with the lock held."""
+        (count,) = self.connection.execute(
+            "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+        ).fetchone()
+        if count <= self.maxsize:
+            return
+        count -= self.connection.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?", (self.namespace, now)
+        ).rowcount
+        if count > self.maxsize:
+            # The rows are read in the order of the (namespace, expires_at) index, so only the evicted ones are read
+            self.connection.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key IN (SELECT key FROM cache_entries "
+                "WHERE namespace = ? ORDER BY expires_at LIMIT ?)",
+                (self.namespace, self.namespace, count - self.maxsize),
+            )
+
+    def delete(self, key: Hashable):
+        try:
+            with self.lock:
+                self.connection.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, self.hash_key(key))
+                )
+        except sqlite3.Error as error:
+            logging.warning("Unable to delete from the %s cache: %r", self.namespace, error)
+
+    def clear(self):
+        try:
+            with self.lock:
+                self.connection.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+        except sqlite3.Error as error:
+            logging.warning("Unable to clear the %s cache: %r", self.namespace, error)
+
+    def __len__(self) -> int:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE namespace = ? AND expires_at > ?",
+                (self.namespace, time.time()),
+            ).fetchone()
+        return row[0]
+
+    # The members are rows of their own, whose key is the hashed key of the collection followed by ":" and the member,
+    # so the members of a collection are a range of the primary key
+
+    def get_members(self, key: Hashable) -> dict[str, Any]:
+        prefix = self.hash_key(key) + ":"
+        try:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT key, value FROM cache_entries WHERE namespace = ? AND key > ? AND key < ? AND expires_at > ?",
+                    (self.namespace, prefix, prefix[:-1] + ";", time.time()),
+                ).fetchall()
+        except sqlite3.Error as error:
+            logging.warning("Unable to read from the %s cache: %r", self.namespace, error)
+            return {}
+        return self.serializer.loads_members(
+            self.namespace, prefix, [(row_key[len(prefix) :], value) for row_key, value in rows]
+        )
+
+    def set_member(self, key: Hashable, member: str, value: Any, ttl: float):
+        self.set_row(f"{self.hash_key(key)}:{member}", value, ttl)
+
+    def delete_members(self, key: Hashable, members: list[str]):
+        prefix = self.hash_key(key) + ":"
+        try:
+            with self.lock:
+                self.connection.executemany(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                    [(self.namespace, prefix + member) for member in members],
+                )
+        except sqlite3.Error as error:
+            logging.warning("Unable to delete from the %s cache: %r", self.namespace, error)
+
+
+class RedisServer:
+    """
+    The client of the Redis server shared by the backends, for Redis, Azure Cache for Redis or any compatible server.
+    The URL looks like redis://host:6379/0, or rediss://:password@host:6380/0 for TLS.
+    After the server couldn't be reached, it's considered unavailable for retry_interval seconds, during which
+    the commands fail right away instead of delaying the requests by the timeout again.
+    """
+
+    def __init__(self, url: str, timeout: float = 0.5, retry_interval: float = 30):
+        self.client = redis.asyncio.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.retry_interval = retry_interval
+        self.unavailable_until = 0.0
+
+    async def execute(self, command: Callable[[redis.asyncio.Redis], Any]) -> Any:
+        """
+        Awaits the commands sent by command with the client, unless the server is unavailable.
+        redis-py annotates the commands of its sync and async clients together, so the replies are typed as Any.
+        """
+        if time.monotonic() < self.unavailable_until:
+            raise redis.exceptions.ConnectionError("The Redis server is unavailable")
+        try:
+            return await command(self.client)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            self.unavailable_until = time.monotonic() + self.retry_interval
+            raise
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class RedisBackend(CacheBackend):
+    """
+    Keeps the entries in a Redis server, shared by the workers of all the instances.
+    Redis expires the entries itself and evicts them according to its maxmemory-policy, so there's no maxsize.
+    """
+
+    shared = True
+
+    def __init__(self, server: RedisServer, namespace: str, serializer: CacheSerializer):
+        self.server = server
+        self.namespace = namespace
+        self.serializer = serializer
+
+    def get_redis_key(self, hashed_key: str) -> str:
+        return f"{self.namespace}:{hashed_key}"
+
+    async def aget(self, key: Hashable) -> Optional[Any]:
+        hashed_key = self.hash_key(key)
+        try:
+            data = await self.server.execute(lambda client: client.get(self.get_redis_key(hashed_key)))
+            return self.serializer.loads(self.namespace, hashed_key, data) if data is not None else None
+        except Exception as error:
+            logging.warning("Unable to read from the %s cache: %r", self.namespace, error)
+            return None
+
+    async def aset(self, key: Hashable, value: Any, ttl: float):
+        hashed_key = self.hash_key(key)
+        try:
+            data = self.serializer.dumps(self.namespace, hashed_key, value, time.time() + ttl)
+            await self.server.execute(
+                lambda client: client.set(self.get_redis_key(hashed_key), data, px=max(1, int(ttl * 1000)))
+            )
+        except Exception as error:
+            logging.warning("Unable to write to the %s cache: %r", self.namespace, error)
+
+    async def adelete(self, key: Hashable):
+        try:
+            await self.server.execute(lambda client: client.delete(self.get_redis_key(self.hash_key(key))))
+        except redis.exceptions.RedisError as error:
+            logging.warning("Unable to delete from the %s cache: %r", self.namespace, error)
+
+    async def aclear(self):
+        async def clear(client: redis.asyncio.Redis):
+            keys = [key async for key in client.scan_iter(match=f"{self.namespace}:*", count=500)]
+            for start in range(0, len(keys), 500):
+                await client.delete(*keys[start : start + 500])
+
+        try:
+            await self.server.execute(clear)
+        except redis.exceptions.RedisError as error:
+            logging.warning("Unable to clear the %s cache: %r", self.namespace, error)
+
+    # A collection is a hash, whose members carry their own expiration, as Redis only expires whole keys
+
+    async def aget_members(self, key: Hashable) -> dict[str, Any]:
+        hashed_key = self.hash_key(key)
+        try:
+            reply = await self.server.execute(lambda client: client.hgetall(self.get_redis_key(hashed_key)))
+        except redis.exceptions.RedisError as error:
+            logging.warning("Unable to read from the %s cache: %r", self.namespace, error)
+            return {}
+        members = [(member.decode("utf-8"), data) for member, data in reply.items()]
+        return self.serializer.loads_members(self.namespace, hashed_key + ":", members)
+
+    async def aset_member(self, key: Hashable, member: str, value: Any, ttl: float):
+        hashed_key = self.hash_key(key)
+        redis_key = self.get_redis_key(hashed_key)
+
+        async def set_member(client: redis.asyncio.Redis):
+            # The hash lives as long as its newest member, the older members are skipped once expired.
+            # Both commands are sent in a single round trip.
+            async with client.pipeline(transaction=False) as pipeline:
+                pipeline.hset(redis_key, mapping={member: data})
+                pipeline.pexpire(redis_key, max(1, int(ttl * 1000)))
+                await pipeline.execute()
+
+        try:
+            data = self.serializer.dumps(self.namespace, f"{hashed_key}:{member}", value, time.time() + ttl)
+            await self.server.execute(set_member)
+        except Exception as error:
+            logging.warning("Unable to write to the %s cache: %r", self.namespace, error)
+
+    async def adelete_members(self, key: Hashable, members: list[str]):
+        if not members:
+            return
+        try:
+            redis_key = self.get_redis_key(self.hash_key(key))
+            await self.server.execute(lambda client: client.hdel(redis_key, *members))  # type: ignore[arg-type]
+        except redis.exceptions.RedisError as error:
+            logging.warning("Unable to delete from the %s cache: %r", self.namespace, error)
+
+
+class CacheBackendFactory:
+    """
+    Creates the backends of the caches, all sharing the connection to the SQLite file or the Redis server.
+    Attributes:
+        kind (str): memory, sqlite or redis.
+        sqlite_path (str): The path of the SQLite database file, for the sqlite backend.
+        redis_url (str): The URL of the Redis server, for the redis backend.
+        timeout (float): The number of seconds to wait for the SQLite lock or a reply from Redis.
+        signing_key (str): The secret the shared backends sign their entries with, the same for all the workers.
+        value_types (Sequence[type]): The dataclasses and Azure SDK models that can be cached in the shared backends.
+        executor (Executor): The threads the calls of the SQLite backend run in, see SyncCacheBackend.run.
+    """
+
+    def __init__(
+        self,
+        kind: str = "memory",
+        sqlite_path: Optional[str] = None,
+        redis_url: Optional[str] = None,
+        timeout: float = 0.5,
+        signing_key: Optional[str] = None,
+        value_types: Sequence[type] = (),
+    ):
+        if kind not in CACHE_BACKENDS:
+            raise ValueError(f"The cache backend must be one of {', '.join(CACHE_BACKENDS)}")
+        if kind == "sqlite" and not sqlite_path:
+            raise ValueError("The sqlite cache backend needs the path of the database file")
+        if kind == "redis" and not redis_url:
+            raise ValueError("The redis cache backend needs the URL of the server")
+        if kind != "memory" and not signing_key:
+            raise ValueError("The shared cache backends need a signing key")
+        self.kind = kind
+        self.sqlite_path = sqlite_path
+        self.redis_url = redis_url
+        self.timeout = timeout
+        self.serializer = CacheSerializer(signing_key or "", value_types)
+        self.sqlite_connection: Optional[sqlite3.Connection] = None
+        self.sqlite_lock = threading.Lock()
+        self.redis_server: Optional[RedisServer] = None
+        # The calls to the file are serialized by a lock, so a few threads are enough
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache") if kind == "sqlite" else None
+
+    @property
+    def shared(self) -> bool:
+        return self.kind != "memory"
+
+    def create(self, namespace: str, maxsize: int) -> CacheBackend:
+        if self.kind == "sqlite" and self.sqlite_path:
+            if self.sqlite_connection is None:
+                self.sqlite_connection = SQLiteBackend.connect(self.sqlite_path, self.timeout)
+            backend = SQLiteBackend(self.sqlite_connection, self.sqlite_lock, namespace, maxsize, self.serializer)
+            backend.executor = self.executor
+            return backend
+        if self.kind == "redis" and self.redis_url:
+            if self.redis_server is None:
+                self.redis_server = RedisServer(self.redis_url, self.timeout)
+            return RedisBackend(self.redis_server, namespace, self.serializer)
+        return MemoryBackend(maxsize)
+
+    async def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.sqlite_connection is not None:
+            self.sqlite_connection.close()
+        if self.redis_server is not None:
+            await self.redis_server.close()
@@ -0,0 +1,98 @@
+import asyncio
+from typing import Any, AsyncGenerator, AsyncIterator, Optional
+
+
+class DeltaCoalescer:
+    """
+    Merges consecutive content deltas of a streamed chat response, so that fewer and larger chunks are sent.
+    Merged content is sent once max_chars characters have accumulated, or max_delay seconds after the first of them
+    arrived, whichever comes first. The first content delta is always sent right away, so the time to the first
+    token doesn't change, and any other event, like the context or the follow-up questions, flushes the merged content
+    before it's sent.
+    """
+
+    def __init__(self, max_chars: int = 100, max_delay: float = 0.03):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_chars > 1 and self.max_delay > 0
+
+    @staticmethod
+    def get_content(event: dict[str, Any]) -> Optional[str]:
+        """Returns the content of an event that only carries content, which can be merged with its neighbours."""
+        choices = event.get("choices")
+        if not choices or len(choices) != 1:
+            return None
+        choice = choices[0]
+        if choice.get("finish_reason") is not None or "context" in choice:
+            return None
+        delta = choice.get("delta") or {}
+        if delta.get("role") or delta.get("tool_calls") or delta.get("function_call"):
+            return None
+        content = delta.get("content")
+        return content if isinstance(content, str) and content else None
+
+    async def coalesce(self, events: AsyncIterator[dict[str, Any]]) -> AsyncGenerator[dict[str, Any], None]:
+        if not self.enabled:
+            async for event in events:
+                yield event
+            return
+
+        loop = asyncio.get_running_loop()
+        iterator = events.__aiter__()
+        # The next event, while waiting for it with a deadline
+        next_event: Optional[asyncio.Future] = None
+        # The first of the merged deltas, which carries the merged content when it's sent
+        merged: Optional[dict[str, Any]] = None
+        parts: list[str] = []
+        size = 0
+        deadline = 0.0
+        sent_content = False
+
+        def flush() -> dict[str, Any]:
+            nonlocal merged, parts, size
+            assert merged is not None
+            merged["choices"][0]["delta"]["content"] = "".join(parts)
+            event, merged, parts, size = merged, None, [], 0
+            return event
+
+        try:
+            while True:
+                try:
+                    if merged is None:
+                        # Without merged content there's no deadline, so wait for the next event as is
+                        event = await (next_event if next_event is not None else iterator.__anext__())
+                    else:
+                        if next_event is None:
+                            next_event = asyncio.ensure_future(iterator.__anext__())
+                        done, _ = await asyncio.wait({next_event}, timeout=max(0.0, deadline - loop.time()))
+                        if not done:
+                            yield flush()
+                            continue
+                        event = next_event.result()
+                    next_event = None
+                except StopAsyncIteration:
+                    break
+
+                content = self.get_content(event)
+                if content is None or not sent_content:
+                    if merged is not None:
+                        yield flush()
+                    sent_content = sent_content or content is not None
+                    yield event
+                    continue
+
+                if merged is None:
+                    merged = event
+                    deadline = loop.time() + self.max_delay
+                parts.append(content)
+                size += len(content)
+                if size >= self.max_chars or loop.time() >= deadline:
+                    yield flush()
+            if merged is not None:
+                yield flush()
+        finally:
+            if next_event is not None:
+                next_event.cancel()
@@ -0,0 +1,79 @@
+class FollowupQuestionParser:
+    """
+    Splits a streamed answer into the content shown to the user and the follow-up questions enclosed in <<...>>,
+    one delta at a time. Each delta is only scanned once, so the work per delta doesn't grow with the answer,
+    and markers split across deltas (e.g. "<" then "<") are recognized.
+
+    Like ChatApproach.extract_followup_questions, the content ends at the first "<<", and the questions are
+    the non-empty texts between "<<" and ">>" that don't contain ">".
+    """
+
+    def __init__(self):
+        # Whether the first "<<" was seen, after which nothing else is shown
+        self.started = False
+        # Whether a question is being read, since its "<<"
+        self.in_question = False
+        # A "<" or ">" at the end of the last delta that may be the first half of a marker
+        self.pending = ""
+        self.question_parts: list[str] = []
+        self.questions: list[str] = []
+
+    def feed(self, text: str) -> tuple[str, list[str]]:
+        """
+        Parses the next delta of the answer. Returns the content that can be shown now
+        and the questions that were completed by this delta.
+        """
+        text = self.pending + text
+        self.pending = ""
+        content = ""
+        if not self.started:
+            start = text.find("<<")
+            if start == -1:
+                if text.endswith("<"):
+                    self.pending = "<"
+                    text = text[:-1]
+                return text, []
+            content = text[:start]
+            text = text[start + 2 :]
+            self.started = True
+            self.in_question = True
+
+        questions = []
+        position = 0
+        while position < len(text):
+            if not self.in_question:
+                start = text.find("<<", position)
+                if start == -1:
+                    if text.endswith("<"):
+                        self.pending = "<"
+                    break
+                self.in_question = True
+                position = start + 2
+                continue
+
+            end = text.find(">", position)
+            if end == -1:
+                self.question_parts.append(text[position:])
+                break
+            self.question_parts.append(text[position:end])
+            if end == len(text) - 1:
+                self.pending = ">"
+                break
+            question = "".join(self.question_parts)
+            self.question_parts = []
+            self.in_question = False
+            # A single ">" ends the question without completing it
+            if text[end + 1] == ">" and question:
+                questions.append(question)
+                position = end + 2
+            else:
+                position = end + 1
+
+        self.questions.extend(questions)
+        return content, questions
+
+    def flush(self) -> str:
+        """Returns the content held back at the end of the answer, in case it wasn't the start of a marker."""
+        content = "" if self.started else self.pending
+        self.pending = ""
+        return content
@@ -0,0 +1,37 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+
+def create_http_session(
+    limit: int = 100,
+    limit_per_host: int = 20,
+    timeout: float = 30,
+    keepalive_timeout: float = 30,
+    dns_cache_ttl: int = 300,
+) -> aiohttp.ClientSession:
+    """
+    Creates a session whose connection pool is shared by the outgoing calls to Azure AI Vision, Microsoft Graph
+    and the Entra ID keys endpoint, so that requests reuse warm keep-alive connections instead of a new TCP+TLS handshake.
+    Must be called while an event loop is running and closed when the app shuts down.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+@asynccontextmanager
+async def use_http_session(session: Optional[aiohttp.ClientSession]) -> AsyncIterator[aiohttp.ClientSession]:
+    """
+    Yields the shared session when one was provided and is still open, otherwise a temporary session for this call.
+    """
+    if session is not None and not session.closed:
+        yield session
+    else:
+        async with aiohttp.ClientSession() as temporary_session:
+            yield temporary_session
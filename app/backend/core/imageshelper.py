@@ -1,7 +1,10 @@
+import asyncio
 import base64
+import logging
 import os
-from typing import Optional
+from typing import List, Optional
 
+from azure.core.exceptions import ResourceNotFoundError
 from azure.storage.blob.aio import ContainerClient
 from typing_extensions import Literal, Required, TypedDict
 
@@ -34,3 +37,24 @@ async def fetch_image(blob_container_client: ContainerClient, result: Document)
         else:
             return None
     return None
+
+
+async def fetch_images(
+    blob_container_client: ContainerClient, results: List[Document], max_concurrency: int = 5
+) -> List[ImageURL]:
+    """
+    Downloads the page images for the search results concurrently, running at most max_concurrency downloads at once.
+    The images are returned in the same order as the results, and results whose image blob is missing are skipped.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def fetch(result: Document) -> Optional[ImageURL]:
+        async with semaphore:
+            try:
+                return await fetch_image(blob_container_client, result)
+            except ResourceNotFoundError:
+                logging.warning("Image for %s not found in blob storage, skipping", result.sourcepage)
+                return None
+
+    images = await asyncio.gather(*[fetch(result) for result in results])
+    return [image for image in images if image]
@@ -0,0 +1,76 @@
+import asyncio
+import inspect
+import logging
+from typing import Awaitable, Callable, Optional, Union
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob.aio import ContainerClient
+
+# Written by prepdocs at the end of every ingestion run, see BlobManager.update_index_version in scripts/prepdocslib
+INDEX_VERSION_BLOB_NAME = "index-version.json"
+
+UNKNOWN_VERSION = object()
+
+
+class IndexVersionWatcher:
+    """
+    Polls the index version marker blob and calls on_change whenever it changes, awaiting it if it's a coroutine
+    function, so that caches of search results can be invalidated once prepdocs finishes an ingestion run.
+    """
+
+    def __init__(
+        self,
+        blob_container_client: ContainerClient,
+        on_change: Callable[[], Union[None, Awaitable[None]]],
+        interval: float = 60,
+        blob_name: str = INDEX_VERSION_BLOB_NAME,
+    ):
+        self.blob_container_client = blob_container_client
+        self.on_change = on_change
+        self.interval = interval
+        self.blob_name = blob_name
+        self.version: object = UNKNOWN_VERSION
+        self.task: Optional[asyncio.Task] = None
+
+    async def get_version(self) -> Optional[str]:
+        try:
+            properties = await self.blob_container_client.get_blob_client(self.blob_name).get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+        return properties.etag
+
+    async def check(self) -> bool:
+        """
+        Reads the current version and calls on_change if it differs from the last one seen.
+        The first check always counts as a change, since the index may have been updated before it ran.
+        """
+        version = await self.get_version()
+        if version == self.version:
+            return False
+        logging.info("Index version changed from %s to %s", self.version, version)
+        self.version = version
+        result = self.on_change()
+        if inspect.isawaitable(result):
+            await result
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as error:
+                logging.warning("Unable to check the index version: %r", error)
+
+    def start(self):
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
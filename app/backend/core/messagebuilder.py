@@ -1,5 +1,7 @@
+import hashlib
+import json
 import unicodedata
-from typing import List, Union
+from typing import Any, List, Optional, Union
 
 from openai.types.chat import (
     ChatCompletionAssistantMessageParam,
@@ -9,6 +11,7 @@ from openai.types.chat import (
     ChatCompletionUserMessageParam,
 )
 
+from .cache import TTLCache
 from .modelhelper import num_tokens_from_messages
 
 
@@ -19,16 +22,19 @@ class MessageBuilder:
         message (list): A list of dictionaries representing chat messages.
         model (str): The name of the ChatGPT model.
         token_count (int): The total number of tokens in the conversation.
+        token_count_cache (TTLCache): Optional cache of token counts by message content, shared between requests.
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
+        append_message(self, role: str, content: str): Appends a new message to the end of the conversation.
     """
 
-    def __init__(self, system_content: str, chatgpt_model: str):
+    def __init__(self, system_content: str, chatgpt_model: str, token_count_cache: Optional[TTLCache[int]] = None):
         self.messages: list[ChatCompletionMessageParam] = [
             ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", system_content))
         ]
         self.model = chatgpt_model
+        self.token_count_cache = token_count_cache
 
     def insert_message(self, role: str, content: Union[str, List[ChatCompletionContentPartParam]], index: int = 1):
         """
@@ -39,21 +45,46 @@ class MessageBuilder:
             content (str | List[ChatCompletionContentPartParam]): The content of the message.
             index (int): The index at which to insert the message.
         """
-        message: ChatCompletionMessageParam
+        self.messages.insert(index, self.create_message(role, content))
+
+    def append_message(self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]):
+        """
+        Appends a message to the end of the conversation.
+        Building a conversation in order with append_message is linear, unlike repeated inserts in the middle.
+        Args:
+            role (str): The role of the message sender (either "user", "system", or "assistant").
+            content (str | List[ChatCompletionContentPartParam]): The content of the message.
+        """
+        self.messages.append(self.create_message(role, content))
+
+    def create_message(
+        self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]
+    ) -> ChatCompletionMessageParam:
         if role == "user":
-            message = ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
+            return ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
         elif role == "system" and isinstance(content, str):
-            message = ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", content))
+            return ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", content))
         elif role == "assistant" and isinstance(content, str):
-            message = ChatCompletionAssistantMessageParam(
-                role="assistant", content=unicodedata.normalize("NFC", content)
-            )
+            return ChatCompletionAssistantMessageParam(role="assistant", content=unicodedata.normalize("NFC", content))
         else:
             raise ValueError(f"Invalid role: {role}")
-        self.messages.insert(index, message)
 
-    def count_tokens_for_message(self, message: dict[str, str]):
-        return num_tokens_from_messages(message, self.model)
+    def count_tokens_for_message(self, message: dict[str, Any]) -> int:
+        """
+        Counts the tokens of a message, reusing the count of an identical message from the token count cache,
+        so that the history resent on every turn of a conversation is only tokenized once.
+        """
+        if self.token_count_cache is None or not self.token_count_cache.enabled:
+            return num_tokens_from_messages(message, self.model)
+        message_hash = hashlib.sha256(
+            json.dumps(message, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()
+        cache_key = (self.model, message_hash)
+        token_count = self.token_count_cache.get(cache_key)
+        if token_count is None:
+            token_count = num_tokens_from_messages(message, self.model)
+            self.token_count_cache.set(cache_key, token_count)
+        return token_count
 
     def normalize_content(self, content: Union[str, List[ChatCompletionContentPartParam]]):
         if isinstance(content, str):
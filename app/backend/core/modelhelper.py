@@ -1,5 +1,9 @@
 from __future__ import annotations
 
+import functools
+import os
+from typing import Sequence
+
 import tiktoken
 
 MODELS_2_TOKEN_LIMITS = {
@@ -13,6 +17,9 @@ MODELS_2_TOKEN_LIMITS = {
 }
 
 
+# Below this many characters, encoding the strings one by one is faster than starting a thread pool
+BATCH_ENCODING_MIN_CHARS = 20000
+
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
 
 
@@ -22,6 +29,16 @@ def get_token_limit(model_id: str) -> int:
     return MODELS_2_TOKEN_LIMITS[model_id]
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding for a model, resolved once per model and then reused.
+    Args:
+        model (str): The name of the model, either the Azure OpenAI or the OpenAI name.
+    """
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
 def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
     """
     Calculate the number of tokens required to encode a message.
@@ -37,7 +54,7 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         output: 11
     """
 
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    encoding = get_encoding(model)
     num_tokens = 2  # For "role" and "content" keys
     for key, value in message.items():
         if isinstance(value, list):
@@ -50,6 +67,54 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
     return num_tokens
 
 
+def num_tokens_from_texts(texts: Sequence[str], model: str, num_threads: int | None = None) -> list[int]:
+    """
+    Calculate the number of tokens of many strings at once.
+    Large batches are encoded on a pool of threads, as tiktoken releases the GIL while encoding.
+    Args:
+        texts (list): The strings to encode.
+        model (str): The name of the model to use for encoding.
+        num_threads (int): The number of threads tiktoken encodes with, defaults to the number of CPUs (at most 8).
+    Returns:
+        list: The number of tokens of each string, in the same order.
+    """
+    encoding = get_encoding(model)
+    num_threads = num_threads or min(8, os.cpu_count() or 1)
+    # Starting the thread pool costs more than encoding a few short strings
+    if num_threads < 2 or len(texts) < 2 or sum(len(text) for text in texts) < BATCH_ENCODING_MIN_CHARS:
+        return [len(encoding.encode(text)) for text in texts]
+    return [len(tokens) for tokens in encoding.encode_batch(list(texts), num_threads=num_threads)]
+
+
+def num_tokens_from_messages_batch(
+    messages: Sequence[dict[str, str]], model: str, num_threads: int | None = None
+) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of the messages, with a single batch encoding call.
+    Returns the same counts as calling num_tokens_from_messages for each message.
+    """
+    message_texts = [get_message_texts(message) for message in messages]
+    text_counts = num_tokens_from_texts([text for texts in message_texts for text in texts], model, num_threads)
+    counts = []
+    offset = 0
+    for texts in message_texts:
+        counts.append(2 + sum(text_counts[offset : offset + len(texts)]))
+        offset += len(texts)
+    return counts
+
+
+def get_message_texts(message: dict[str, str]) -> list[str]:
+    texts = []
+    for value in message.values():
+        if isinstance(value, list):
+            for v in value:
+                if isinstance(v, str):
+                    texts.append(v)
+        else:
+            texts.append(value)
+    return texts
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
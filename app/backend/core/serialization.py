@@ -0,0 +1,40 @@
+import dataclasses
+import json
+from typing import Any
+
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+def to_serializable(o: Any) -> Any:
+    """
+    Converts the objects the encoders don't know, like the ThoughtStep dataclasses, only one level deep.
+    Unlike dataclasses.asdict, the fields aren't copied, since the encoder walks into them anyway.
+    """
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return {field.name: getattr(o, field.name) for field in dataclasses.fields(o)}
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+# Built once, since json.dumps creates a new encoder on every call that passes options
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=to_serializable)
+
+
+def dumps(o: Any) -> str:
+    """Serializes o to compact JSON, with orjson when it's installed and the standard library otherwise."""
+    if HAS_ORJSON:
+        return orjson.dumps(o, default=to_serializable, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return _encoder.encode(o)
+
+
+def dumps_ndjson_line(o: Any) -> str:
+    """Serializes o as a line of newline-delimited JSON. Newlines inside strings are escaped by the encoders."""
+    if HAS_ORJSON:
+        return orjson.dumps(
+            o, default=to_serializable, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+        ).decode("utf-8")
+    return _encoder.encode(o) + "\n"
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+V = TypeVar("V")
+
+
+class SingleFlight(Generic[V]):
+    """
+    Coalesces concurrent calls for the same key, so that only one of them runs and every caller gets its result.
+    A caller that gets cancelled doesn't cancel the shared call for the other callers.
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, asyncio.Task[V]] = {}
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def start(self, key: Hashable, fn: Callable[[], Awaitable[V]]) -> "asyncio.Task[V]":
+        """
+        Returns the call in flight for the key, or starts a new one with fn.
+        The task is tracked until it completes, so it can also be used for fire-and-forget refreshes.
+        """
+        task = self.calls.get(key)
+        if task is None:
+
+            async def run() -> V:
+                return await fn()
+
+            task = asyncio.create_task(run())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.finish(key, done))
+        return task
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[V]]) -> V:
+        return await asyncio.shield(self.start(key, fn))
+
+    def finish(self, key: Hashable, task: "asyncio.Task[V]"):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # Retrieve the exception so it is logged even if every caller stopped waiting for the result
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug("Call for %s failed: %r", key, task.exception())
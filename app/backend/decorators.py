@@ -1,6 +1,6 @@
 import logging
 from functools import wraps
-from typing import Any, Callable, Dict
+from typing import Any, Callable
 
 from quart import abort, current_app, request
 
@@ -37,19 +37,20 @@ def authenticated_path(route_fn: Callable[[str], Any]):
     return auth_handler
 
 
-def authenticated(route_fn: Callable[[Dict[str, Any]], Any]):
+def authenticated(route_fn: Callable[..., Any]):
     """
-    Decorator for routes that might require access control. Unpacks Authorization header information into an auth_claims dictionary
+    Decorator for routes that might require access control. Unpacks Authorization header information into an auth_claims dictionary,
+    which is passed to the route before its URL variables
     """
 
     @wraps(route_fn)
-    async def auth_handler():
+    async def auth_handler(**kwargs):
         auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
         try:
             auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
         except AuthError:
             abort(403)
 
-        return await route_fn(auth_claims)
+        return await route_fn(auth_claims, **kwargs)
 
     return auth_handler
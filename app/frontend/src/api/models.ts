@@ -48,7 +48,8 @@ export type Thoughts = {
 export type ResponseContext = {
     data_points: string[];
     followup_questions: string[] | null;
-    thoughts: Thoughts[];
+    thoughts?: Thoughts[];
+    thoughts_id?: string;
 };
 
 export type ResponseChoice = {
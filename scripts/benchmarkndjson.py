@@ -0,0 +1,109 @@
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import timeit
+
+# The serializer and thought steps live in the backend app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+import core.serialization  # type: ignore[import-not-found]  # noqa: E402
+from approaches.approach import ThoughtStep  # type: ignore[import-not-found]  # noqa: E402
+from core.serialization import dumps_ndjson_line  # type: ignore[import-not-found]  # noqa: E402
+
+SOURCE = (
+    "Benefit_Options-3.pdf: Northwind Health Plus では、年に一度の眼科検診と、半年ごとの歯科検診がカバーされています。"
+    "ただし、コンタクトレンズの費用は一部自己負担となります。"
+)
+
+
+class LegacyJSONEncoder(json.JSONEncoder):
+    # What format_as_ndjson used to do: deep copy the dataclasses with asdict, with a new encoder for every chunk
+    def default(self, o):
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            return dataclasses.asdict(o)
+        return super().default(o)
+
+
+def legacy_dumps_ndjson_line(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False, cls=LegacyJSONEncoder) + "\n"
+
+
+def build_context_chunk(sources: int) -> dict:
+    results = [
+        {"id": f"file-{i}", "content": SOURCE * 4, "sourcepage": f"Benefit_Options-{i}.pdf", "score": 0.03}
+        for i in range(sources)
+    ]
+    return {
+        "choices": [
+            {
+                "delta": {"role": "assistant"},
+                "context": {
+                    "data_points": {"text": [SOURCE * 4] * sources},
+                    "thoughts": [
+                        ThoughtStep("Original user query", "眼科検診はカバーされていますか?"),
+                        ThoughtStep("Generated search query", "眼科検診 カバー", {"use_semantic_captions": False}),
+                        ThoughtStep("Results", results, {"search_cache_hit": False}),
+                        ThoughtStep("Prompt", [str({"role": "user", "content": SOURCE * 4 * sources})]),
+                    ],
+                },
+                "session_state": None,
+                "finish_reason": None,
+                "index": 0,
+            }
+        ],
+        "object": "chat.completion.chunk",
+    }
+
+
+def build_token_chunk() -> dict:
+    # The shape of ChatCompletionChunk.model_dump() for a single token
+    return {
+        "id": "chatcmpl-8Jv3Xh2mB4Y1Xu0Q3rVjQ3ZqZ7lbk",
+        "choices": [
+            {
+                "delta": {"content": "検診", "function_call": None, "role": None, "tool_calls": None},
+                "finish_reason": None,
+                "index": 0,
+                "logprobs": None,
+            }
+        ],
+        "created": 1699896916,
+        "model": "gpt-35-turbo",
+        "object": "chat.completion.chunk",
+        "system_fingerprint": None,
+    }
+
+
+def main(args: argparse.Namespace):
+    context_chunk = build_context_chunk(args.sources)
+    token_chunk = build_token_chunk()
+    print(f"Context chunk: {len(legacy_dumps_ndjson_line(context_chunk).encode('utf-8')) / 1024:.1f} KiB")
+
+    serializers = [("legacy", legacy_dumps_ndjson_line), ("json", dumps_ndjson_line)]
+    if core.serialization.HAS_ORJSON:
+        serializers.append(("orjson", dumps_ndjson_line))
+    for label, serialize in serializers:
+        core.serialization.HAS_ORJSON = label == "orjson"
+        timings = {}
+        for chunk_label, chunk in (("context", context_chunk), ("token", token_chunk)):
+            elapsed = min(timeit.repeat(lambda: serialize(chunk), number=args.iterations, repeat=5))
+            timings[chunk_label] = elapsed / args.iterations * 1_000_000
+        # The share of a second spent serializing, at the given chunk rate
+        overhead = (timings["context"] + timings["token"] * args.chunk_rate) / 10_000
+        print(
+            f"{label:>8}: context chunk {timings['context']:8.1f} µs, token chunk {timings['token']:6.1f} µs, "
+            f"{overhead:5.2f}% of a second at {args.chunk_rate} chunks/s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the time to serialize the chunks of a /chat stream with the legacy encoder, the standard library and orjson",
+        epilog="Example: benchmarkndjson.py --sources 5 --chunk-rate 100",
+    )
+    parser.add_argument("--sources", type=int, default=3, help="Number of sources in the context chunk")
+    parser.add_argument("--chunk-rate", type=int, default=60, help="Number of token chunks streamed per second")
+    parser.add_argument("--iterations", type=int, default=1000, help="Number of times each chunk is serialized per run")
+    main(parser.parse_args())
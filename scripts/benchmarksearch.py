@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import time
+from typing import Any, List, Optional, Union
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.identity.aio import AzureDeveloperCliCredential
+from azure.search.documents.aio import SearchClient
+
+# The fields the app's approaches need to build the sources, see Approach.get_select_fields
+SELECT_FIELDS = ["id", "content", "category", "sourcepage", "sourcefile"]
+
+
+async def run_query(
+    search_client: SearchClient, query: str, top: int, select: Optional[List[str]]
+) -> tuple[float, int]:
+    """Runs a single query and returns its latency in milliseconds and the size of the returned documents in bytes."""
+    start = time.perf_counter()
+    results = await search_client.search(search_text=query, top=top, select=select)
+    documents = [document async for document in results]
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000, len(json.dumps(documents, default=str).encode("utf-8"))
+
+
+async def benchmark(
+    service_name: str,
+    index_name: str,
+    credentials: Union[AsyncTokenCredential, AzureKeyCredential],
+    queries: List[str],
+    top: int,
+    iterations: int,
+):
+    async with SearchClient(
+        endpoint=f"https://{service_name}.search.windows.net", index_name=index_name, credential=credentials
+    ) as search_client:
+        # Warm up the connection so the first measurement doesn't include the TLS handshake
+        await run_query(search_client, queries[0], top, SELECT_FIELDS)
+
+        for label, select in (("all fields", None), ("selected fields", SELECT_FIELDS)):
+            latencies = []
+            sizes = []
+            for _ in range(iterations):
+                for query in queries:
+                    latency, size = await run_query(search_client, query, top, select)
+                    latencies.append(latency)
+                    sizes.append(size)
+            print(
+                f"{label:>16}: median latency {statistics.median(latencies):8.1f} ms, "
+                f"p95 latency {statistics.quantiles(latencies, n=20)[-1]:8.1f} ms, "
+                f"median payload {statistics.median(sizes) / 1024:8.1f} KiB"
+            )
+
+
+async def main(args: Any):
+    # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
+    azd_credential = (
+        AzureDeveloperCliCredential()
+        if args.tenant_id is None
+        else AzureDeveloperCliCredential(tenant_id=args.tenant_id, process_timeout=60)
+    )
+    search_credential: Union[AsyncTokenCredential, AzureKeyCredential] = azd_credential
+    if args.search_key is not None:
+        search_credential = AzureKeyCredential(args.search_key)
+
+    await benchmark(
+        service_name=args.search_service,
+        index_name=args.index,
+        credentials=search_credential,
+        queries=args.query,
+        top=args.top,
+        iterations=args.iterations,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the latency and payload size of search queries with and without field selection",
+        epilog="Example: benchmarksearch.py --search-service mysearch --index myindex --query 'What is included in my plan?'",
+    )
+    parser.add_argument("--search-service", required=True, help="Name of the Azure AI Search service")
+    parser.add_argument("--index", required=True, help="Name of the Azure AI Search index to query")
+    parser.add_argument(
+        "--search-key",
+        required=False,
+        help="Optional. Use this Azure AI Search account key instead of the current user identity to login (use az login to set current user for Azure)",
+    )
+    parser.add_argument(
+        "--query",
+        action="append",
+        default=None,
+        help="Query to run, can be repeated. Defaults to a few questions about the sample data",
+    )
+    parser.add_argument("--top", type=int, default=3, help="Number of documents to retrieve per query")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of times to run each query")
+    parser.add_argument(
+        "--tenant-id", required=False, help="Optional. Use this to define the Azure directory where to authenticate)"
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig()
+        logging.getLogger().setLevel(logging.INFO)
+    if not args.query:
+        args.query = [
+            "What is included in my Northwind Health Plus plan that is not in standard?",
+            "What happens in a performance review?",
+            "What does a Product Manager do?",
+        ]
+
+    asyncio.run(main(args))
@@ -0,0 +1,6 @@
+ #!/bin/sh
+
+. ./scripts/loadenv.sh
+
+echo "Running benchmarksearch.py. Arguments to script: $@"
+  ./scripts/.venv/bin/python ./scripts/benchmarksearch.py --search-service "$AZURE_SEARCH_SERVICE" --index "$AZURE_SEARCH_INDEX" $@
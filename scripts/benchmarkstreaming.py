@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from openai.types.chat import ChatCompletionChunk
+
+# The chat approaches live in the backend app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+from approaches.chatreadretrieveread import (  # type: ignore[import-not-found]  # noqa: E402
+    ChatReadRetrieveReadApproach,
+)
+
+TOKENS = [
+    "Northwind",
+    " Health",
+    " Plus",
+    " では",
+    "、",
+    "年に",
+    "一度",
+    "の",
+    "眼科",
+    "検診",
+    "が",
+    "カバー",
+    "されています",
+    "。",
+]
+CONTENT_FILTER_RESULTS = {
+    category: {"filtered": False, "severity": "safe"} for category in ("hate", "self_harm", "sexual", "violence")
+}
+
+
+def record_stream(chunks: int) -> list[dict]:
+    """Builds the chunks of a streamed answer, shaped like the ones Azure OpenAI sends."""
+    base = {"id": "chatcmpl-8Jv3Xh2mB4Y1Xu0Q3rVjQ3ZqZ7lbk", "object": "chat.completion.chunk", "created": 1699896916}
+    stream = [{**base, "model": "", "choices": [], "prompt_filter_results": [{"prompt_index": 0}]}]
+    stream.append(
+        {
+            **base,
+            "model": "gpt-35-turbo",
+            "choices": [{"delta": {"role": "assistant", "content": ""}, "index": 0, "finish_reason": None}],
+        }
+    )
+    for i in range(chunks - 3):
+        stream.append(
+            {
+                **base,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "delta": {"content": TOKENS[i % len(TOKENS)]},
+                        "index": 0,
+                        "finish_reason": None,
+                        "content_filter_results": CONTENT_FILTER_RESULTS,
+                    }
+                ],
+            }
+        )
+    stream.append({**base, "model": "gpt-35-turbo", "choices": [{"delta": {}, "index": 0, "finish_reason": "stop"}]})
+    return stream
+
+
+class BenchmarkApproach(ChatReadRetrieveReadApproach):
+    def __init__(self, chunks: list[ChatCompletionChunk]):
+        super().__init__(
+            search_client=None,
+            auth_helper=None,
+            openai_client=None,
+            chatgpt_model="gpt-35-turbo",
+            chatgpt_deployment="chat",
+            embedding_deployment="embeddings",
+            embedding_model="text-embedding-ada-002",
+            sourcepage_field="sourcepage",
+            content_field="content",
+            query_language="en-us",
+            query_speller="lexicon",
+        )
+        self.chunks = chunks
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def run_until_final_call(self, history, overrides, auth_claims, should_stream):
+        async def chat_coroutine():
+            return self.stream()
+
+        return {"thoughts": []}, chat_coroutine()
+
+
+async def legacy_stream(approach: BenchmarkApproach):
+    # What run_with_streaming used to do for every chunk
+    async for event_chunk in approach.stream():
+        event = event_chunk.model_dump()
+        if event["choices"]:
+            yield event
+
+
+async def consume(events) -> int:
+    count = 0
+    async for _ in events:
+        count += 1
+    return count
+
+
+async def main(args: argparse.Namespace):
+    chunks = [ChatCompletionChunk.model_validate(chunk) for chunk in record_stream(args.chunks)]
+    approach = BenchmarkApproach(chunks)
+    history = [{"role": "user", "content": "眼科検診はカバーされていますか?"}]
+    runs = {
+        "model_dump": lambda: legacy_stream(approach),
+        "typed": lambda: approach.run_with_streaming(history, {}, {}),
+        "typed + follow-ups": lambda: approach.run_with_streaming(history, {"suggest_followup_questions": True}, {}),
+    }
+    print(f"Streaming {len(chunks)} chunks")
+    for label, run in runs.items():
+        timings = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            await consume(run())
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(f"{label:>18}: {best * 1000:8.2f} ms per stream, {best / len(chunks) * 1_000_000:6.2f} µs per chunk")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the time to turn the chunks of a streamed answer into events with model_dump and from the typed chunks",
+        epilog="Example: benchmarkstreaming.py --chunks 1000",
+    )
+    parser.add_argument("--chunks", type=int, default=1000, help="Number of chunks in the streamed answer")
+    parser.add_argument("--iterations", type=int, default=20, help="Number of times the stream is processed")
+    asyncio.run(main(parser.parse_args()))
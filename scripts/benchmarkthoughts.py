@@ -0,0 +1,95 @@
+import argparse
+import os
+import sys
+import timeit
+
+# The approaches and the serializer live in the backend app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+from approaches.approach import Approach, ThoughtStep  # type: ignore[import-not-found]  # noqa: E402
+from core.cache import TTLCache  # type: ignore[import-not-found]  # noqa: E402
+from core.serialization import dumps  # type: ignore[import-not-found]  # noqa: E402
+
+SOURCE = (
+    "Benefit_Options-3.pdf: Northwind Health Plus では、年に一度の眼科検診と、半年ごとの歯科検診がカバーされています。"
+    "ただし、コンタクトレンズの費用は一部自己負担となります。"
+)
+
+
+def build_extra_info(sources: int) -> dict:
+    # The context of a /chat answer, with the search results and the prompt repeated in the thoughts
+    results = [
+        {"id": f"file-{i}", "content": SOURCE * 4, "sourcepage": f"Benefit_Options-{i}.pdf", "score": 0.03}
+        for i in range(sources)
+    ]
+    return {
+        "data_points": {"text": [SOURCE * 4] * sources},
+        "thoughts": [
+            ThoughtStep("Original user query", "眼科検診はカバーされていますか?"),
+            ThoughtStep("Generated search query", "眼科検診 カバー", {"use_semantic_captions": False}),
+            ThoughtStep("Results", results, {"search_cache_hit": False}),
+            ThoughtStep("Prompt", [str({"role": "user", "content": SOURCE * 4 * sources})]),
+        ],
+    }
+
+
+def build_response(context: dict) -> dict:
+    return {
+        "id": "chatcmpl-8Jv3Xh2mB4Y1Xu0Q3rVjQ3ZqZ7lbk",
+        "choices": [
+            {
+                "message": {
+                    "content": "年に一度の眼科検診がカバーされています [Benefit_Options-3.pdf]。",
+                    "role": "assistant",
+                },
+                "context": context,
+                "session_state": None,
+                "finish_reason": "stop",
+                "index": 0,
+            }
+        ],
+        "object": "chat.completion",
+    }
+
+
+def main(args: argparse.Namespace):
+    extra_info = build_extra_info(args.sources)
+    approach = Approach(
+        search_client=None,
+        openai_client=None,
+        auth_helper=None,
+        query_language=None,
+        query_speller=None,
+        embedding_deployment=None,
+        embedding_model="text-embedding-ada-002",
+        openai_host="azure",
+        thoughts_store=TTLCache(maxsize=args.iterations * 10, ttl=300),
+    )
+    full_size = 0
+    for mode in Approach.THOUGHTS_MODES:
+        overrides = {"thoughts_mode": mode}
+        response = build_response(approach.get_response_context(extra_info, overrides, {"oid": "OID_X"}))
+        size = len(dumps(response).encode("utf-8"))
+        full_size = full_size or size
+        # Time everything done per answer, including storing the deferred thoughts
+        elapsed = min(
+            timeit.repeat(
+                lambda: dumps(build_response(approach.get_response_context(extra_info, overrides, {"oid": "OID_X"}))),
+                number=args.iterations,
+                repeat=5,
+            )
+        )
+        print(
+            f"{mode:>8}: {size / 1024:6.1f} KiB ({size / full_size:4.0%} of full), "
+            f"{elapsed / args.iterations * 1_000_000:7.1f} µs to build and serialize"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the size and serialization time of a /chat response with full, no and deferred thoughts",
+        epilog="Example: benchmarkthoughts.py --sources 5",
+    )
+    parser.add_argument("--sources", type=int, default=3, help="Number of sources in the context")
+    parser.add_argument("--iterations", type=int, default=1000, help="Number of times each response is built per run")
+    main(parser.parse_args())
@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import timeit
+
+import tiktoken
+
+# The token counting helpers live in the backend app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+from core.modelhelper import (  # type: ignore[import-not-found]  # noqa: E402
+    get_encoding,
+    get_oai_chatmodel_tiktok,
+    num_tokens_from_messages,
+    num_tokens_from_messages_batch,
+)
+
+SAMPLE_TURNS = [
+    ("user", "私の健康保険プランでは、眼科検診と歯科検診はカバーされていますか?詳しく教えてください。"),
+    (
+        "assistant",
+        "Northwind Health Plus プランでは、年に一度の眼科検診と、半年ごとの歯科検診がカバーされています [Benefit_Options-3.pdf]。"
+        "ただし、コンタクトレンズの費用は一部自己負担となります [Benefit_Options-4.pdf]。",
+    ),
+    ("user", "パフォーマンスレビューではどのようなことが行われますか?"),
+    (
+        "assistant",
+        "パフォーマンスレビューでは、上司と一緒に過去一年間の目標の達成度を振り返り、翌年の目標を設定します "
+        "[employee_handbook-3.pdf]。フィードバックは双方向で行われます。",
+    ),
+]
+
+
+def build_history(turns: int) -> list[dict[str, str]]:
+    return [
+        {"role": role, "content": content}
+        for role, content in (SAMPLE_TURNS[i % len(SAMPLE_TURNS)] for i in range(turns))
+    ]
+
+
+def count_uncached(history: list[dict[str, str]], model: str) -> list[int]:
+    # What num_tokens_from_messages used to do: resolve the encoding again for every message
+    counts = []
+    for message in history:
+        encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+        counts.append(2 + sum(len(encoding.encode(value)) for value in message.values()))
+    return counts
+
+
+def count_cached(history: list[dict[str, str]], model: str) -> list[int]:
+    return [num_tokens_from_messages(message, model) for message in history]
+
+
+def count_batch(history: list[dict[str, str]], model: str) -> list[int]:
+    return num_tokens_from_messages_batch(history, model)
+
+
+def main(args: argparse.Namespace):
+    history = build_history(args.turns)
+    get_encoding(args.model)  # Load the encoding file before measuring
+    expected = count_uncached(history, args.model)
+    print(f"Counting the tokens of {len(history)} messages ({sum(expected)} tokens) with {args.model}")
+    for label, count in (("uncached", count_uncached), ("cached", count_cached), ("batch", count_batch)):
+        assert count(history, args.model) == expected
+        elapsed = min(timeit.repeat(lambda: count(history, args.model), number=args.iterations, repeat=5))
+        print(f"{label:>10}: {elapsed / args.iterations * 1000:8.2f} ms per history")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the time to count the tokens of a long chat history with and without the cached encodings and batch counting",
+        epilog="Example: benchmarktokens.py --turns 200",
+    )
+    parser.add_argument("--model", default="gpt-35-turbo", help="Chat model whose encoding is used")
+    parser.add_argument("--turns", type=int, default=100, help="Number of messages in the history")
+    parser.add_argument("--iterations", type=int, default=20, help="Number of times the history is counted per run")
+    main(parser.parse_args())
@@ -1,7 +1,9 @@
 import datetime
 import io
+import json
 import os
 import re
+import uuid
 from typing import List, Optional, Union
 
 import fitz  # type: ignore
@@ -19,6 +21,9 @@ class BlobManager:
     Class to manage uploading and deleting blobs containing citation information from a blob storage account
     """
 
+    # The backend polls this blob and clears its search results cache when it changes, see app/backend/core/indexversion.py
+    INDEX_VERSION_BLOB_NAME = "index-version.json"
+
     def __init__(
         self,
         endpoint: str,
@@ -145,6 +150,23 @@ class BlobManager:
                     print(f"\tRemoving blob {blob_path}")
                 await container_client.delete_blob(blob_path)
 
+    async def update_index_version(self):
+        """
+        Writes a new index version marker, so that running backends know the index content changed.
+        """
+        async with BlobServiceClient(
+            account_url=self.endpoint, credential=self.credential
+        ) as service_client, service_client.get_container_client(self.container) as container_client:
+            if not await container_client.exists():
+                await container_client.create_container()
+            version = {
+                "version": str(uuid.uuid4()),
+                "updated": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }
+            if self.verbose:
+                print(f"\tUpdating index version -> {version['version']}")
+            await container_client.upload_blob(self.INDEX_VERSION_BLOB_NAME, json.dumps(version), overwrite=True)
+
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
         if os.path.splitext(filename)[1].lower() == ".pdf":
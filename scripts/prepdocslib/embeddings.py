@@ -1,3 +1,5 @@
+import functools
+import os
 from abc import ABC
 from typing import Awaitable, Callable, List, Optional, Union
 from urllib.parse import urljoin
@@ -47,9 +49,19 @@ class OpenAIEmbeddings(ABC):
         if self.verbose:
             print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
+    @functools.cached_property
+    def encoding(self) -> tiktoken.Encoding:
+        return tiktoken.encoding_for_model(self.open_ai_model_name)
+
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        return len(self.encoding.encode(text))
+
+    def calculate_token_lengths(self, texts: List[str]) -> List[int]:
+        """Calculates the token length of many texts, encoding them on a pool of threads when there are several CPUs"""
+        num_threads = min(8, os.cpu_count() or 1)
+        if num_threads < 2:
+            return [self.calculate_token_length(text) for text in texts]
+        return [len(tokens) for tokens in self.encoding.encode_batch(texts, num_threads=num_threads)]
 
     def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
@@ -63,8 +75,7 @@ class OpenAIEmbeddings(ABC):
         batches: List[EmbeddingBatch] = []
         batch: List[str] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        for text, text_token_length in zip(texts, self.calculate_token_lengths(texts)):
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
                 batches.append(EmbeddingBatch(batch, batch_token_length))
                 batch = []
@@ -1,6 +1,7 @@
 import argparse
 import json
 import os
+import time
 from unittest import mock
 
 import aiohttp
@@ -46,7 +47,7 @@ MockSearchIndex = SearchIndex(
 
 async def mock_search(self, *args, **kwargs):
     self.filter = kwargs.get("filter")
-    return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
+    return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"), kwargs.get("select"))
 
 
 @pytest.fixture
@@ -65,6 +66,12 @@ def mock_compute_embeddings_call(monkeypatch):
     monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
 
 
+@pytest.fixture
+def mock_perf_counter(monkeypatch):
+    # Keep the latencies reported in thoughts stable in the snapshot tests that include them
+    monkeypatch.setattr(time, "perf_counter", lambda: 0.0)
+
+
 @pytest.fixture
 def mock_openai_embedding(monkeypatch):
     async def mock_acreate(*args, **kwargs):
@@ -176,7 +183,7 @@ def mock_openai_chatcompletion(monkeypatch):
             answer = "From the provided sources, the impact of interest rates and GDP growth on financial markets can be observed through the line graph. [Financial Market Analysis Report 2023-7.png]"
         else:
             answer = "The capital of France is Paris. [Benefit_Options-2.pdf]."
-            if messages[0]["content"].find("Generate 3 very brief follow-up questions") > -1:
+            if messages[0]["content"].find("three additional follow-up questions") > -1:
                 answer = "The capital of France is Paris. [Benefit_Options-2.pdf]. <<What is the capital of Spain?>>"
         if "stream" in kwargs and kwargs["stream"] is True:
             return AsyncChatCompletionIterator(answer)
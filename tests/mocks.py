@@ -62,7 +62,7 @@ class MockCaption:
 
 
 class MockAsyncSearchResultsIterator:
-    def __init__(self, search_text, vector_queries: Optional[list[VectorQuery]]):
+    def __init__(self, search_text, vector_queries: Optional[list[VectorQuery]], select: Optional[list[str]] = None):
         if search_text == "interest rates" or (
             vector_queries and any([vector.fields == "imageEmbedding" for vector in vector_queries])
         ):
@@ -121,6 +121,15 @@ class MockAsyncSearchResultsIterator:
                     },
                 ]
             ]
+        if select:
+            # Like the search service, only return the selected fields along with the search metadata
+            self.data = [
+                [
+                    {key: value for key, value in document.items() if key in select or key.startswith("@search.")}
+                    for document in page
+                ]
+                for page in self.data
+            ]
 
     def __aiter__(self):
         return self
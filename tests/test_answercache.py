@@ -0,0 +1,92 @@
+import time
+
+from core.answercache import SemanticAnswerCache
+
+
+def test_answercache_get_set():
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=10, ttl=60, min_similarity=0.9)
+    assert cache.get("scope", [1.0, 0.0]) is None
+    cache.set("scope", [1.0, 0.0], "A")
+    cache.set("scope", [0.0, 1.0], "B")
+
+    # The vectors are compared by direction, not length
+    assert cache.get("scope", [2.0, 0.0]) == ("A", 1.0)
+    value, similarity = cache.get("scope", [1.0, 0.2])
+    assert value == "A"
+    assert 0.98 < similarity < 0.99
+    # Halfway between both entries isn't similar enough to either
+    assert cache.get("scope", [1.0, 1.0]) is None
+    assert cache.stats() == {"size": 2, "scopes": 1, "maxsize": 10, "hits": 2, "misses": 2, "hit_rate": 0.5}
+
+
+def test_answercache_scopes():
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=10, ttl=60)
+    cache.set("oids/any(g:search.in(g, 'OID_X'))", [1.0, 0.0], "A")
+
+    assert cache.get("oids/any(g:search.in(g, 'OID_Y'))", [1.0, 0.0]) is None
+    assert cache.get("oids/any(g:search.in(g, 'OID_X'))", [1.0, 0.0]) == ("A", 1.0)
+
+
+def test_answercache_evicts_oldest_across_scopes():
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=2, ttl=60)
+    cache.set("a", [1.0, 0.0], "A")
+    cache.set("b", [1.0, 0.0], "B")
+    cache.set("a", [0.0, 1.0], "C")
+
+    assert cache.get("a", [1.0, 0.0]) is None
+    assert cache.get("a", [0.0, 1.0]) == ("C", 1.0)
+    assert cache.get("b", [1.0, 0.0]) == ("B", 1.0)
+    assert len(cache) == 2
+
+
+def test_answercache_dimension_change():
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=10, ttl=60)
+    cache.set("scope", [1.0, 0.0], "A")
+
+    # Like after switching to an embedding model with another dimension
+    assert cache.get("scope", [1.0, 0.0, 0.0]) is None
+    cache.set("scope", [1.0, 0.0, 0.0], "B")
+    assert cache.get("scope", [1.0, 0.0, 0.0]) == ("B", 1.0)
+    assert cache.get("scope", [1.0, 0.0]) is None
+    assert len(cache) == 1
+
+
+def test_answercache_grows_partitions():
+    cache: SemanticAnswerCache[int] = SemanticAnswerCache(maxsize=100, ttl=60, min_similarity=0.9999)
+    vectors = [[1.0, i / 10] for i in range(40)]
+    for i, vector in enumerate(vectors):
+        cache.set("scope", vector, i)
+
+    assert [cache.get("scope", vector)[0] for vector in vectors] == list(range(40))
+
+
+def test_answercache_expires(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=10, ttl=60)
+    cache.set("scope", [1.0, 0.0], "A")
+    monkeypatch.setattr(time, "monotonic", lambda: now + 30)
+    cache.set("scope", [0.0, 1.0], "B")
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+
+    assert cache.get("scope", [1.0, 0.0]) is None
+    assert cache.get("scope", [0.0, 1.0]) == ("B", 1.0)
+    assert len(cache) == 1
+
+
+def test_answercache_disabled():
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=0, ttl=60)
+    cache.set("scope", [1.0, 0.0], "A")
+    assert cache.get("scope", [1.0, 0.0]) is None
+    assert len(cache) == 0
+
+
+def test_answercache_clear():
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=10, ttl=60)
+    cache.set("scope", [1.0, 0.0], "A")
+    # A vector without a direction can't be compared
+    cache.set("scope", [0.0, 0.0], "B")
+    assert len(cache) == 1
+    cache.clear()
+    assert cache.get("scope", [1.0, 0.0]) is None
+    assert cache.stats()["scopes"] == 0
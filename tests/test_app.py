@@ -9,6 +9,8 @@ from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from approaches.approach import ThoughtStep
+from core.cachebackends import CacheBackendFactory
 
 
 def fake_response(http_code):
@@ -280,6 +282,7 @@ async def test_chat_handle_exception_contentsafety_streaming(client, monkeypatch
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_text(client, snapshot):
     response = await client.post(
         "/chat",
@@ -296,6 +299,243 @@ async def test_chat_text(client, snapshot):
 
 
 @pytest.mark.asyncio
+async def test_chat_text_search_cache(client):
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"retrieval_mode": "text"},
+        },
+    }
+    response = await client.post("/chat", json=request_json)
+    result = await response.get_json()
+    assert result["choices"][0]["context"]["thoughts"][2]["props"]["search_cache_hit"] is False
+
+    response = await client.post("/chat", json=request_json)
+    result = await response.get_json()
+    assert result["choices"][0]["context"]["thoughts"][2]["props"]["search_cache_hit"] is True
+
+
+@pytest.mark.asyncio
+async def test_chat_text_skip_query_rewrite(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "query_rewrite_mode": "heuristic"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    thoughts = result["choices"][0]["context"]["thoughts"]
+    assert thoughts[1]["description"] == "What is the capital of France?"
+    assert thoughts[1]["props"]["query_rewrite"] == "skipped"
+    assert thoughts[1]["props"]["query_rewrite_reason"] == "first_turn"
+
+
+@pytest.mark.asyncio
+async def test_chat_hybrid_speculative_retrieval(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "hybrid", "speculative_retrieval": True},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    thoughts = result["choices"][0]["context"]["thoughts"]
+    assert thoughts[1]["description"] == "capital of France"
+    # The mock embeddings are the same for every text
+    assert thoughts[1]["props"]["speculative_retrieval"] == "hit_similar"
+    assert thoughts[1]["props"]["speculative_query"] == "What is the capital of France?"
+    assert thoughts[1]["props"]["speculative_similarity"] == 1.0
+    assert "speculative_saved_ms" in thoughts[1]["props"]
+    assert len(thoughts[2]["description"]) > 0
+
+
+@pytest.mark.asyncio
+async def test_chat_text_thoughts_none(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "thoughts_mode": "none"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    context = result["choices"][0]["context"]
+    assert "thoughts" not in context
+    assert "thoughts_id" not in context
+    assert context["data_points"]["text"]
+
+
+def share_thoughts_store(config, tmp_path):
+    # Deferring the thoughts needs a cache backend shared by the workers
+    thoughts_store = config[app.CONFIG_THOUGHTS_STORE]
+    thoughts_store.backend = CacheBackendFactory(
+        "sqlite", sqlite_path=str(tmp_path / "cache.sqlite3"), signing_key="test-key", value_types=[ThoughtStep]
+    ).create("thoughts", 10)
+    thoughts_store.maxsize = 10
+
+
+@pytest.mark.asyncio
+async def test_chat_text_thoughts_deferred_memory(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "thoughts_mode": "deferred"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    context = (await response.get_json())["choices"][0]["context"]
+    # Another worker couldn't serve the thoughts from memory, so they're left out
+    assert "thoughts" not in context
+    assert "thoughts_id" not in context
+
+
+@pytest.mark.asyncio
+async def test_chat_text_thoughts_deferred(client, tmp_path):
+    share_thoughts_store(client.app.config, tmp_path)
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "thoughts_mode": "deferred"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    context = result["choices"][0]["context"]
+    assert "thoughts" not in context
+
+    response = await client.get(f"/thoughts/{context['thoughts_id']}")
+    assert response.status_code == 200
+    thoughts = (await response.get_json())["thoughts"]
+    assert thoughts[0]["title"] == "Original user query"
+    assert thoughts[0]["description"] == "What is the capital of France?"
+
+    response = await client.get("/thoughts/unknown")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_text_thoughts_deferred_filter(auth_client, tmp_path):
+    share_thoughts_store(auth_client.config, tmp_path)
+    response = await auth_client.post(
+        "/chat",
+        headers={"Authorization": "Bearer MockToken"},
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "thoughts_mode": "deferred"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    context = events[0]["choices"][0]["context"]
+    assert "thoughts" not in context
+
+    response = await auth_client.get(
+        f"/thoughts/{context['thoughts_id']}", headers={"Authorization": "Bearer MockToken"}
+    )
+    assert response.status_code == 200
+    assert (await response.get_json())["thoughts"][0]["title"] == "Original user query"
+
+    # The thoughts of another user's question can't be fetched
+    auth_client.config[app.CONFIG_THOUGHTS_STORE].set("other", {"oid": "OID_OTHER", "thoughts": []})
+    response = await auth_client.get("/thoughts/other", headers={"Authorization": "Bearer MockToken"})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_ask_answer_cache(client):
+    client.app.config[app.CONFIG_ANSWER_CACHE].maxsize = 10
+
+    async def ask(question, overrides):
+        response = await client.post(
+            "/ask", json={"messages": [{"content": question, "role": "user"}], "context": {"overrides": overrides}}
+        )
+        assert response.status_code == 200
+        return (await response.get_json())["choices"][0]
+
+    first = await ask("What is the capital of France?", {"retrieval_mode": "text"})
+    assert first["context"]["thoughts"][-1]["title"] != "Answer cache hit"
+
+    # The mock embeddings are the same for every text, so a rephrased question gets the cached answer
+    cached = await ask("Which city is the capital of France?", {"retrieval_mode": "text"})
+    assert cached["message"]["content"] == first["message"]["content"]
+    assert cached["context"]["data_points"] == first["context"]["data_points"]
+    assert cached["context"]["thoughts"][-1] == {
+        "title": "Answer cache hit",
+        "description": "What is the capital of France?",
+        "props": {"answer_cache_hit": True, "similarity": 1.0},
+    }
+
+    cached = await ask("Which city is the capital of France?", {"retrieval_mode": "text", "thoughts_mode": "none"})
+    assert "thoughts" not in cached["context"]
+
+    # Other filters or settings have their own answers
+    other = await ask("What is the capital of France?", {"retrieval_mode": "text", "exclude_category": "excluded"})
+    assert other["context"]["thoughts"][-1]["title"] != "Answer cache hit"
+    other = await ask("What is the capital of France?", {"retrieval_mode": "text", "top": 1})
+    assert other["context"]["thoughts"][-1]["title"] != "Answer cache hit"
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_answer_cache(client):
+    client.app.config[app.CONFIG_ANSWER_CACHE].maxsize = 10
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text"}},
+    }
+
+    response = await client.post("/chat", json=request_json)
+    first = (await response.get_json())["choices"][0]
+    assert first["context"]["thoughts"][-1]["title"] != "Answer cache hit"
+
+    # The answer cached for the non-streaming request is replayed as a stream
+    response = await client.post("/chat", json={**request_json, "stream": True})
+    assert response.mimetype == "application/json-lines"
+    replayed = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert replayed[0]["choices"][0]["context"]["thoughts"][-1]["title"] == "Answer cache hit"
+    assert replayed[0]["choices"][0]["context"]["data_points"] == first["context"]["data_points"]
+    assert "".join(event["choices"][0]["delta"].get("content") or "" for event in replayed[1:]) == (
+        first["message"]["content"]
+    )
+    assert replayed[-1]["choices"][0]["finish_reason"] == "stop"
+
+    # Follow-up turns depend on the conversation, so they're never served from the cache
+    response = await client.post(
+        "/chat",
+        json={
+            **request_json,
+            "messages": [
+                {"content": "What is the capital of France?", "role": "user"},
+                {"content": "The capital of France is Paris. [Benefit_Options-2.pdf].", "role": "assistant"},
+                {"content": "What is the capital of France?", "role": "user"},
+            ],
+        },
+    )
+    result = await response.get_json()
+    assert result["choices"][0]["context"]["thoughts"][-1]["title"] != "Answer cache hit"
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_text_filter(auth_client, snapshot):
     response = await auth_client.post(
         "/chat",
@@ -322,6 +562,7 @@ async def test_chat_text_filter(auth_client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_text_semanticranker(client, snapshot):
     response = await client.post(
         "/chat",
@@ -338,6 +579,7 @@ async def test_chat_text_semanticranker(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_text_semanticcaptions(client, snapshot):
     response = await client.post(
         "/chat",
@@ -354,6 +596,7 @@ async def test_chat_text_semanticcaptions(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_prompt_template(client, snapshot):
     response = await client.post(
         "/chat",
@@ -370,6 +613,7 @@ async def test_chat_prompt_template(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_prompt_template_concat(client, snapshot):
     response = await client.post(
         "/chat",
@@ -386,6 +630,7 @@ async def test_chat_prompt_template_concat(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_hybrid(client, snapshot):
     response = await client.post(
         "/chat",
@@ -402,6 +647,7 @@ async def test_chat_hybrid(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_vector(client, snapshot):
     response = await client.post(
         "/chat",
@@ -418,6 +664,7 @@ async def test_chat_vector(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_stream_text(client, snapshot):
     response = await client.post(
         "/chat",
@@ -435,6 +682,7 @@ async def test_chat_stream_text(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_stream_text_filter(auth_client, snapshot):
     response = await auth_client.post(
         "/chat",
@@ -462,6 +710,7 @@ async def test_chat_stream_text_filter(auth_client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_with_history(client, snapshot):
     response = await client.post(
         "/chat",
@@ -486,6 +735,7 @@ async def test_chat_with_history(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_with_long_history(client, snapshot, caplog):
     """This test makes sure that the history is truncated to max tokens minus 1024."""
     caplog.set_level(logging.DEBUG)
@@ -515,6 +765,7 @@ async def test_chat_with_long_history(client, snapshot, caplog):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_session_state_persists(client, snapshot):
     response = await client.post(
         "/chat",
@@ -532,6 +783,7 @@ async def test_chat_session_state_persists(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_stream_session_state_persists(client, snapshot):
     response = await client.post(
         "/chat",
@@ -550,6 +802,7 @@ async def test_chat_stream_session_state_persists(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_followup(client, snapshot):
     response = await client.post(
         "/chat",
@@ -568,6 +821,7 @@ async def test_chat_followup(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_stream_followup(client, snapshot):
     response = await client.post(
         "/chat",
@@ -581,10 +835,17 @@ async def test_chat_stream_followup(client, snapshot):
     )
     assert response.status_code == 200
     result = await response.get_data()
+    # The follow-up questions come in their own event, and not in the content of the answer
+    events = [json.loads(line) for line in result.splitlines()]
+    assert [event["choices"][0]["context"] for event in events if "context" in event["choices"][0]][1] == {
+        "followup_questions": ["What is the capital of Spain?"]
+    }
+    assert "<<" not in "".join(event["choices"][0]["delta"].get("content") or "" for event in events)
     snapshot.assert_match(result, "result.jsonlines")
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_vision(client, snapshot):
     response = await client.post(
         "/chat",
@@ -605,6 +866,7 @@ async def test_chat_vision(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_chat_vision_vectors(client, snapshot):
     response = await client.post(
         "/chat",
@@ -626,6 +888,7 @@ async def test_chat_vision_vectors(client, snapshot):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_perf_counter")
 async def test_ask_vision(client, snapshot):
     response = await client.post(
         "/ask",
@@ -645,11 +908,61 @@ async def test_ask_vision(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_stream_text(client):
+    response = await client.post(
+        "/ask",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    # The context comes first, then the deltas of the answer
+    assert events[0]["choices"][0]["context"]["thoughts"][0]["title"] == "Search Query"
+    assert events[0]["choices"][0]["context"]["data_points"]["text"]
+    assert "".join(event["choices"][0]["delta"]["content"] or "" for event in events[1:]) == (
+        "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    )
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_vision(client):
+    response = await client.post(
+        "/ask",
+        json={
+            "stream": True,
+            "messages": [{"content": "Are interest rates high?", "role": "user"}],
+            "context": {
+                "overrides": {
+                    "use_gpt4v": True,
+                    "gpt4v_input": "textAndImages",
+                    "vector_fields": ["embedding", "imageEmbedding"],
+                },
+            },
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0]["choices"][0]["context"]["thoughts"][0]["title"] == "Search Query"
+    assert "".join(event["choices"][0]["delta"]["content"] or "" for event in events[1:])
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson():
     async def gen():
         yield {"a": "I ❤️ 🐍"}
         yield {"b": "Newlines inside \n strings are fine"}
+        yield {"thoughts": [ThoughtStep("Search query", "capital of France", {"top": 3})]}
 
     result = [line async for line in app.format_as_ndjson(gen())]
-    assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+    assert result == [
+        '{"a":"I ❤️ 🐍"}\n',
+        '{"b":"Newlines inside \\n strings are fine"}\n',
+        '{"thoughts":[{"title":"Search query","description":"capital of France","props":{"top":3}}]}\n',
+    ]
@@ -2,6 +2,7 @@ import os
 from unittest import mock
 
 import pytest
+import quart.testing.app
 from azure.keyvault.secrets.aio import SecretClient
 
 import app
@@ -31,6 +32,26 @@ async def test_app_local_openai(monkeypatch, minimal_env):
         assert quart_app.config[app.CONFIG_OPENAI_CLIENT].base_url == "http://localhost:5000"
 
 
+@pytest.mark.asyncio
+async def test_app_shared_http_session(monkeypatch, minimal_env, mock_get_secret):
+    monkeypatch.setenv("USE_GPT4V", "true")
+    monkeypatch.setenv("AZURE_OPENAI_GPT4V_MODEL", "gpt-4")
+    monkeypatch.setenv("AZURE_KEY_VAULT_NAME", "my_key_vault")
+    monkeypatch.setenv("VISION_SECRET_NAME", "vision-secret-name")
+    monkeypatch.setenv("HTTP_POOL_SIZE", "10")
+    monkeypatch.setenv("HTTP_POOL_SIZE_PER_HOST", "2")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        http_session = quart_app.config[app.CONFIG_HTTP_SESSION]
+        assert http_session.connector.limit == 10
+        assert http_session.connector.limit_per_host == 2
+        assert quart_app.config[app.CONFIG_AUTH_CLIENT].http_session is http_session
+        assert quart_app.config[app.CONFIG_ASK_VISION_APPROACH].http_session is http_session
+        assert quart_app.config[app.CONFIG_CHAT_VISION_APPROACH].http_session is http_session
+    assert http_session.closed
+
+
 @pytest.mark.asyncio
 async def test_app_config_default(monkeypatch, minimal_env):
     quart_app = app.create_app()
@@ -144,3 +165,19 @@ async def test_app_searchkey_notfound(monkeypatch, minimal_env):
     quart_app = app.create_app()
     async with quart_app.test_app() as test_app:
         test_app.test_client()
+
+
+@pytest.mark.asyncio
+async def test_app_thoughts_deferred(monkeypatch, minimal_env, tmp_path):
+    monkeypatch.setenv("THOUGHTS_MODE", "deferred")
+    quart_app = app.create_app()
+    with pytest.raises(quart.testing.app.LifespanError, match="needs a CACHE_BACKEND shared by the workers"):
+        async with quart_app.test_app():
+            pass
+
+    monkeypatch.setenv("CACHE_BACKEND", "sqlite")
+    monkeypatch.setenv("CACHE_SQLITE_PATH", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setenv("CACHE_SIGNING_KEY", "test-key")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_THOUGHTS_STORE].enabled
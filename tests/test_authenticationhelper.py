@@ -1,7 +1,18 @@
+import argparse
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import aiohttp
+import msal
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
 
 from core.authentication import AuthenticationHelper, AuthError
 
@@ -220,7 +231,7 @@ async def test_check_path_auth_denied(monkeypatch, mock_confidential_client_succ
     )
     assert (
         filter
-        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z'))) and (sourcepage eq 'Benefit_Options-2.pdf')"
+        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z'))) and (sourcepage eq 'Benefit_Options-2.pdf' or sourcefile eq 'Benefit_Options-2.pdf')"
     )
 
 
@@ -246,7 +257,7 @@ async def test_check_path_auth_allowed(monkeypatch, mock_confidential_client_suc
     )
     assert (
         filter
-        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z'))) and (sourcepage eq 'Benefit_Options-2.pdf')"
+        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z'))) and (sourcepage eq 'Benefit_Options-2.pdf' or sourcefile eq 'Benefit_Options-2.pdf')"
     )
 
 
@@ -277,3 +288,420 @@ async def test_check_path_auth_allowed_without_access_control(
     )
     assert filter is None
     assert called_search is False
+
+
+@pytest.mark.asyncio
+async def test_list_groups_shared_session(mock_list_groups_success):
+    async with aiohttp.ClientSession() as session:
+        groups = await AuthenticationHelper.list_groups(
+            graph_resource_access_token={"access_token": "MockToken"}, http_session=session
+        )
+        assert groups == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
+        # The shared session is left open for the next request
+        assert not session.closed
+
+
+def create_signed_token(private_key, kid: str, expires_in: int = 3600):
+    return jwt.encode(
+        {
+            "iss": "https://login.microsoftonline.com/TENANT_ID/v2.0",
+            "aud": "SERVER_APP",
+            "oid": "OID_X",
+            "exp": int(time.time()) + expires_in,
+        },
+        private_key,
+        algorithm="RS256",
+        headers={"kid": kid},
+    )
+
+
+@pytest.fixture
+def signing_keys(monkeypatch):
+    private_keys = {}
+    jwks: dict = {"keys": []}
+    fetches = []
+
+    def add_key(kid):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        private_keys[kid] = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ).decode()
+        public_jwk = jwk.construct(private_key.public_key(), algorithm="RS256").to_dict()
+        jwks["keys"].append({"kty": "RSA", "kid": kid, "use": "sig", "n": public_jwk["n"], "e": public_jwk["e"]})
+
+    async def mock_fetch_jwks(self):
+        fetches.append(time.monotonic())
+        return {"keys": list(jwks["keys"])}
+
+    monkeypatch.setattr(AuthenticationHelper, "fetch_jwks", mock_fetch_jwks)
+    add_key("KEY_1")
+    return argparse.Namespace(private_keys=private_keys, add_key=add_key, fetches=fetches)
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_caches_keys_and_tokens(
+    mock_confidential_client_success, signing_keys, monkeypatch
+):
+    helper = create_authentication_helper()
+    token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1")
+
+    await helper.validate_access_token(token)
+    assert len(signing_keys.fetches) == 1
+    assert len(helper.validated_tokens) == 1
+
+    # A validated token skips the signature check entirely
+    def fail_decode(*args, **kwargs):
+        raise AssertionError("token should not be decoded again")
+
+    with mock.patch("core.authentication.jwt.decode", fail_decode):
+        await helper.validate_access_token(token)
+
+    # Another token signed with a known key reuses the cached keys
+    monkeypatch.setattr(AuthenticationHelper, "fetch_jwks", lambda self: pytest.fail("keys should be cached"))
+    other_token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1", expires_in=1800)
+    await helper.validate_access_token(other_token)
+    assert len(helper.validated_tokens) == 2
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_refreshes_keys_for_unknown_kid(mock_confidential_client_success, signing_keys):
+    helper = create_authentication_helper()
+    await helper.validate_access_token(create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1"))
+    assert len(signing_keys.fetches) == 1
+
+    # The keys were rotated after they were cached
+    signing_keys.add_key("KEY_2")
+    helper.jwks_fetched_at -= helper.jwks_min_refresh_interval
+    await helper.validate_access_token(create_signed_token(signing_keys.private_keys["KEY_2"], "KEY_2"))
+    assert len(signing_keys.fetches) == 2
+
+    # Unknown keys don't trigger another download until the minimum refresh interval has passed
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_3"))
+    assert exc_info.value.error["description"] == "Unable to find appropriate key"
+    assert len(signing_keys.fetches) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_jwks_coalesces_refreshes(mock_confidential_client_success, signing_keys, monkeypatch):
+    helper = create_authentication_helper()
+    await helper.get_jwks()
+    signing_keys.add_key("KEY_2")
+    helper.jwks_fetched_at -= helper.jwks_min_refresh_interval
+    release = asyncio.Event()
+    fetch_jwks = AuthenticationHelper.fetch_jwks
+
+    async def slow_fetch_jwks(self):
+        await release.wait()
+        return await fetch_jwks(self)
+
+    monkeypatch.setattr(AuthenticationHelper, "fetch_jwks", slow_fetch_jwks)
+    tokens = [create_signed_token(signing_keys.private_keys["KEY_2"], "KEY_2", expires_in=60 + i) for i in range(3)]
+    validations = [asyncio.create_task(helper.validate_access_token(token)) for token in tokens]
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(*validations)
+
+    # The tokens signed with the rotated key share a single download
+    assert len(signing_keys.fetches) == 2
+    assert len(helper.jwks_fetches) == 0
+
+
+@pytest.mark.asyncio
+async def test_get_jwks_keeps_keys_when_refresh_fails(mock_confidential_client_success, signing_keys, monkeypatch):
+    helper = create_authentication_helper()
+    token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1")
+    await helper.validate_access_token(token)
+
+    async def failing_fetch_jwks(self):
+        raise AuthError(error="Failed to get keys info", status_code=503)
+
+    monkeypatch.setattr(AuthenticationHelper, "fetch_jwks", failing_fetch_jwks)
+    helper.jwks_fetched_at -= helper.jwks_cache_ttl
+    helper.validated_tokens.clear()
+
+    # The expired keys are still used to validate the tokens signed with them
+    await helper.validate_access_token(token)
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_2"))
+    assert exc_info.value.error["description"] == "Unable to find appropriate key"
+    assert helper.jwks is not None and len(helper.jwks["keys"]) == 1
+
+    # A response without keys doesn't replace them either
+    monkeypatch.setattr(AuthenticationHelper, "fetch_jwks", lambda self: asyncio.sleep(0, {"error": "invalid"}))
+    assert await helper.get_jwks() == helper.jwks
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_cache_bounded_by_expiration(mock_confidential_client_success, signing_keys):
+    helper = create_authentication_helper()
+
+    expired_token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1", expires_in=-60)
+    with pytest.raises(AuthError):
+        await helper.validate_access_token(expired_token)
+    assert len(helper.validated_tokens) == 0
+
+    expiring_token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1", expires_in=30)
+    await helper.validate_access_token(expiring_token)
+    expires_at, _ = next(iter(helper.validated_tokens.backend._entries.values()))
+    assert expires_at <= time.monotonic() + 30
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_obo_off_event_loop(signing_keys, monkeypatch):
+    threads = []
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y"]}}
+
+    monkeypatch.setattr(msal.ConfidentialClientApplication, "__init__", lambda self, *args, **kwargs: None)
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+    helper = create_authentication_helper()
+    token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1")
+
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+    assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    assert threads[0].startswith("msal-obo")
+
+    # The claims are cached for the same token, so the on-behalf-of exchange only happens once
+    assert await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"}) == auth_claims
+    assert len(threads) == 1
+
+    other_token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1", expires_in=1800)
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {other_token}"})
+    assert len(threads) == 2
+    helper.close()
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_not_cached_on_error(mock_confidential_client_unauthorized, signing_keys):
+    helper = create_authentication_helper()
+    token = create_signed_token(signing_keys.private_keys["KEY_1"], "KEY_1")
+
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+    assert auth_claims == {}
+    assert len(helper.claims_cache) == 0
+
+
+@pytest.fixture
+def mock_list_groups_counter(monkeypatch):
+    class MockListGroups:
+        def __init__(self):
+            self.calls = 0
+            self.groups = ["OVERAGE_GROUP_Y"]
+            self.release = asyncio.Event()
+            self.release.set()
+
+        async def __call__(self, graph_resource_access_token, http_session=None):
+            self.calls += 1
+            await self.release.wait()
+            return list(self.groups)
+
+    list_groups = MockListGroups()
+    monkeypatch.setattr(AuthenticationHelper, "list_groups", list_groups)
+    return list_groups
+
+
+@pytest.mark.asyncio
+async def test_get_groups_coalesces_concurrent_lookups(mock_confidential_client_success, mock_list_groups_counter):
+    helper = create_authentication_helper()
+    mock_list_groups_counter.release.clear()
+
+    lookups = [asyncio.create_task(helper.get_groups("OID_X", {"access_token": "MockToken"})) for _ in range(3)]
+    await asyncio.sleep(0)
+    mock_list_groups_counter.release.set()
+
+    assert await asyncio.gather(*lookups) == [["OVERAGE_GROUP_Y"]] * 3
+    assert mock_list_groups_counter.calls == 1
+
+    # Later lookups are served from the cache
+    assert await helper.get_groups("OID_X", {"access_token": "MockToken"}) == ["OVERAGE_GROUP_Y"]
+    assert mock_list_groups_counter.calls == 1
+    assert helper.groups_cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_get_groups_stale_while_revalidate(mock_confidential_client_success, mock_list_groups_counter):
+    helper = create_authentication_helper()
+    await helper.get_groups("OID_X", {"access_token": "MockToken"})
+
+    # Once the entry is older than the TTL, the stale groups are returned while they are refreshed in the background
+    fetched_at, groups = helper.groups_cache.get("OID_X")
+    helper.groups_cache.set("OID_X", (fetched_at - helper.groups_cache_ttl, groups))
+    mock_list_groups_counter.groups = ["OVERAGE_GROUP_Z"]
+
+    assert await helper.get_groups("OID_X", {"access_token": "MockToken"}) == ["OVERAGE_GROUP_Y"]
+    await asyncio.gather(*helper.group_fetches.calls.values())
+    assert mock_list_groups_counter.calls == 2
+    assert await helper.get_groups("OID_X", {"access_token": "MockToken"}) == ["OVERAGE_GROUP_Z"]
+
+    # Past the stale limit the entry expires and the groups are read again before returning
+    helper.groups_cache.clear()
+    mock_list_groups_counter.groups = ["OVERAGE_GROUP_W"]
+    assert await helper.get_groups("OID_X", {"access_token": "MockToken"}) == ["OVERAGE_GROUP_W"]
+    assert mock_list_groups_counter.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+    searches = 0
+
+    async def mock_search(self, *args, **kwargs):
+        nonlocal searches
+        searches += 1
+        return MockAsyncPageIterator(data=[{"sourcepage": "Benefit_Options-2.pdf"}])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    for _ in range(3):
+        assert await auth_helper_require_access_control.check_path_auth(
+            path="Benefit_Options-2.pdf",
+            auth_claims={"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]},
+            search_client=create_search_client(),
+        )
+    assert searches == 1
+
+    # Another user has a different security filter, so the decision isn't shared
+    await auth_helper_require_access_control.check_path_auth(
+        path="Benefit_Options-2.pdf",
+        auth_claims={"oid": "OID_W", "groups": []},
+        search_client=create_search_client(),
+    )
+    assert searches == 2
+
+
+class MockFacetedResults:
+    def __init__(self, sourcepages):
+        self.sourcepages = sourcepages
+
+    async def get_facets(self):
+        return {"sourcepage": [{"value": sourcepage, "count": 1} for sourcepage in self.sourcepages]}
+
+
+@pytest.mark.asyncio
+async def test_preauthorize_paths(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+    search_kwargs = []
+
+    async def mock_search(self, *args, **kwargs):
+        search_kwargs.append(kwargs)
+        if "facets" in kwargs:
+            return MockFacetedResults(["Benefit_Options-2.pdf", "Northwind's Plan-1.pdf"])
+        raise AssertionError("check_path_auth should use the preauthorized decisions")
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+
+    decisions = await auth_helper_require_access_control.preauthorize_paths(
+        ["Benefit_Options-2.pdf", "Northwind's Plan-1.pdf", "Secret-1.pdf", "Benefit_Options-2.pdf"],
+        auth_claims,
+        create_search_client(),
+    )
+    assert decisions == {"Benefit_Options-2.pdf": True, "Northwind's Plan-1.pdf": True, "Secret-1.pdf": False}
+    assert len(search_kwargs) == 1
+    assert (
+        search_kwargs[0]["filter"]
+        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z'))) and search.in(sourcepage, 'Benefit_Options-2.pdf|Northwind''s Plan-1.pdf|Secret-1.pdf', '|')"
+    )
+    assert search_kwargs[0]["facets"] == ["sourcepage,count:3"]
+
+    for path, allowed in decisions.items():
+        assert (
+            await auth_helper_require_access_control.check_path_auth(path, auth_claims, create_search_client())
+            is allowed
+        )
+
+    # Paths that are already cached are not queried again
+    assert (
+        await auth_helper_require_access_control.preauthorize_paths(
+            ["Secret-1.pdf"], auth_claims, create_search_client()
+        )
+        == {}
+    )
+    assert len(search_kwargs) == 1
+
+
+@pytest.mark.asyncio
+async def test_preauthorize_pdf_pages(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+    search_kwargs = []
+
+    async def mock_search(self, *args, **kwargs):
+        search_kwargs.append(kwargs)
+        if "facets" in kwargs:
+            return MockFacetedResults(["Benefit_Options.pdf#page=3"])
+        raise AssertionError("check_path_auth should use the preauthorized decisions")
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+
+    decisions = await auth_helper_require_access_control.preauthorize_paths(
+        ["Benefit_Options.pdf#page=2", "Benefit_Options.pdf#page=3", "Secret.pdf#page=1"],
+        auth_claims,
+        create_search_client(),
+    )
+    # The decisions are made per file, as the browser doesn't send the page when opening the citation
+    assert decisions == {"Benefit_Options.pdf": True, "Secret.pdf": False}
+    assert await auth_helper_require_access_control.check_path_auth(
+        "Benefit_Options.pdf", auth_claims, create_search_client()
+    )
+    assert not await auth_helper_require_access_control.check_path_auth(
+        "Secret.pdf", auth_claims, create_search_client()
+    )
+    assert len(search_kwargs) == 1
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_pdf_cold_and_preauthorized(
+    monkeypatch, mock_confidential_client_success, mock_validate_token_success
+):
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    filters = []
+
+    async def mock_search(self, *args, **kwargs):
+        filters.append(kwargs["filter"])
+        if "facets" in kwargs:
+            return MockFacetedResults(["Benefit_Options.pdf#page=3"])
+        # Like the index, the chunks of the PDF have the page in sourcepage and the file in sourcefile
+        matched = "sourcefile eq 'Benefit_Options.pdf'" in kwargs["filter"]
+        return MockAsyncPageIterator(data=[{"sourcepage": "Benefit_Options.pdf#page=3"}] if matched else [])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    # The browser opens the citation without its #page fragment
+    cold = create_authentication_helper(require_access_control=True)
+    assert await cold.check_path_auth("Benefit_Options.pdf", auth_claims, create_search_client()) is True
+    assert await cold.check_path_auth("Benefit_Options.pdf#page=3", auth_claims, create_search_client()) is True
+
+    warm = create_authentication_helper(require_access_control=True)
+    await warm.preauthorize_paths(["Benefit_Options.pdf#page=3"], auth_claims, create_search_client())
+    assert await warm.check_path_auth("Benefit_Options.pdf", auth_claims, create_search_client()) is True
+    # One search for the cold lookup, whose decision is reused for the page, and one for the preauthorization
+    assert len(filters) == 2
+    assert filters[0].endswith("(sourcepage eq 'Benefit_Options.pdf' or sourcefile eq 'Benefit_Options.pdf')")
+
+
+@pytest.mark.asyncio
+async def test_schedule_path_preauthorization(monkeypatch, mock_confidential_client_success):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+
+    async def mock_search(self, *args, **kwargs):
+        return MockFacetedResults(["Benefit_Options-2.pdf"])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    auth_claims = {"oid": "OID_X", "groups": []}
+
+    auth_helper_require_access_control.schedule_path_preauthorization(
+        ["Benefit_Options-2.pdf"], auth_claims, create_search_client()
+    )
+    await asyncio.gather(*auth_helper_require_access_control.path_preauthorizations.calls.values())
+    assert len(auth_helper_require_access_control.path_auth_cache) == 1
+
+    # Without a security filter every path is allowed, so there is nothing to check
+    auth_helper = create_authentication_helper(require_access_control=False)
+    auth_helper.schedule_path_preauthorization(["Benefit_Options-2.pdf"], auth_claims, create_search_client())
+    assert len(auth_helper.path_preauthorizations) == 0
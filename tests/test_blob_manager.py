@@ -1,3 +1,4 @@
+import json
 import os
 import sys
 from tempfile import NamedTemporaryFile
@@ -163,6 +164,29 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
     await blob_manager.remove_blob()
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_update_index_version(monkeypatch, mock_env, blob_manager):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    uploaded = {}
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        uploaded[name] = json.loads(data)
+        assert kwargs.get("overwrite") is True
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    await blob_manager.update_index_version()
+    first_version = uploaded["index-version.json"]["version"]
+    await blob_manager.update_index_version()
+    assert uploaded["index-version.json"]["version"] != first_version
+
+
 def test_sourcepage_from_file_page():
     assert BlobManager.sourcepage_from_file_page("test.pdf", 0) == "test.pdf#page=1"
     assert BlobManager.sourcepage_from_file_page("test.html", 0) == "test.html"
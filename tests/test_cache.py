@@ -0,0 +1,53 @@
+import time
+
+from core.cache import TTLCache
+
+
+def test_ttlcache_get_set():
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", "A")
+    assert cache.get("a") == "A"
+    assert cache.stats() == {"size": 1, "maxsize": 2, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_ttlcache_evicts_least_recently_used():
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == "A"
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert len(cache) == 2
+
+
+def test_ttlcache_expires(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache: TTLCache[str] = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", "A")
+    cache.set("b", "B", ttl=120)
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert cache.get("a") is None
+    assert cache.get("b") == "B"
+    assert len(cache) == 1
+
+
+def test_ttlcache_disabled():
+    cache: TTLCache[str] = TTLCache(maxsize=0, ttl=60)
+    cache.set("a", "A")
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttlcache_clear():
+    cache: TTLCache[str] = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", "A")
+    cache.delete("a")
+    cache.set("b", "B")
+    cache.clear()
+    assert cache.get("b") is None
+    assert len(cache) == 0
@@ -0,0 +1,460 @@
+import asyncio
+import socket
+import socketserver
+import threading
+import time
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from typing import Any
+
+import pytest
+import redis.asyncio
+import redis.exceptions
+from azure.search.documents.models import CaptionResult
+
+from core.answercache import SemanticAnswerCache
+from core.cache import TTLCache
+from core.cachebackends import (
+    CacheBackendFactory,
+    CacheSerializer,
+    RedisBackend,
+    RedisServer,
+    SQLiteBackend,
+)
+
+SIGNING_KEY = "test-key"
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """A local stand-in for a Redis server, with the commands used by RedisBackend."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), RedisStandInHandler)
+        self.password = password
+        # The values are bytes, or dictionaries for hashes
+        self.data: dict[bytes, tuple[float, Any]] = {}
+        self.lock = threading.Lock()
+        self.commands: list[str] = []
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"redis://:{self.password}@{host}:{port}/2" if self.password else f"redis://{host}:{port}"
+
+    def run(self, args: list[bytes]):
+        command = args[0].decode().upper()
+        self.commands.append(command)
+        now = time.time()
+        with self.lock:
+            if command == "CLIENT":
+                # CLIENT SETINFO is sent by redis-py on connection, which ignores the error of older servers
+                return "-ERR unknown subcommand"
+            if command == "AUTH":
+                return "+OK" if args[-1].decode() == self.password else "-WRONGPASS invalid password"
+            if command == "SELECT":
+                return "+OK"
+            if command == "GET":
+                expires_at, value = self.data.get(args[1], (0, b""))
+                return value if expires_at > now else None
+            if command == "SET":
+                self.data[args[1]] = (now + int(args[4]) / 1000, args[2])
+                return "+OK"
+            if command == "DEL":
+                return sum(self.data.pop(key, None) is not None for key in args[1:])
+            expires_at, value = self.data.get(args[1], (0, None)) if len(args) > 1 else (0, None)
+            if command == "HSET":
+                fields = value if expires_at > now else {}
+                fields.update(zip(args[2::2], args[3::2]))
+                self.data[args[1]] = (expires_at if expires_at > now else float("inf"), fields)
+                return len(args[2:]) // 2
+            if command == "HGETALL":
+                return [item for field in (value if expires_at > now else {}).items() for item in field]
+            if command == "HDEL":
+                return sum(value.pop(field, None) is not None for field in args[2:]) if expires_at > now else 0
+            if command == "PEXPIRE":
+                if expires_at <= now:
+                    return 0
+                self.data[args[1]] = (now + int(args[2]) / 1000, value)
+                return 1
+            if command == "SCAN":
+                pattern = args[3].decode()
+                return [b"0", [key for key in self.data if fnmatchcase(key.decode(), pattern)]]
+        return f"-ERR unknown command '{command}'"
+
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def encode(self, reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, str):
+            return reply.encode() + b"\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(self.encode(item) for item in reply)
+
+    def handle(self):
+        while (args := self.read_command()) is not None:
+            self.wfile.write(self.encode(self.server.run(args)))
+
+
+@pytest.fixture
+def redis_server():
+    server = RedisStandIn(password="secret")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_sqlite_shared_between_workers(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    # Each worker process has its own factory and connection to the same file
+    worker1 = TTLCache(
+        maxsize=10,
+        ttl=60,
+        backend=CacheBackendFactory("sqlite", sqlite_path=path, signing_key=SIGNING_KEY).create("search", 10),
+    )
+    worker2 = TTLCache(
+        maxsize=10,
+        ttl=60,
+        backend=CacheBackendFactory("sqlite", sqlite_path=path, signing_key=SIGNING_KEY).create("search", 10),
+    )
+    other = TTLCache(
+        maxsize=10,
+        ttl=60,
+        backend=CacheBackendFactory("sqlite", sqlite_path=path, signing_key=SIGNING_KEY).create("other", 10),
+    )
+
+    worker1.set(("capital of France", "oids/any(g:search.in(g, 'OID_X'))"), [{"id": "file-1"}])
+
+    assert worker2.get(("capital of France", "oids/any(g:search.in(g, 'OID_X'))")) == [{"id": "file-1"}]
+    assert worker2.get(("capital of France", "oids/any(g:search.in(g, 'OID_Y'))")) is None
+    assert other.get(("capital of France", "oids/any(g:search.in(g, 'OID_X'))")) is None
+    worker2.clear()
+    assert worker1.get(("capital of France", "oids/any(g:search.in(g, 'OID_X'))")) is None
+
+
+def test_sqlite_expires_and_evicts(tmp_path, monkeypatch):
+    backend = CacheBackendFactory(
+        "sqlite", sqlite_path=str(tmp_path / "cache.sqlite3"), signing_key=SIGNING_KEY
+    ).create("search", 2)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    backend.set("a", "A", 60)
+    backend.set("b", "B", 120)
+    backend.set("c", "C", 90)
+
+    # Past maxsize, the entry closest to expiring is evicted
+    assert backend.get("a") is None
+    assert len(backend) == 2
+    monkeypatch.setattr(time, "time", lambda: now + 100)
+    assert backend.get("c") is None
+    assert backend.get("b") == "B"
+    assert len(backend) == 1
+
+
+def test_sqlite_sweeps_periodically(tmp_path):
+    backend = CacheBackendFactory(
+        "sqlite", sqlite_path=str(tmp_path / "cache.sqlite3"), signing_key=SIGNING_KEY
+    ).create("search", 20)
+    for i in range(21):
+        backend.set(i, i, 60 + i)
+    # The size is only checked every other write, so it can go over maxsize until the next check
+    assert len(backend) == 21
+    backend.set(21, 21, 81)
+    assert len(backend) == 20
+    assert backend.get(0) is None and backend.get(1) is None
+    assert backend.get(2) == 2
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_members(kind, tmp_path):
+    factory = CacheBackendFactory(kind, sqlite_path=str(tmp_path / "cache.sqlite3"), signing_key=SIGNING_KEY)
+    backend = factory.create("answers", 10)
+    backend.set_member("index", "a", {"vector": "A"}, 60)
+    backend.set_member("index", "b", {"vector": "B"}, 0.05)
+    backend.set_member("other", "a", {"vector": "C"}, 60)
+
+    assert backend.get_members("index") == {"a": {"vector": "A"}, "b": {"vector": "B"}}
+    time.sleep(0.1)
+    assert backend.get_members("index") == {"a": {"vector": "A"}}
+    backend.delete_members("index", ["a"])
+    assert backend.get_members("index") == {}
+    assert backend.get_members("other") == {"a": {"vector": "C"}}
+
+
+def test_sqlite_unreadable_entry(tmp_path, caplog):
+    backend = CacheBackendFactory(
+        "sqlite", sqlite_path=str(tmp_path / "cache.sqlite3"), signing_key=SIGNING_KEY
+    ).create("search", 10)
+    assert isinstance(backend, SQLiteBackend)
+    backend.connection.execute(
+        "INSERT INTO cache_entries VALUES (?, ?, ?, ?)", ("search", backend.hash_key("a"), time.time() + 60, b"junk")
+    )
+
+    assert backend.get("a") is None
+    assert "Unable to read from the search cache" in caplog.text
+
+
+def test_sqlite_forged_entry(tmp_path, caplog):
+    path = str(tmp_path / "cache.sqlite3")
+    backend = CacheBackendFactory("sqlite", sqlite_path=path, signing_key=SIGNING_KEY).create("auth_paths", 10)
+    forger = CacheBackendFactory("sqlite", sqlite_path=path, signing_key="other-key").create("auth_paths", 10)
+    assert isinstance(backend, SQLiteBackend)
+    forger.set("a", True, 60)
+    backend.set("b", False, 60)
+    # An entry copied to another key keeps the signature of its own key
+    backend.connection.execute(
+        "INSERT INTO cache_entries SELECT namespace, ?, expires_at, value FROM cache_entries WHERE key = ?",
+        (backend.hash_key("c"), backend.hash_key("b")),
+    )
+    forger.set_member("index", "x", {"vector": "X"}, 60)
+    backend.set_member("index", "y", {"vector": "Y"}, 60)
+
+    assert backend.get("a") is None
+    assert backend.get("b") is False
+    assert backend.get("c") is None
+    assert "Invalid signature" in caplog.text
+    # The forged member is skipped, not the whole collection
+    assert backend.get_members("index") == {"y": {"vector": "Y"}}
+
+
+@dataclass
+class Step:
+    title: str
+    props: dict[str, Any]
+
+
+def test_serializer():
+    serializer = CacheSerializer(SIGNING_KEY, [Step, CaptionResult])
+    caption = CaptionResult.from_dict({"text": "Paris", "highlights": "<em>Paris</em>"})
+    data = serializer.dumps("search", "key", [Step("Results", {"hit": True}), caption, ("a", 1)], time.time() + 60)
+
+    step, read_caption, pair = serializer.loads("search", "key", data)
+    assert step == Step("Results", {"hit": True})
+    assert read_caption.text == "Paris" and read_caption.highlights == "<em>Paris</em>"
+    assert pair == ["a", 1]
+    with pytest.raises(ValueError, match="Invalid signature"):
+        serializer.loads("search", "other-key", data)
+    assert serializer.loads("search", "key", serializer.dumps("search", "key", "A", time.time() - 1)) is None
+
+    # Only the registered types are written and read back
+    with pytest.raises(TypeError, match="can't be cached"):
+        serializer.dumps("search", "key", {1, 2}, time.time() + 60)
+    other = CacheSerializer(SIGNING_KEY, [Step])
+    with pytest.raises(ValueError, match="CaptionResult can't be read"):
+        other.loads("search", "key", data)
+
+
+@pytest.mark.asyncio
+async def test_async_methods_run_in_executor(tmp_path, monkeypatch):
+    factory = CacheBackendFactory("sqlite", sqlite_path=str(tmp_path / "cache.sqlite3"), signing_key=SIGNING_KEY)
+    cache: TTLCache[str] = TTLCache(maxsize=10, ttl=60, backend=factory.create("search", 10))
+    answers: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=2, ttl=60, backend=factory.create("answers", 4))
+    threads = []
+    get_members = answers.backend.get_members  # type: ignore[union-attr]
+    monkeypatch.setattr(
+        answers.backend, "get_members", lambda key: threads.append(threading.current_thread()) or get_members(key)
+    )
+
+    await cache.aset("a", "A")
+    assert await cache.aget("a") == "A"
+    await cache.aclear()
+    assert await cache.aget("a") is None
+    await answers.aset("scope", [1.0, 0.0], "A")
+    assert await answers.aget("scope", [1.0, 0.0]) == ("A", 1.0)
+    # The calls to the file don't block the event loop
+    assert threads and all(thread.name.startswith("cache") for thread in threads)
+    assert cache.hits == 1 and answers.hits == 1
+    # The in-memory caches are used on the event loop
+    assert TTLCache().backend.executor is None
+    await factory.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_shared_between_workers(redis_server):
+    factory1 = CacheBackendFactory("redis", redis_url=redis_server.url, signing_key=SIGNING_KEY)
+    factory2 = CacheBackendFactory("redis", redis_url=redis_server.url, signing_key=SIGNING_KEY)
+    worker1: TTLCache[list[float]] = TTLCache(maxsize=10, ttl=60, backend=factory1.create("embeddings", 10))
+    worker2: TTLCache[list[float]] = TTLCache(maxsize=10, ttl=60, backend=factory2.create("embeddings", 10))
+    thoughts: TTLCache[dict[str, Any]] = TTLCache(maxsize=10, ttl=60, backend=factory2.create("thoughts", 10))
+
+    await worker1.aset(("text-embedding-ada-002", "capital of France", "embedding"), [0.1, 0.2])
+    await thoughts.aset("thoughts-id", {"oid": "OID_X", "thoughts": []})
+
+    assert await worker2.aget(("text-embedding-ada-002", "capital of France", "embedding")) == [0.1, 0.2]
+    assert await worker2.aget(("text-embedding-ada-002", "capital of Spain", "embedding")) is None
+    await worker2.aclear()
+    assert await worker1.aget(("text-embedding-ada-002", "capital of France", "embedding")) is None
+    assert await thoughts.aget("thoughts-id") == {"oid": "OID_X", "thoughts": []}
+    # The keys are hashed, and the connections authenticated and selected the database of the URL
+    assert all(key.startswith(b"thoughts:") and b"thoughts-id" not in key for key in redis_server.data)
+    assert redis_server.commands[0] == "AUTH" and "SELECT" in redis_server.commands
+    # The Redis backend is only used asynchronously
+    assert worker1.stats()["size"] is None
+    with pytest.raises(TypeError, match="async methods"):
+        worker1.get("a")
+    await factory1.close()
+    await factory2.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_expires(redis_server):
+    server = RedisServer(redis_server.url)
+    backend = RedisBackend(server, "search", CacheSerializer(SIGNING_KEY))
+    await backend.aset("a", "A", 0.05)
+    assert await backend.aget("a") == "A"
+    await asyncio.sleep(0.1)
+    assert await backend.aget("a") is None
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_members_pipelined(redis_server):
+    server = RedisServer(redis_server.url)
+    backend = RedisBackend(server, "answers", CacheSerializer(SIGNING_KEY))
+    await backend.aset_member("index", "a", {"vector": "A"}, 60)
+    redis_server.commands.clear()
+    await backend.aset_member("index", "b", {"vector": "B"}, 60)
+
+    # The member and the expiration of the hash are sent together, on the connection already open
+    assert redis_server.commands == ["HSET", "PEXPIRE"]
+    assert await backend.aget_members("index") == {"a": {"vector": "A"}, "b": {"vector": "B"}}
+    await backend.adelete_members("index", ["a"])
+    assert await backend.aget_members("index") == {"b": {"vector": "B"}}
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_wrong_password(redis_server, caplog):
+    host, port = redis_server.server_address
+    server = RedisServer(f"redis://:wrong@{host}:{port}")
+    backend = RedisBackend(server, "search", CacheSerializer(SIGNING_KEY))
+
+    assert await backend.aget("a") is None
+    assert "AuthenticationError" in caplog.text
+    assert redis_server.commands == ["AUTH"]
+    await server.close()
+
+
+def test_redis_tls():
+    server = RedisServer("rediss://:secret@example.redis.cache.windows.net:6380/0")
+    assert server.client.connection_pool.connection_class is redis.asyncio.SSLConnection
+    assert server.client.connection_pool.connection_kwargs["password"] == "secret"
+    assert RedisServer("redis://localhost").client.connection_pool.connection_class is redis.asyncio.Connection
+
+
+@pytest.mark.asyncio
+async def test_redis_unavailable(caplog):
+    # A port nothing listens on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        host, port = sock.getsockname()
+    server = RedisServer(f"redis://{host}:{port}", timeout=0.1, retry_interval=60)
+    cache: TTLCache[str] = TTLCache(
+        maxsize=10, ttl=60, backend=RedisBackend(server, "search", CacheSerializer(SIGNING_KEY))
+    )
+
+    await cache.aset("a", "A")
+    assert await cache.aget("a") is None
+    assert "Unable to write to the search cache" in caplog.text
+    # Until retry_interval has passed, the commands fail without trying to connect again
+    with pytest.raises(redis.exceptions.ConnectionError, match="unavailable"):
+        await server.execute(lambda client: client.get("a"))
+    server.unavailable_until = 0
+    with pytest.raises(redis.exceptions.ConnectionError, match="connecting"):
+        await server.execute(lambda client: client.get("a"))
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_answercache_shared_redis(redis_server):
+    factory1 = CacheBackendFactory("redis", redis_url=redis_server.url, signing_key=SIGNING_KEY)
+    factory2 = CacheBackendFactory("redis", redis_url=redis_server.url, signing_key=SIGNING_KEY)
+    worker1: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=10, ttl=60, backend=factory1.create("answers", 10))
+    worker2: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=10, ttl=60, backend=factory2.create("answers", 10))
+
+    await worker1.aset("scope", [1.0, 0.0], "A")
+    await worker2.aset("scope", [0.0, 1.0], "B")
+    # Each answer is stored on its own, next to the index of the embeddings of the scope
+    assert len(redis_server.data) == 3
+
+    redis_server.commands.clear()
+    assert await worker1.aget("scope", [0.0, 1.0]) == ("B", 1.0)
+    assert await worker2.aget("scope", [1.0, 0.0]) == ("A", 1.0)
+    assert await worker2.aget("scope", [1.0, 1.0]) is None
+    # A lookup reads the index, then only the answer it returns
+    assert redis_server.commands == ["HGETALL", "GET", "HGETALL", "GET", "HGETALL"]
+    await factory1.close()
+    await factory2.close()
+
+
+@pytest.mark.asyncio
+async def test_answercache_shared(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    factory1 = CacheBackendFactory("sqlite", sqlite_path=path, signing_key=SIGNING_KEY)
+    factory2 = CacheBackendFactory("sqlite", sqlite_path=path, signing_key=SIGNING_KEY)
+    worker1: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=2, ttl=60, backend=factory1.create("answers", 4))
+    worker2: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=2, ttl=60, backend=factory2.create("answers", 4))
+
+    await worker1.aset("scope", [1.0, 0.0], "A")
+    await worker2.aset("scope", [0.0, 1.0], "B")
+
+    assert await worker2.aget("scope", [1.0, 0.0]) == ("A", 1.0)
+    assert await worker1.aget("scope", [0.0, 1.0]) == ("B", 1.0)
+    assert await worker1.aget("other", [1.0, 0.0]) is None
+    # With a shared backend, maxsize applies to each scope
+    await worker1.aset("scope", [1.0, 1.0], "C")
+    assert await worker2.aget("scope", [1.0, 0.0]) is None
+    assert (await worker2.aget("scope", [1.0, 1.0]))[0] == "C"
+    await worker2.aclear()
+    assert await worker1.aget("scope", [0.0, 1.0]) is None
+    with pytest.raises(TypeError, match="async methods"):
+        worker1.get("scope", [0.0, 1.0])
+    await factory1.close()
+    await factory2.close()
+
+
+@pytest.mark.asyncio
+async def test_answercache_shared_dimension_change(tmp_path):
+    factory = CacheBackendFactory("sqlite", sqlite_path=str(tmp_path / "cache.sqlite3"), signing_key=SIGNING_KEY)
+    backend = factory.create("answers", 10)
+    assert isinstance(backend, SQLiteBackend)
+    cache: SemanticAnswerCache[str] = SemanticAnswerCache(maxsize=5, ttl=60, backend=backend)
+    await cache.aset("scope", [1.0, 0.0], "A")
+
+    # The embeddings of the previous dimension are skipped, then evicted by the next write
+    assert await cache.aget("scope", [1.0, 0.0, 0.0]) is None
+    await cache.aset("scope", [1.0, 0.0, 0.0], "B")
+    assert await cache.aget("scope", [1.0, 0.0, 0.0]) == ("B", 1.0)
+    assert len(backend.get_members(("index", "scope"))) == 1
+    assert len(backend) == 2
+    await factory.close()
+
+
+def test_factory():
+    assert CacheBackendFactory().shared is False
+    with pytest.raises(ValueError, match="must be one of"):
+        CacheBackendFactory("lmdb")
+    with pytest.raises(ValueError, match="URL of the server"):
+        CacheBackendFactory("redis")
+    with pytest.raises(ValueError, match="signing key"):
+        CacheBackendFactory("sqlite", sqlite_path="cache.sqlite3")
+    with pytest.raises(ValueError, match="redis://"):
+        RedisServer("http://localhost")
@@ -1,9 +1,17 @@
+import asyncio
 import json
 
 import pytest
-from openai.types.chat import ChatCompletion
+from azure.search.documents.models import RawVectorQuery
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+import core.messagebuilder
+from approaches.approach import CachedAnswer, ThoughtStep
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.answercache import SemanticAnswerCache
+from core.cache import TTLCache
+from core.modelhelper import num_tokens_from_texts
+from core.singleflight import SingleFlight
 
 
 @pytest.fixture
@@ -267,3 +275,553 @@ def test_get_messages_from_history_few_shots(chat_approach):
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+@pytest.mark.asyncio
+async def test_create_search_query_completion_single_flight(chat_approach):
+    payload = '{"id":"chatcmpl-81JkxYqYppUkPtOAia40gki2vJ9QM","object":"chat.completion","created":1695324963,"model":"gpt-35-turbo","choices":[{"index":0,"finish_reason":"stop","message":{"content":"health plan","role":"assistant"}}]}'
+    calls = []
+    release = asyncio.Event()
+
+    class MockCompletions:
+        async def create(self, **kwargs):
+            calls.append(kwargs)
+            await release.wait()
+            return ChatCompletion.model_validate(json.loads(payload), strict=False)
+
+    class MockOpenAIClient:
+        def __init__(self):
+            self.chat = self
+            self.completions = MockCompletions()
+
+    chat_approach.openai_client = MockOpenAIClient()
+    chat_approach.single_flight = SingleFlight()
+    messages = [{"role": "user", "content": "Generate search query for: What is my health plan?"}]
+
+    waiters = [
+        asyncio.create_task(chat_approach.create_search_query_completion(model="chat", messages=messages, n=1))
+        for _ in range(3)
+    ]
+    # A different conversation doesn't share the completion
+    other = asyncio.create_task(
+        chat_approach.create_search_query_completion(
+            model="chat", messages=[{"role": "user", "content": "Generate search query for: Hi"}], n=1
+        )
+    )
+    await asyncio.sleep(0)
+    release.set()
+    completions = await asyncio.gather(*waiters, other)
+
+    assert len(calls) == 2
+    assert [chat_approach.get_search_query(completion, "") for completion in completions] == ["health plan"] * 4
+
+
+def test_get_messages_from_history_token_count_cache(chat_approach, monkeypatch):
+    counted = []
+    num_tokens_from_messages = core.messagebuilder.num_tokens_from_messages
+
+    def mock_num_tokens_from_messages(message, model):
+        counted.append(message["content"])
+        return num_tokens_from_messages(message, model)
+
+    monkeypatch.setattr(core.messagebuilder, "num_tokens_from_messages", mock_num_tokens_from_messages)
+    chat_approach.token_count_cache = TTLCache()
+    history = [
+        {"role": "user", "content": "What happens in a performance review?"},
+        {
+            "role": "assistant",
+            "content": "The supervisor discusses the employee's performance [employee_handbook-3.pdf].",
+        },
+        {"role": "user", "content": "What does a Product Manager do?"},
+    ]
+
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id="gpt-35-turbo",
+        history=history,
+        user_content=history[-1]["content"],
+        max_tokens=3000,
+    )
+    assert [message["content"] for message in messages[1:]] == [message["content"] for message in history]
+    assert len(counted) == 3
+
+    # On the next turn, only the new messages are tokenized
+    counted.clear()
+    history += [
+        {"role": "assistant", "content": "A Product Manager leads the product strategy [role_library.pdf]."},
+        {"role": "user", "content": "What is the dress code?"},
+    ]
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id="gpt-35-turbo",
+        history=history,
+        user_content=history[-1]["content"],
+        max_tokens=3000,
+    )
+    assert [message["content"] for message in messages[1:]] == [message["content"] for message in history]
+    assert counted == [history[-1]["content"], history[-2]["content"]]
+
+
+def test_pack_sources_fits(chat_approach):
+    sources = ["a.pdf#page=1: The plan covers eye exams.", "b.pdf#page=2: The plan covers dental exams."]
+
+    packed, props = chat_approach.pack_sources(sources, 1000, "gpt-35-turbo")
+
+    assert packed == sources
+    assert props["sources_truncated"] is None
+    assert props["sources_dropped"] == []
+    assert 0 < props["sources_tokens"] <= 1000
+
+
+def test_pack_sources_truncates_at_sentence(chat_approach):
+    sources = [
+        "a.pdf#page=1: The plan covers eye exams.",
+        "b.pdf#page=2: The plan covers dental exams. Braces are not covered. " + "Contact lenses are covered. " * 50,
+        "c.pdf#page=3: The plan covers hearing aids.",
+    ]
+    truncated_source = "b.pdf#page=2: The plan covers dental exams. Braces are not covered."
+    budget = sum(count + 1 for count in num_tokens_from_texts([sources[0], truncated_source], "gpt-35-turbo")) + 2
+
+    packed, props = chat_approach.pack_sources(sources, budget, "gpt-35-turbo")
+
+    assert packed == [sources[0], truncated_source]
+    assert props["sources_truncated"] == "b.pdf#page=2"
+    assert props["sources_dropped"] == ["c.pdf#page=3"]
+    assert props["sources_tokens"] <= budget
+
+
+def test_pack_sources_drops_without_sentence(chat_approach):
+    sources = ["a.pdf#page=1: The plan covers eye exams and dental exams and hearing aids and more"]
+
+    packed, props = chat_approach.pack_sources(sources, 5, "gpt-35-turbo")
+
+    assert packed == []
+    assert props["sources_dropped"] == ["a.pdf#page=1"]
+    assert props["sources_truncated"] is None
+
+
+def test_pack_sources_japanese(chat_approach):
+    sources = [
+        "a.pdf#page=1: 眼科検診はカバーされています。歯科検診もカバーされています。" + "補聴器は対象外です。" * 50
+    ]
+    truncated_source = "a.pdf#page=1: 眼科検診はカバーされています。"
+    budget = num_tokens_from_texts([truncated_source], "gpt-35-turbo")[0] + 3
+
+    packed, props = chat_approach.pack_sources(sources, budget, "gpt-35-turbo")
+
+    assert packed == [truncated_source]
+    assert props["sources_truncated"] == "a.pdf#page=1"
+
+
+def test_get_sources_token_budget(chat_approach):
+    budget = chat_approach.get_sources_token_budget("You are a bot.", "gpt-35-turbo", [], "What is covered?", 3000)
+    assert 2900 < budget < 3000
+
+    # The history is counted against the budget
+    history = [
+        {"role": "user", "content": "What happens in a performance review? " * 20},
+        {"role": "assistant", "content": "The supervisor discusses the employee's performance. " * 20},
+        {"role": "user", "content": "What is covered?"},
+    ]
+    history_budget = chat_approach.get_sources_token_budget(
+        "You are a bot.", "gpt-35-turbo", history, "What is covered?", 3000
+    )
+    assert history_budget < budget
+
+    # But a very long history doesn't take the share of the budget that is kept for the sources
+    long_history = history[:-1] * 50 + history[-1:]
+    long_history_budget = chat_approach.get_sources_token_budget(
+        "You are a bot.", "gpt-35-turbo", long_history, "What is covered?", 3000
+    )
+    assert long_history_budget == int(budget * chat_approach.sources_min_token_share)
+
+
+def test_should_rewrite_query(chat_approach):
+    first_turn = [{"role": "user", "content": "What does a Product Manager do?"}]
+    follow_up = [
+        {"role": "user", "content": "What does a Product Manager do?"},
+        {"role": "assistant", "content": "A Product Manager leads the product strategy [role_library.pdf]."},
+        {"role": "user", "content": "And what about the salary?"},
+    ]
+    keywords = follow_up[:-1] + [{"role": "user", "content": "Product Manager salary"}]
+
+    assert chat_approach.should_rewrite_query(first_turn, {}) == (True, "always")
+    assert chat_approach.should_rewrite_query(follow_up, {"query_rewrite_mode": "never"}) == (False, "never")
+    assert chat_approach.should_rewrite_query(first_turn, {"query_rewrite_mode": "heuristic"}) == (False, "first_turn")
+    assert chat_approach.should_rewrite_query(keywords, {"query_rewrite_mode": "heuristic"}) == (False, "keyword_query")
+    assert chat_approach.should_rewrite_query(follow_up, {"query_rewrite_mode": "heuristic"}) == (True, "follow_up")
+    # Unknown modes fall back to the deployment's mode
+    assert chat_approach.should_rewrite_query(first_turn, {"query_rewrite_mode": "sometimes"}) == (True, "always")
+
+    chat_approach.query_rewrite_mode = "heuristic"
+    assert chat_approach.should_rewrite_query(first_turn, {}) == (False, "first_turn")
+    assert chat_approach.should_rewrite_query(first_turn, {"query_rewrite_mode": "always"}) == (True, "always")
+
+
+def test_is_keyword_query(chat_approach):
+    assert chat_approach.is_keyword_query("Product Manager salary")
+    assert chat_approach.is_keyword_query("あべし 人物 歴史")
+    assert not chat_approach.is_keyword_query("What is the salary?")
+    assert not chat_approach.is_keyword_query("あべしの功績を教えてください。")
+    assert not chat_approach.is_keyword_query("what does the product manager do at the company")
+
+
+@pytest.mark.asyncio
+async def test_rewrite_query(chat_approach):
+    history = [{"role": "user", "content": "What does a Product Manager do?"}]
+    calls = 0
+
+    async def generate_search_query():
+        nonlocal calls
+        calls += 1
+        return "product manager role"
+
+    query, props = await chat_approach.rewrite_query(history, {}, generate_search_query)
+    assert query == "product manager role"
+    assert props["query_rewrite"] == "rewritten"
+    assert props["query_rewrite_reason"] == "always"
+    assert "query_rewrite_ms" in props
+    assert chat_approach.query_rewrite_average_ms is not None
+
+    query, props = await chat_approach.rewrite_query(history, {"query_rewrite_mode": "never"}, generate_search_query)
+    assert query == "What does a Product Manager do?"
+    assert props == {"query_rewrite": "skipped", "query_rewrite_reason": "never"}
+    assert calls == 1
+
+
+def test_should_speculate(chat_approach):
+    first_turn = [{"role": "user", "content": "What does a Product Manager do?"}]
+
+    assert chat_approach.should_speculate(first_turn, {}) is False
+    assert chat_approach.should_speculate(first_turn, {"speculative_retrieval": True}) is True
+    # The question is searched as is when the rewrite is skipped, so there's nothing to speculate on
+    assert (
+        chat_approach.should_speculate(first_turn, {"speculative_retrieval": True, "query_rewrite_mode": "never"})
+        is False
+    )
+
+    chat_approach.speculative_retrieval = True
+    assert chat_approach.should_speculate(first_turn, {}) is True
+    assert chat_approach.should_speculate(first_turn, {"speculative_retrieval": False}) is False
+
+
+def test_is_same_search_query(chat_approach):
+    assert chat_approach.is_same_search_query("What does a Product Manager do?", "what does a product manager do")
+    assert chat_approach.is_same_search_query("あべしの功績は？", "あべしの功績は")
+    assert not chat_approach.is_same_search_query("What does a Product Manager do?", "product manager role")
+
+
+def test_cosine_similarity(chat_approach):
+    assert chat_approach.cosine_similarity([1.0, 0.0], [2.0, 0.0]) == pytest.approx(1.0)
+    assert chat_approach.cosine_similarity([1.0, 0.0], [0.0, 1.0]) == pytest.approx(0.0)
+    assert chat_approach.cosine_similarity([0.0, 0.0], [1.0, 0.0]) == 0.0
+
+
+def make_speculation(query, results, delay=0.0):
+    async def speculate():
+        await asyncio.sleep(delay)
+        return ([], results, {"search_cache_hit": False, "query": query}), 50.0
+
+    return asyncio.create_task(speculate())
+
+
+def make_retrieve(calls):
+    async def retrieve(query, vectors=None):
+        calls.append((query, vectors))
+        return vectors or [], ["fresh"], {"search_cache_hit": False, "query": query}
+
+    return retrieve
+
+
+def make_compute_embedding(vectors):
+    async def compute_embedding(query):
+        return RawVectorQuery(vector=vectors[query], k=50, fields="embedding")
+
+    return compute_embedding
+
+
+@pytest.mark.asyncio
+async def test_resolve_speculation_exact(chat_approach):
+    calls = []
+    speculation = make_speculation("What is my health plan?", ["speculative"])
+
+    (_, results, _), props = await chat_approach.resolve_speculation(
+        speculation, "What is my health plan?", "what is my health plan", make_retrieve(calls), None
+    )
+
+    assert results == ["speculative"]
+    assert props["speculative_retrieval"] == "hit_exact"
+    # The results were retrieved for the question, not the generated query
+    assert props["speculative_query"] == "What is my health plan?"
+    assert 0 <= props["speculative_saved_ms"] <= 50.0
+    assert calls == []
+
+
+@pytest.mark.asyncio
+async def test_resolve_speculation_similar(chat_approach):
+    calls = []
+    speculation = make_speculation("What is my health plan?", ["speculative"])
+    compute_embedding = make_compute_embedding(
+        {"What is my health plan?": [1.0, 0.0, 0.1], "health plan": [1.0, 0.01, 0.1]}
+    )
+
+    (_, results, _), props = await chat_approach.resolve_speculation(
+        speculation, "What is my health plan?", "health plan", make_retrieve(calls), compute_embedding
+    )
+
+    assert results == ["speculative"]
+    assert props["speculative_retrieval"] == "hit_similar"
+    assert props["speculative_similarity"] >= chat_approach.speculative_min_similarity
+    assert props["speculative_query"] == "What is my health plan?"
+    assert calls == []
+
+
+@pytest.mark.asyncio
+async def test_resolve_speculation_miss(chat_approach):
+    calls = []
+    speculation = make_speculation("What does it cover?", ["speculative"], delay=10)
+    compute_embedding = make_compute_embedding(
+        {"What does it cover?": [1.0, 0.0, 0.0], "Northwind Health Plus coverage": [0.0, 1.0, 0.0]}
+    )
+
+    (vectors, results, _), props = await chat_approach.resolve_speculation(
+        speculation, "What does it cover?", "Northwind Health Plus coverage", make_retrieve(calls), compute_embedding
+    )
+
+    assert results == ["fresh"]
+    assert props == {"speculative_retrieval": "miss", "speculative_similarity": 0.0}
+    # The embedding of the generated query is reused for the search
+    assert len(calls) == 1
+    assert calls[0][0] == "Northwind Health Plus coverage"
+    assert vectors[0].vector == [0.0, 1.0, 0.0]
+    await asyncio.sleep(0)
+    assert speculation.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_resolve_speculation_text_only_miss(chat_approach):
+    calls = []
+    speculation = make_speculation("What does it cover?", ["speculative"])
+
+    (_, results, _), props = await chat_approach.resolve_speculation(
+        speculation, "What does it cover?", "Northwind Health Plus coverage", make_retrieve(calls), None
+    )
+
+    assert results == ["fresh"]
+    assert props == {"speculative_retrieval": "miss"}
+    assert calls == [("Northwind Health Plus coverage", None)]
+
+
+@pytest.mark.asyncio
+async def test_resolve_speculation_error(chat_approach):
+    calls = []
+
+    async def speculate():
+        raise ValueError("Search failed")
+
+    speculation = asyncio.create_task(speculate())
+
+    (_, results, _), props = await chat_approach.resolve_speculation(
+        speculation, "What is my health plan?", "What is my health plan?", make_retrieve(calls), None
+    )
+
+    assert results == ["fresh"]
+    assert props == {"speculative_retrieval": "error"}
+    assert calls == [("What is my health plan?", None)]
+
+
+async def stream_with_followups(chat_approach, monkeypatch, deltas):
+    async def stream():
+        for i, delta in enumerate(deltas):
+            finish_reason = "stop" if i == len(deltas) - 1 else None
+            yield ChatCompletionChunk.model_validate(
+                {
+                    "id": "test-id",
+                    "object": "chat.completion.chunk",
+                    "created": 1,
+                    "model": "gpt-35-turbo",
+                    "choices": [
+                        {"delta": {"role": "assistant", "content": delta}, "index": 0, "finish_reason": finish_reason}
+                    ],
+                }
+            )
+
+    async def run_until_final_call(history, overrides, auth_claims, should_stream):
+        async def chat_coroutine():
+            return stream()
+
+        return {"thoughts": []}, chat_coroutine()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", run_until_final_call)
+
+    return [
+        event
+        async for event in chat_approach.run_with_streaming(
+            [{"role": "user", "content": "What is the capital of France?"}], {"suggest_followup_questions": True}, {}
+        )
+    ]
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_split_followup_markers(chat_approach, monkeypatch):
+    events = await stream_with_followups(
+        chat_approach,
+        monkeypatch,
+        [
+            None,
+            "The capital of France is Paris. <",
+            "<What is the capital of Spain?>",
+            "><",
+            "<What about Italy?>>",
+            # The last chunk only carries the finish reason
+            None,
+        ],
+    )
+
+    assert [event["choices"][0]["delta"].get("content") for event in events] == [
+        None,
+        None,
+        "The capital of France is Paris. ",
+        None,
+        None,
+        None,
+    ]
+    assert [event["choices"][0].get("context", {}).get("followup_questions") for event in events[3:5]] == [
+        ["What is the capital of Spain?"],
+        ["What is the capital of Spain?", "What about Italy?"],
+    ]
+    assert events[-1]["choices"][0]["finish_reason"] == "stop"
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_followup_in_last_chunk(chat_approach, monkeypatch):
+    events = await stream_with_followups(
+        chat_approach,
+        monkeypatch,
+        [None, "The capital of France is Paris. <<What is the capital of Spain?>", "><<What about Italy?>>"],
+    )
+
+    # The follow-up markup in the chunk with the finish reason isn't sent as content
+    assert [event["choices"][0]["delta"].get("content") for event in events] == [
+        None,
+        None,
+        "The capital of France is Paris. ",
+        None,
+        None,
+    ]
+    assert events[-2]["choices"][0]["finish_reason"] == "stop"
+    assert events[-1]["choices"][0]["context"]["followup_questions"] == [
+        "What is the capital of Spain?",
+        "What about Italy?",
+    ]
+
+
+def test_get_chunk_event(chat_approach):
+    chunk = ChatCompletionChunk.model_validate(
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "delta": {"content": "Paris"},
+                    "index": 0,
+                    "finish_reason": None,
+                    "logprobs": None,
+                    "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}},
+                }
+            ],
+        }
+    )
+
+    assert chat_approach.get_chunk_event(chunk, "Paris") == {
+        "id": "test-id",
+        "choices": [{"delta": {"content": "Paris", "role": None}, "finish_reason": None, "index": 0}],
+        "created": 1,
+        "model": "gpt-35-turbo",
+        "object": "chat.completion.chunk",
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_response_context(chat_approach, caplog):
+    extra_info = {"data_points": {"text": ["Benefit_Options-2.pdf: Paris"]}, "thoughts": ["thought"]}
+
+    assert await chat_approach.get_response_context(extra_info, {}, {}) is extra_info
+    assert await chat_approach.get_response_context(extra_info, {"thoughts_mode": "none"}, {}) == {
+        "data_points": extra_info["data_points"]
+    }
+    # Without a thoughts store, deferred thoughts are left out
+    assert await chat_approach.get_response_context(extra_info, {"thoughts_mode": "deferred"}, {}) == {
+        "data_points": extra_info["data_points"]
+    }
+
+    chat_approach.thoughts_store = TTLCache(maxsize=10, ttl=60)
+    context = await chat_approach.get_response_context(extra_info, {"thoughts_mode": "deferred"}, {"oid": "OID_X"})
+    assert "thoughts" not in context
+    assert chat_approach.thoughts_store.get(context["thoughts_id"]) == {"oid": "OID_X", "thoughts": ["thought"]}
+
+    chat_approach.thoughts_mode = "none"
+    assert await chat_approach.get_response_context(extra_info, {"thoughts_mode": "full"}, {}) is extra_info
+    assert "thoughts" not in (await chat_approach.get_response_context(extra_info, {"thoughts_mode": "bogus"}, {}))
+    assert "Unknown thoughts mode bogus" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_cache_streamed_answer(chat_approach):
+    chat_approach.answer_cache = SemanticAnswerCache(maxsize=10, ttl=60)
+    extra_info = {"data_points": {"text": ["Benefit_Options-2.pdf: Paris"]}, "thoughts": ["thought"]}
+
+    async def events():
+        yield chat_approach.get_context_event(extra_info, None)
+        yield {"choices": [{"delta": {"content": "Paris", "role": None}, "finish_reason": None, "index": 0}]}
+        yield {"choices": [{"delta": {"content": ".", "role": None}, "finish_reason": "stop", "index": 0}]}
+        yield chat_approach.get_followup_event(["What is the capital of Spain?"])
+
+    answer_key = ("scope", [1.0, 0.0])
+    streamed = [
+        event
+        async for event in chat_approach.cache_streamed_answer(
+            events(), answer_key, "What is the capital of France?", {"thoughts_mode": "none"}, {}
+        )
+    ]
+    # The request's thoughts mode applies to what's sent, while the cache keeps the full context
+    assert "thoughts" not in streamed[0]["choices"][0]["context"]
+    cached, similarity = chat_approach.answer_cache.get("scope", [1.0, 0.0])
+    assert cached == CachedAnswer(
+        question="What is the capital of France?",
+        content="Paris.",
+        context={**extra_info, "followup_questions": ["What is the capital of Spain?"]},
+    )
+
+    replayed = [event async for event in chat_approach.replay_cached_answer(cached, similarity, {}, {}, "state")]
+    assert replayed[0]["choices"][0]["context"] == {
+        "data_points": extra_info["data_points"],
+        "thoughts": [
+            "thought",
+            ThoughtStep(
+                "Answer cache hit", "What is the capital of France?", {"answer_cache_hit": True, "similarity": 1.0}
+            ),
+        ],
+    }
+    assert replayed[0]["choices"][0]["session_state"] == "state"
+    assert [event["choices"][0]["delta"].get("content") for event in replayed[1:]] == ["Paris.", None, None]
+    assert replayed[2] == chat_approach.get_followup_event(["What is the capital of Spain?"])
+    assert replayed[3]["choices"][0]["finish_reason"] == "stop"
+
+
+@pytest.mark.asyncio
+async def test_cache_streamed_answer_incomplete(chat_approach):
+    chat_approach.answer_cache = SemanticAnswerCache(maxsize=10, ttl=60)
+
+    async def events():
+        yield chat_approach.get_context_event({"data_points": {"text": []}}, None)
+        yield {"choices": [{"delta": {"content": "Paris", "role": None}, "finish_reason": "length", "index": 0}]}
+
+    streamed = [
+        event async for event in chat_approach.cache_streamed_answer(events(), ("scope", [1.0, 0.0]), "Paris?", {}, {})
+    ]
+    assert len(streamed) == 2
+    # Answers cut short aren't cached
+    assert len(chat_approach.answer_cache) == 0
@@ -1,3 +1,4 @@
+import asyncio
 import json
 
 import pytest
@@ -5,10 +6,16 @@ from azure.search.documents.indexes.models import SearchField, SearchIndex
 from azure.search.documents.models import (
     RawVectorQuery,
 )
+from openai.types import CreateEmbeddingResponse, Embedding
 from openai.types.chat import ChatCompletion
+from openai.types.create_embedding_response import Usage
 
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from core.authentication import AuthenticationHelper
+from core.cache import TTLCache
+from core.singleflight import SingleFlight
+
+from .mocks import MockAsyncSearchResultsIterator
 
 
 class MockOpenAIClient:
@@ -19,6 +26,17 @@ class MockOpenAIClient:
         pass
 
 
+class MockSearchClient:
+    def __init__(self):
+        self.search_kwargs = {}
+
+    async def search(self, *args, **kwargs):
+        self.search_kwargs = kwargs
+        return MockAsyncSearchResultsIterator(
+            kwargs.get("search_text"), kwargs.get("vector_queries"), kwargs.get("select")
+        )
+
+
 MockSearchIndex = SearchIndex(
     name="test",
     fields=[
@@ -143,3 +161,271 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k == 50
     assert result.fields == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached(chat_approach, openai_client, monkeypatch):
+    calls = 0
+
+    async def mock_acreate(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[Embedding(embedding=[0.1, 0.2, 0.3], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=2, total_tokens=2),
+        )
+
+    monkeypatch.setattr(openai_client.embeddings, "create", mock_acreate)
+    chat_approach.embedding_cache = TTLCache(maxsize=10, ttl=60)
+
+    first = await chat_approach.compute_text_embedding("test  query")
+    second = await chat_approach.compute_text_embedding(" test query ")
+    assert first.vector == second.vector == [0.1, 0.2, 0.3]
+    assert calls == 1
+    assert chat_approach.embedding_cache.hits == 1
+
+    # Callers can opt out of the cache, for example through the use_embedding_cache override
+    await chat_approach.compute_text_embedding("test query", use_cache=False)
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_compute_image_embedding_cached(chat_approach, mock_compute_embeddings_call):
+    chat_approach.embedding_cache = TTLCache(maxsize=10, ttl=60)
+
+    first = await chat_approach.compute_image_embedding("test query", "endpoint", "key")
+    assert first.fields == "imageEmbedding"
+    assert chat_approach.embedding_cache.misses == 1
+
+    second = await chat_approach.compute_image_embedding("test query", "endpoint", "key")
+    assert second.vector == first.vector
+    assert chat_approach.embedding_cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors_concurrently(chat_approach, openai_client, mock_openai_embedding, monkeypatch):
+    mock_openai_embedding(openai_client)
+    started = []
+    both_started = asyncio.Event()
+
+    async def mock_compute_image_embedding(self, q, vision_endpoint, vision_key, use_cache=True):
+        started.append("imageEmbedding")
+        await asyncio.wait_for(both_started.wait(), 1)
+        return RawVectorQuery(vector=[1.0], k=50, fields="imageEmbedding")
+
+    original_compute_text_embedding = ChatReadRetrieveReadVisionApproach.compute_text_embedding
+
+    async def mock_compute_text_embedding(self, q, use_cache=True):
+        started.append("embedding")
+        both_started.set()
+        return await original_compute_text_embedding(self, q, use_cache)
+
+    monkeypatch.setattr(ChatReadRetrieveReadVisionApproach, "compute_image_embedding", mock_compute_image_embedding)
+    monkeypatch.setattr(ChatReadRetrieveReadVisionApproach, "compute_text_embedding", mock_compute_text_embedding)
+
+    vectors, props = await chat_approach.compute_vectors(
+        "test query", ["imageEmbedding", "embedding"], "endpoint", "key", timeout=5
+    )
+
+    # The image embedding only completes once the text embedding has started
+    assert sorted(started) == ["embedding", "imageEmbedding"]
+    assert [vector.fields for vector in vectors] == ["imageEmbedding", "embedding"]
+    assert set(props["vector_latency_ms"]) == {"embedding", "imageEmbedding"}
+    assert props["vector_fields_failed"] == []
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors_partial_failure(chat_approach, openai_client, mock_openai_embedding, monkeypatch):
+    mock_openai_embedding(openai_client)
+
+    async def mock_compute_image_embedding(self, q, vision_endpoint, vision_key, use_cache=True):
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(ChatReadRetrieveReadVisionApproach, "compute_image_embedding", mock_compute_image_embedding)
+
+    vectors, props = await chat_approach.compute_vectors(
+        "test query", ["embedding", "imageEmbedding"], "endpoint", "key", timeout=0.01
+    )
+
+    assert [vector.fields for vector in vectors] == ["embedding"]
+    assert props["vector_fields_failed"] == ["imageEmbedding"]
+    assert "imageEmbedding" not in props["vector_latency_ms"]
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors_all_failed(chat_approach, monkeypatch):
+    async def mock_compute_text_embedding(self, q, use_cache=True):
+        raise ValueError("embedding failed")
+
+    monkeypatch.setattr(ChatReadRetrieveReadVisionApproach, "compute_text_embedding", mock_compute_text_embedding)
+
+    with pytest.raises(ValueError):
+        await chat_approach.compute_vectors("test query", ["embedding"], "endpoint", "key")
+
+
+@pytest.mark.asyncio
+async def test_search_selects_fields(chat_approach):
+    chat_approach.search_client = MockSearchClient()
+
+    results = await chat_approach.search(3, "interest rates", None, [], False, False)
+
+    assert chat_approach.search_client.search_kwargs["select"] == [
+        "id",
+        "content",
+        "category",
+        "sourcepage",
+        "sourcefile",
+        "oids",
+        "groups",
+    ]
+    assert results[0].sourcepage == "Financial Market Analysis Report 2023-6.png"
+    assert results[0].embedding is None
+
+
+@pytest.mark.asyncio
+async def test_search_include_vectors(chat_approach):
+    chat_approach.search_client = MockSearchClient()
+
+    results = await chat_approach.search(3, "interest rates", None, [], False, False, include_vectors=True)
+
+    assert chat_approach.search_client.search_kwargs["select"] is None
+    assert results[0].embedding is not None
+
+
+@pytest.mark.asyncio
+async def test_search_with_cache(chat_approach):
+    chat_approach.search_client = MockSearchClient()
+    chat_approach.search_cache = TTLCache()
+    vectors = [RawVectorQuery(vector=[0.1, 0.2], k=50, fields="embedding")]
+
+    results, props = await chat_approach.search_with_cache(
+        3, "interest rates", "oids/any(g:search.in(g, 'A'))", vectors, False, False
+    )
+    assert props == {"search_cache_hit": False}
+    chat_approach.search_client = None
+
+    cached_results, props = await chat_approach.search_with_cache(
+        3, "interest rates", "oids/any(g:search.in(g, 'A'))", vectors, False, False
+    )
+    assert props == {"search_cache_hit": True}
+    assert cached_results == results
+
+
+@pytest.mark.asyncio
+async def test_search_with_cache_key_includes_filter_and_vectors(chat_approach):
+    chat_approach.search_client = MockSearchClient()
+    chat_approach.search_cache = TTLCache()
+    vectors = [RawVectorQuery(vector=[0.1, 0.2], k=50, fields="embedding")]
+
+    await chat_approach.search_with_cache(3, "interest rates", "oids/any(g:search.in(g, 'A'))", vectors, False, False)
+
+    # A user with different access must not get the cached results
+    _, props = await chat_approach.search_with_cache(
+        3, "interest rates", "oids/any(g:search.in(g, 'B'))", vectors, False, False
+    )
+    assert props == {"search_cache_hit": False}
+
+    other_vectors = [RawVectorQuery(vector=[0.3, 0.4], k=50, fields="embedding")]
+    _, props = await chat_approach.search_with_cache(
+        3, "interest rates", "oids/any(g:search.in(g, 'A'))", other_vectors, False, False
+    )
+    assert props == {"search_cache_hit": False}
+
+
+@pytest.mark.asyncio
+async def test_search_with_cache_disabled(chat_approach):
+    chat_approach.search_client = MockSearchClient()
+    chat_approach.search_cache = TTLCache()
+
+    await chat_approach.search_with_cache(3, "interest rates", None, [], False, False, use_cache=False)
+    _, props = await chat_approach.search_with_cache(3, "interest rates", None, [], False, False, use_cache=False)
+
+    assert props == {"search_cache_hit": False}
+    assert len(chat_approach.search_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_single_flight(chat_approach, openai_client, monkeypatch):
+    calls = 0
+    release = asyncio.Event()
+
+    async def mock_acreate(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[Embedding(embedding=[0.1, 0.2, 0.3], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=2, total_tokens=2),
+        )
+
+    monkeypatch.setattr(openai_client.embeddings, "create", mock_acreate)
+    chat_approach.single_flight = SingleFlight()
+
+    waiters = [asyncio.create_task(chat_approach.compute_text_embedding("test query")) for _ in range(3)]
+    await asyncio.sleep(0)
+    # One client disconnecting doesn't cancel the call for the others
+    waiters[0].cancel()
+    release.set()
+
+    results = await asyncio.gather(*waiters[1:])
+    assert [result.vector for result in results] == [[0.1, 0.2, 0.3]] * 2
+    assert calls == 1
+    assert waiters[0].cancelled()
+
+
+@pytest.mark.asyncio
+async def test_search_single_flight(chat_approach):
+    search_client = MockSearchClient()
+    calls = 0
+    release = asyncio.Event()
+
+    async def mock_search(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return await MockSearchClient.search(search_client, *args, **kwargs)
+
+    chat_approach.search_client = MockSearchClient()
+    chat_approach.search_client.search = mock_search
+    chat_approach.single_flight = SingleFlight()
+
+    waiters = [
+        asyncio.create_task(chat_approach.search_with_cache(3, "interest rates", None, [], False, False))
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*waiters)
+
+    assert calls == 1
+    assert results[0] == results[1] == results[2]
+    # Every caller gets its own list of results
+    assert results[0][0] is not results[1][0]
+
+
+@pytest.mark.asyncio
+async def test_search_single_flight_error(chat_approach):
+    release = asyncio.Event()
+
+    async def mock_search(*args, **kwargs):
+        await release.wait()
+        raise ValueError("search failed")
+
+    chat_approach.search_client = MockSearchClient()
+    chat_approach.search_client.search = mock_search
+    chat_approach.single_flight = SingleFlight()
+
+    waiters = [
+        asyncio.create_task(chat_approach.search_with_cache(3, "interest rates", None, [], False, False))
+        for _ in range(2)
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(chat_approach.single_flight) == 0
@@ -15,8 +15,8 @@ import app
 from .mocks import MockAzureCredential
 
 
-@pytest.mark.asyncio
-async def test_content_file(monkeypatch, mock_env, mock_acs_search):
+@pytest.fixture
+def content_blob_container_client(mock_env):
     class MockAiohttpClientResponse404(aiohttp.ClientResponse):
         def __init__(self, url, body_bytes, headers=None):
             self._body = body_bytes
@@ -27,29 +27,81 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
             self._url = url
 
     class MockAiohttpClientResponse(aiohttp.ClientResponse):
-        def __init__(self, url, body_bytes, headers=None):
+        def __init__(self, url, body_bytes, headers=None, status=200):
             self._body = body_bytes
             self._headers = headers
             self._cache = {}
-            self.status = 200
+            self.status = status
             self.reason = "OK"
             self._url = url
 
+    content = b"test content"
+    properties_headers = {
+        "Content-Type": "application/octet-stream",
+        "Content-Length": str(len(content)),
+        "ETag": '"0x8DC1234567890AB"',
+        "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+    }
+
+    # The ETags of changed.pdf, which is replaced after its properties are first read,
+    # and of replaced.pdf, which is replaced every time its properties are read
+    changed_etags = ['"0xOLD"', '"0xNEW"']
+    replaced_etags = [f'"0x{version}"' for version in range(10)]
+
     class MockTransport(AsyncHttpTransport):
         async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
             if request.url.endswith("notfound.pdf"):
                 raise ResourceNotFoundError(MockAiohttpClientResponse404(request.url, b""))
+            elif request.url.endswith("empty.pdf"):
+                assert request.method == "HEAD", "An empty blob shouldn't be downloaded"
+                return AioHttpTransportResponse(
+                    request,
+                    MockAiohttpClientResponse(request.url, b"", {**properties_headers, "Content-Length": "0"}),
+                )
+            elif request.url.endswith(("changed.pdf", "replaced.pdf")):
+                etags = changed_etags if request.url.endswith("changed.pdf") else replaced_etags
+                if request.method == "HEAD":
+                    etag = etags.pop(0) if len(etags) > 1 else etags[0]
+                    return AioHttpTransportResponse(
+                        request, MockAiohttpClientResponse(request.url, b"", {**properties_headers, "ETag": etag})
+                    )
+                if request.headers["If-Match"] != etags[0]:
+                    return AioHttpTransportResponse(
+                        request,
+                        MockAiohttpClientResponse(request.url, b"", {"x-ms-error-code": "ConditionNotMet"}, status=412),
+                    )
+                return AioHttpTransportResponse(
+                    request,
+                    MockAiohttpClientResponse(
+                        request.url,
+                        content[:4],
+                        {
+                            **properties_headers,
+                            "ETag": etags[0],
+                            "Content-Range": "bytes 0-3/12",
+                            "Content-Length": "4",
+                        },
+                        status=206,
+                    ),
+                )
+            elif request.method == "HEAD":
+                return AioHttpTransportResponse(
+                    request, MockAiohttpClientResponse(request.url, b"", properties_headers)
+                )
             else:
+                # The blob is downloaded in ranges, which are inclusive of the end
+                start, end = map(int, request.headers["x-ms-range"].removeprefix("bytes=").split("-"))
                 return AioHttpTransportResponse(
                     request,
                     MockAiohttpClientResponse(
                         request.url,
-                        b"test content",
+                        content[start : end + 1],
                         {
-                            "Content-Type": "application/octet-stream",
-                            "Content-Range": "bytes 0-27/28",
-                            "Content-Length": "28",
+                            **properties_headers,
+                            "Content-Range": f"bytes {start}-{end}/{len(content)}",
+                            "Content-Length": str(end + 1 - start),
                         },
+                        status=206,
                     ),
                 )
 
@@ -71,12 +123,18 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
         credential=MockAzureCredential(),
         transport=MockTransport(),
         retry_total=0,  # Necessary to avoid unnecessary network requests during tests
+        # Small chunks so that the responses are streamed from several blob downloads
+        max_single_get_size=4,
+        max_chunk_get_size=4,
     )
-    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    return blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
 
+@pytest.mark.asyncio
+async def test_content_file(monkeypatch, mock_env, mock_acs_search, content_blob_container_client):
     quart_app = app.create_app()
     async with quart_app.test_app() as test_app:
-        quart_app.config.update({"blob_container_client": blob_container_client})
+        quart_app.config.update({"blob_container_client": content_blob_container_client})
 
         client = test_app.test_client()
         response = await client.get("/content/notfound.pdf")
@@ -91,3 +149,80 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
         assert await response.get_data() == b"test content"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 5-11/12"
+        assert response.headers["Content-Length"] == "7"
+        assert await response.get_data() == b"content"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=100-"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */12"
+
+        # A range for a different version of the file returns the whole file
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-", "If-Range": '"0xOTHER"'})
+        assert response.status_code == 200
+        assert await response.get_data() == b"test content"
+
+
+@pytest.mark.asyncio
+async def test_content_file_conditional(monkeypatch, mock_env, mock_acs_search, content_blob_container_client):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": content_blob_container_client})
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert etag == '"0x8DC1234567890AB"'
+        assert response.headers["Last-Modified"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert await response.get_data() == b""
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": '"0xOTHER"'})
+        assert response.status_code == 200
+
+        response = await client.get(
+            "/content/role_library.pdf", headers={"If-Modified-Since": "Tue, 02 Jan 2024 00:00:00 GMT"}
+        )
+        assert response.status_code == 304
+
+        response = await client.get(
+            "/content/role_library.pdf", headers={"If-Modified-Since": "Sun, 31 Dec 2023 00:00:00 GMT"}
+        )
+        assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_content_file_empty(monkeypatch, mock_env, mock_acs_search, content_blob_container_client):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": content_blob_container_client})
+
+        client = test_app.test_client()
+        response = await client.get("/content/empty.pdf")
+        assert response.status_code == 200
+        assert response.headers["Content-Length"] == "0"
+        assert await response.get_data() == b""
+
+
+@pytest.mark.asyncio
+async def test_content_file_changed(monkeypatch, mock_env, mock_acs_search, content_blob_container_client):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": content_blob_container_client})
+
+        client = test_app.test_client()
+        # The file is replaced between reading its properties and downloading it, so it's opened again
+        response = await client.get("/content/changed.pdf", headers={"Range": "bytes=0-3"})
+        assert response.status_code == 206
+        assert response.headers["ETag"] == '"0xNEW"'
+        assert await response.get_data() == b"test"
+
+        # A file that keeps changing isn't retried indefinitely
+        response = await client.get("/content/replaced.pdf", headers={"Range": "bytes=0-3"})
+        assert response.status_code == 412
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from core.deltacoalescer import DeltaCoalescer
+
+
+def content_event(content, role=None, finish_reason=None):
+    return {
+        "id": "test-id",
+        "choices": [
+            {
+                "delta": {"content": content, "function_call": None, "role": role, "tool_calls": None},
+                "finish_reason": finish_reason,
+                "index": 0,
+            }
+        ],
+        "object": "chat.completion.chunk",
+    }
+
+
+CONTEXT_EVENT = {
+    "choices": [{"delta": {"role": "assistant"}, "context": {"thoughts": []}, "finish_reason": None, "index": 0}],
+    "object": "chat.completion.chunk",
+}
+FOLLOWUP_EVENT = {
+    "choices": [
+        {
+            "delta": {"role": "assistant"},
+            "context": {"followup_questions": ["What is the capital of Spain?"]},
+            "finish_reason": None,
+            "index": 0,
+        }
+    ],
+    "object": "chat.completion.chunk",
+}
+
+
+async def stream(events, delays=None, produced=None):
+    for i, event in enumerate(events):
+        if delays:
+            await asyncio.sleep(delays[i])
+        if produced is not None:
+            produced.append(i)
+        yield event
+
+
+def get_contents(events):
+    return [
+        event["choices"][0]["delta"].get("content") if "context" not in event["choices"][0] else "context"
+        for event in events
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_merges_deltas():
+    coalescer = DeltaCoalescer(max_chars=10, max_delay=10)
+    events = [CONTEXT_EVENT, content_event(None, role="assistant")] + [
+        content_event(token) for token in ["The", " capital", " of", " France", " is", " Paris", "."]
+    ]
+    events.append(content_event(None, finish_reason="stop"))
+
+    result = [event async for event in coalescer.coalesce(stream(events))]
+
+    # The first token is sent on its own, then the tokens are merged until 10 characters have accumulated
+    assert get_contents(result) == ["context", None, "The", " capital of", " France is", " Paris.", None]
+    assert "".join(content or "" for content in get_contents(result)[1:]) == "The capital of France is Paris."
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_before_other_events():
+    coalescer = DeltaCoalescer(max_chars=100, max_delay=10)
+    events = [content_event("Paris"), content_event(" is"), content_event(" the capital."), FOLLOWUP_EVENT]
+
+    result = [event async for event in coalescer.coalesce(stream(events))]
+
+    assert get_contents(result) == ["Paris", " is the capital.", "context"]
+    assert result[-1] is FOLLOWUP_EVENT
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_after_max_delay():
+    coalescer = DeltaCoalescer(max_chars=100, max_delay=0.01)
+    produced: list[int] = []
+    events = [content_event("Paris"), content_event(" is"), content_event(" the"), content_event(" capital.")]
+
+    result = []
+    async for event in coalescer.coalesce(stream(events, delays=[0, 0, 0, 0.2], produced=produced)):
+        result.append((event["choices"][0]["delta"]["content"], list(produced)))
+
+    # The merged deltas are sent once the delay has passed, without waiting for the slow delta after them
+    assert result == [("Paris", [0]), (" is the", [0, 1, 2]), (" capital.", [0, 1, 2, 3])]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_disabled():
+    coalescer = DeltaCoalescer(max_chars=0, max_delay=0.03)
+    events = [content_event(token) for token in ["The", " capital", " of", " France"]]
+
+    assert coalescer.enabled is False
+    assert [event async for event in coalescer.coalesce(stream(events))] == events
+
+
+def test_get_content():
+    assert DeltaCoalescer.get_content(content_event("Paris")) == "Paris"
+    assert DeltaCoalescer.get_content(content_event("")) is None
+    assert DeltaCoalescer.get_content(content_event(None, role="assistant")) is None
+    assert DeltaCoalescer.get_content(content_event("Paris", finish_reason="stop")) is None
+    assert DeltaCoalescer.get_content(CONTEXT_EVENT) is None
+    assert DeltaCoalescer.get_content({"choices": []}) is None
@@ -0,0 +1,111 @@
+import pytest
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.followupparser import FollowupQuestionParser
+
+# Deltas as streamed by the model, split at its token boundaries
+STREAMS = [
+    [
+        "The capital",
+        " of France is Paris",
+        ". [Benefit_Options-2.pdf].",
+        " <<",
+        "What is the capital of Spain?",
+        ">>",
+    ],
+    [
+        "The capital of France is Paris. [Benefit_Options-2.pdf].\n\n",
+        "<",
+        "<What",
+        " is the capital of Spain?>",
+        "><<What is the",
+        " capital of Italy?>><",
+        "<Where is the Eiffel Tower?>",
+        ">",
+    ],
+    [
+        "Northwind Health Plus covers vision exams [Benefit_Options-3.pdf]. <<",
+        "Does it cover contact lenses?>><<Does it cover dental?>>",
+        "<<What is the deductible?>>",
+        "",
+    ],
+    ["No follow-up questions ", "here, but a < sign", " and a > sign."],
+    ["Paris is the capital <", "<What about Spain?>> <<Broken", "> question>> <<What about Italy?>>"],
+    ["Empty <<>> questions <<", ">><<Are skipped?>>"],
+    ["Ends with <"],
+]
+
+
+@pytest.fixture
+def chat_approach():
+    return ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+
+
+def parse(stream: list[str]) -> tuple[str, list[str], list[list[str]]]:
+    parser = FollowupQuestionParser()
+    content = ""
+    completed = []
+    for delta in stream:
+        delta_content, questions = parser.feed(delta)
+        content += delta_content
+        completed.append(questions)
+    content += parser.flush()
+    return content, parser.questions, completed
+
+
+@pytest.mark.parametrize("stream", STREAMS)
+def test_parse_matches_extract_followup_questions(chat_approach, stream):
+    content, questions, _ = parse(stream)
+    expected_content, expected_questions = chat_approach.extract_followup_questions("".join(stream))
+
+    assert content == expected_content
+    assert questions == expected_questions
+
+
+def test_parse_split_markers():
+    content, questions, completed = parse(STREAMS[1])
+
+    assert content == "The capital of France is Paris. [Benefit_Options-2.pdf].\n\n"
+    assert questions == ["What is the capital of Spain?", "What is the capital of Italy?", "Where is the Eiffel Tower?"]
+    # Each question is returned by the delta that completes it
+    assert completed == [
+        [],
+        [],
+        [],
+        [],
+        ["What is the capital of Spain?"],
+        ["What is the capital of Italy?"],
+        [],
+        ["Where is the Eiffel Tower?"],
+    ]
+
+
+def test_feed_holds_back_possible_marker():
+    parser = FollowupQuestionParser()
+
+    assert parser.feed("Paris is the capital <") == ("Paris is the capital ", [])
+    assert parser.feed("3 cities") == ("<3 cities", [])
+    assert parser.feed(" <") == (" ", [])
+    assert parser.feed("<What about Spain?>>") == ("", ["What about Spain?"])
+    assert parser.feed(" Anything after the questions is hidden") == ("", [])
+    assert parser.flush() == ""
+
+
+def test_flush_returns_held_back_content():
+    parser = FollowupQuestionParser()
+
+    assert parser.feed("Ends with <") == ("Ends with ", [])
+    assert parser.flush() == "<"
+    assert parser.flush() == ""
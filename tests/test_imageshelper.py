@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+from approaches.approach import Document
+from core.imageshelper import fetch_images
+
+
+def make_document(sourcepage):
+    return Document(
+        id=None,
+        content=None,
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage=sourcepage,
+        sourcefile=None,
+        oids=None,
+        groups=None,
+        captions=[],
+    )
+
+
+class MockBlob:
+    def __init__(self, name):
+        self.name = name
+        self.properties = {"name": name}
+
+    async def readall(self):
+        return self.name.encode()
+
+
+class MockBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+
+    async def download_blob(self):
+        self.container.active += 1
+        self.container.max_active = max(self.container.max_active, self.container.active)
+        # Finish the first blobs last so that the result order doesn't follow completion order
+        await asyncio.sleep(self.container.delays.get(self.name, 0))
+        self.container.active -= 1
+        if self.name in self.container.missing:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return MockBlob(self.name)
+
+
+class MockContainerClient:
+    def __init__(self, delays={}, missing=[]):
+        self.delays = delays
+        self.missing = missing
+        self.active = 0
+        self.max_active = 0
+
+    def get_blob_client(self, name):
+        return MockBlobClient(self, name)
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_keeps_result_order():
+    container = MockContainerClient(delays={"a-1.png": 0.03, "b-1.png": 0.02, "c-1.png": 0.01})
+    results = [make_document("a-1.png"), make_document("b-1.png"), make_document("c-1.png")]
+
+    images = await fetch_images(container, results, max_concurrency=3)
+
+    assert [image["url"] for image in images] == [
+        "data:image/png;base64,YS0xLnBuZw==",
+        "data:image/png;base64,Yi0xLnBuZw==",
+        "data:image/png;base64,Yy0xLnBuZw==",
+    ]
+    assert container.max_active == 3
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_limits_concurrency():
+    container = MockContainerClient(delays={f"page-{i}.png": 0.01 for i in range(6)})
+    results = [make_document(f"page-{i}.png") for i in range(6)]
+
+    images = await fetch_images(container, results, max_concurrency=2)
+
+    assert len(images) == 6
+    assert container.max_active == 2
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_skips_missing():
+    container = MockContainerClient(missing=["b-1.png"])
+    results = [make_document("a-1.png"), make_document("b-1.png"), make_document(None)]
+
+    images = await fetch_images(container, results)
+
+    assert images == [{"url": "data:image/png;base64,YS0xLnBuZw==", "detail": "auto"}]
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+from core.indexversion import INDEX_VERSION_BLOB_NAME, IndexVersionWatcher
+
+
+class MockBlobProperties:
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class MockBlobClient:
+    def __init__(self, container):
+        self.container = container
+
+    async def get_blob_properties(self):
+        self.container.calls += 1
+        if self.container.error:
+            raise self.container.error
+        if self.container.etag is None:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return MockBlobProperties(self.container.etag)
+
+
+class MockContainerClient:
+    def __init__(self, etag=None):
+        self.etag = etag
+        self.error = None
+        self.calls = 0
+        self.blob_names = []
+
+    def get_blob_client(self, name):
+        self.blob_names.append(name)
+        return MockBlobClient(self)
+
+
+@pytest.mark.asyncio
+async def test_check_calls_on_change_when_version_changes():
+    container = MockContainerClient(etag='"0x1"')
+    changes = []
+    watcher = IndexVersionWatcher(container, on_change=lambda: changes.append(True))
+
+    # The first check counts as a change, the index may have been updated before the app started
+    assert await watcher.check() is True
+    assert await watcher.check() is False
+    container.etag = '"0x2"'
+    assert await watcher.check() is True
+    assert len(changes) == 2
+    assert container.blob_names[0] == INDEX_VERSION_BLOB_NAME
+
+
+@pytest.mark.asyncio
+async def test_check_awaits_async_on_change():
+    container = MockContainerClient(etag='"0x1"')
+    changes = []
+
+    async def on_change():
+        await asyncio.sleep(0)
+        changes.append(True)
+
+    watcher = IndexVersionWatcher(container, on_change=on_change)
+    assert await watcher.check() is True
+    assert changes == [True]
+
+
+@pytest.mark.asyncio
+async def test_check_missing_marker():
+    container = MockContainerClient(etag=None)
+    changes = []
+    watcher = IndexVersionWatcher(container, on_change=lambda: changes.append(True))
+
+    assert await watcher.check() is True
+    assert await watcher.check() is False
+    container.etag = '"0x1"'
+    assert await watcher.check() is True
+    assert len(changes) == 2
+
+
+@pytest.mark.asyncio
+async def test_run_polls_and_survives_errors():
+    container = MockContainerClient(etag='"0x1"')
+    container.error = ValueError("storage unavailable")
+    changes = []
+    watcher = IndexVersionWatcher(container, on_change=lambda: changes.append(True), interval=0.01)
+
+    watcher.start()
+    await asyncio.sleep(0.05)
+    assert container.calls >= 2
+    assert changes == []
+
+    container.error = None
+    await asyncio.sleep(0.05)
+    assert changes == [True]
+
+    await watcher.close()
+    assert watcher.task is None
+    calls = container.calls
+    await asyncio.sleep(0.03)
+    assert container.calls == calls
+
+
+@pytest.mark.asyncio
+async def test_start_disabled():
+    watcher = IndexVersionWatcher(MockContainerClient(), on_change=lambda: None, interval=0)
+    watcher.start()
+    assert watcher.task is None
+    await watcher.close()
@@ -1,3 +1,4 @@
+from core.cache import TTLCache
 from core.messagebuilder import MessageBuilder
 
 
@@ -47,3 +48,34 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_messagebuilder_append_message():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    builder.append_message("user", "Hello, how are you?")
+    builder.append_message("assistant", "a\u0301")
+    assert builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "á"},
+    ]
+
+
+def test_messagebuilder_token_count_cache():
+    cache: TTLCache[int] = TTLCache()
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo", token_count_cache=cache)
+    message = {"role": "user", "content": "Hello, how are you?"}
+
+    count = builder.count_tokens_for_message(message)
+    assert builder.count_tokens_for_message(dict(message)) == count
+    assert cache.hits == 1
+    assert len(cache) == 1
+
+    # Another request's builder reuses the counts
+    other_builder = MessageBuilder("You are a bot.", "gpt-35-turbo", token_count_cache=cache)
+    assert other_builder.count_tokens_for_message(message) == count
+    assert cache.hits == 2
+    # The counts depend on the model
+    other_model_builder = MessageBuilder("You are a bot.", "gpt-4", token_count_cache=cache)
+    other_model_builder.count_tokens_for_message(message)
+    assert len(cache) == 2
@@ -1,9 +1,13 @@
 import pytest
+import tiktoken
 
 from core.modelhelper import (
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_messages_batch,
+    num_tokens_from_texts,
 )
 
 
@@ -59,3 +63,49 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_get_encoding_resolved_once(monkeypatch):
+    calls = []
+    encoding_for_model = tiktoken.encoding_for_model
+
+    def mock_encoding_for_model(model_name):
+        calls.append(model_name)
+        return encoding_for_model(model_name)
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", mock_encoding_for_model)
+    get_encoding.cache_clear()
+
+    message = {"role": "user", "content": "Hello, how are you?"}
+    for _ in range(3):
+        num_tokens_from_messages(message, "gpt-35-turbo")
+    num_tokens_from_texts(["Hello", "how are you?"], "gpt-35-turbo")
+
+    assert calls == ["gpt-3.5-turbo"]
+    get_encoding.cache_clear()
+
+
+def test_num_tokens_from_texts():
+    texts = ["Hello, how are you?", "東京の天気はどうですか?", ""]
+    encoding = get_encoding("gpt-35-turbo")
+    assert num_tokens_from_texts(texts, "gpt-35-turbo") == [len(encoding.encode(text)) for text in texts]
+    assert num_tokens_from_texts(texts[:1], "gpt-35-turbo") == [len(encoding.encode(texts[0]))]
+    assert num_tokens_from_texts([], "gpt-35-turbo") == []
+
+    # Large batches are encoded on a thread pool
+    long_texts = ["東京の天気はどうですか? " * 1000, "Hello, how are you? " * 1000]
+    assert num_tokens_from_texts(long_texts, "gpt-35-turbo", num_threads=2) == [
+        len(encoding.encode(text)) for text in long_texts
+    ]
+
+
+def test_num_tokens_from_messages_batch():
+    messages = [
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "元気です、ありがとう。"},
+        {"role": "user", "content": ["Describe the image", {"image_url": {"url": "data:image/png;base64,"}}]},
+    ]
+    assert num_tokens_from_messages_batch(messages, "gpt-4") == [
+        num_tokens_from_messages(message, "gpt-4") for message in messages
+    ]
+    assert num_tokens_from_messages_batch([], "gpt-4") == []
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+import core.serialization
+from approaches.approach import ThoughtStep
+from core.serialization import dumps, dumps_ndjson_line, to_serializable
+
+EVENT = {
+    "choices": [
+        {
+            "delta": {"role": "assistant"},
+            "context": {
+                "data_points": {"text": ["Benefit_Options-2.pdf: 眼科検診はカバーされています。\nNew line"]},
+                "thoughts": [
+                    ThoughtStep("Original user query", "What is the capital of France?"),
+                    ThoughtStep("Results", [{"id": "file-1", "score": 0.5}], {"search_cache_hit": False, "top": 3}),
+                ],
+            },
+            "session_state": None,
+            "finish_reason": None,
+            "index": 0,
+        }
+    ],
+    "object": "chat.completion.chunk",
+}
+
+
+@pytest.fixture(params=[True, False], ids=["orjson", "json"])
+def backend(request, monkeypatch):
+    if request.param and not core.serialization.HAS_ORJSON:
+        pytest.skip("orjson is not installed")
+    monkeypatch.setattr(core.serialization, "HAS_ORJSON", request.param)
+
+
+def test_dumps(backend):
+    serialized = dumps(EVENT)
+
+    assert "\n" not in serialized
+    assert ", " not in serialized.replace("\\n", "")
+    assert json.loads(serialized)["choices"][0]["context"]["thoughts"] == [
+        {"title": "Original user query", "description": "What is the capital of France?", "props": None},
+        {
+            "title": "Results",
+            "description": [{"id": "file-1", "score": 0.5}],
+            "props": {"search_cache_hit": False, "top": 3},
+        },
+    ]
+    assert "眼科検診" in serialized
+
+
+def test_dumps_ndjson_line(backend):
+    line = dumps_ndjson_line(EVENT)
+
+    assert line.endswith("}\n")
+    assert line.count("\n") == 1
+    assert line == dumps(EVENT) + "\n"
+
+
+def test_backends_match(monkeypatch):
+    if not core.serialization.HAS_ORJSON:
+        pytest.skip("orjson is not installed")
+    with_orjson = dumps_ndjson_line(EVENT)
+    monkeypatch.setattr(core.serialization, "HAS_ORJSON", False)
+    assert dumps_ndjson_line(EVENT) == with_orjson
+
+
+def test_to_serializable_is_shallow():
+    props = {"top": 3}
+    thought = ThoughtStep("Results", [], props)
+
+    assert to_serializable(thought)["props"] is props
+    with pytest.raises(TypeError):
+        to_serializable(object())
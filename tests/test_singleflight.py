@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from core.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_singleflight_coalesces_concurrent_calls():
+    single_flight: SingleFlight[int] = SingleFlight()
+    calls = 0
+    release = asyncio.Event()
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return 42
+
+    waiters = [asyncio.create_task(single_flight.do("key", fetch)) for _ in range(5)]
+    await asyncio.sleep(0)
+    assert len(single_flight) == 1
+    release.set()
+
+    assert await asyncio.gather(*waiters) == [42] * 5
+    assert calls == 1
+    assert len(single_flight) == 0
+
+    # Once the call completed, the next call runs again
+    assert await single_flight.do("key", fetch) == 42
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_singleflight_shares_errors():
+    single_flight: SingleFlight[int] = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("failed")
+
+    results = await asyncio.gather(single_flight.do("key", fail), single_flight.do("key", fail), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_singleflight_cancelled_caller_doesnt_cancel_call():
+    single_flight: SingleFlight[str] = SingleFlight()
+    release = asyncio.Event()
+
+    async def fetch():
+        await release.wait()
+        return "done"
+
+    cancelled = asyncio.create_task(single_flight.do("key", fetch))
+    waiting = asyncio.create_task(single_flight.do("key", fetch))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    release.set()
+
+    assert await waiting == "done"
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled